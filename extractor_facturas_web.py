@@ -1,7 +1,10 @@
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
 from io import BytesIO
+from copy import copy
 import streamlit as st
 import pypdf
 import pandas as pd
@@ -9,9 +12,22 @@ import re
 from datetime import datetime
 import os
 import json
-import tempfile
+import csv
+import sys
+import time
+import argparse
 import uuid
+import zlib
 import pickle
+import sqlite3
+import hashlib
+import importlib
+import queue
+import threading
+import logging
+import heapq
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import pytesseract
 from PIL import Image
 import io
@@ -19,159 +35,1146 @@ import numpy as np
 import cv2
 from pdf2image import convert_from_bytes
 
+# Motor de OCR en proceso (opcional): evita lanzar un proceso de tesseract por página
+TESSEROCR_PENDIENTE = False  # True si sólo falta cargarlo desde un hilo principal
+try:
+    import tesserocr
+    ERROR_TESSEROCR = None
+except ImportError:
+    tesserocr = None
+    ERROR_TESSEROCR = "tesserocr no está instalado"
+except ValueError:
+    # tesserocr instala manejadores de señales (cysignals) y eso sólo se puede en el hilo principal;
+    # streamlit ejecuta el script en otro hilo, así que se carga en los procesos del lote (cargar_tesserocr)
+    tesserocr = None
+    ERROR_TESSEROCR = "tesserocr sólo se puede cargar en el hilo principal de un proceso"
+    TESSEROCR_PENDIENTE = True
+
+# Exportación a Parquet (opcional)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # Configuración de variables para los servicios de extracción
 USE_PATTERN_MATCHING = True
 USE_TESSERACT_OCR = True  # Reemplazo para OpenAI - GRATIS
+PRIORIZAR_CAPA_TEXTO = True  # Probar primero la capa de texto y usar OCR sólo si hace falta
+
+# Campos mínimos para aceptar una extracción sin escalar a OCR
+CAMPOS_REQUERIDOS = ('Numero_Factura', 'Fecha', 'Total')
+TOLERANCIA_CONCILIACION = 1.0  # Diferencia máxima entre el total y la suma de componentes
+
+# Criterios para considerar utilizable la capa de texto de una página (si no, se le aplica OCR)
+MIN_CARACTERES_CAPA_TEXTO = 30
+MIN_PROPORCION_ALFANUMERICA = 0.5
+
+# Motor de OCR: 'auto' usa tesserocr si está instalado y, si no, pytesseract (un subproceso por imagen)
+OCR_MOTOR = 'auto'
+OCR_IDIOMA = 'spa'
+
+# OCR por regiones de interés: fracción de la página (desde arriba y desde abajo)
+# donde se buscan los bloques de encabezado y de totales
+OCR_POR_REGIONES = True
+FRACCION_ENCABEZADO = 0.3
+FRACCION_TOTALES = 0.4
+AREA_MINIMA_BLOQUE = 0.0005  # Fracción del área de la página; descarta manchas y ruido
+MARGEN_REGION = 10  # Píxeles alrededor de cada región recortada
+
+# Procesos en paralelo para lotes de facturas (OCR y RegEx son intensivos en CPU)
+MAX_PROCESOS_LOTE = os.cpu_count() or 1
+
+# Páginas de un mismo documento que se pasan por OCR al mismo tiempo (cada una es un proceso de tesseract)
+OCR_HILOS_POR_DOCUMENTO = min(4, os.cpu_count() or 1)
+
+# Caché de resultados de extracción en disco
+RUTA_CACHE_EXTRACCIONES = 'cache_extracciones'
+TAMANO_MAXIMO_CACHE = 50 * 1024 * 1024  # Bytes
+VERSION_CACHE_EXTRACCION = 1  # Incrementar cuando cambie la lógica de extracción para invalidar la caché
+
+# Patrones de campos (número, fecha, importes) por conjunto: 'ocr' y 'texto' (capa de texto)
+RUTA_PATRONES_CAMPOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'patrones_campos.json')
+
+# Caracteres que se miran después de una etiqueta para encontrar su valor (en lugar de .*? sin límite)
+VENTANA_BUSQUEDA = 120
+# Tiempo máximo por patrón y documento; si se excede, el patrón se deja de probar en ese documento
+PRESUPUESTO_PATRON_MS = 50
+# Crecimiento máximo del tiempo de los patrones por cada duplicación del texto (≈2 si es lineal)
+MAX_CRECIMIENTO_PATRONES = 3.0
+# Patrones omitidos por el presupuesto y etapas que fallaron en el documento que procesa cada hilo
+# (ver extraer_datos_pdf)
+_estado_documento = threading.local()
+
+# Los avisos que no salen del hilo de la interfaz (procesos e hilos del lote) van al log
+logger = logging.getLogger(__name__)
+
+# Base de patrones aprendidos
+CAPACIDAD_PATRONES = 2000  # Máximo de patrones guardados
+POLITICA_EXPULSION = 'lru'  # 'lru' (el usado hace más tiempo) o 'lfu' (el menos usado)
+FRACCION_EXPULSION = 0.1  # Al superar la capacidad se expulsa de una vez esta fracción, no un patrón por INSERT
+UMBRAL_DEDUPLICACION = 0.9  # Similitud a partir de la cual un patrón nuevo se fusiona con uno existente
+# Similitud mínima con un patrón de otro emisor para probar su plantilla (los montos se concilian después)
+UMBRAL_SIMILITUD_PATRON = 0.7
+
+# Excel: a partir de esta cantidad de facturas el detalle va en una sola hoja "Detalle" en lugar de una hoja por factura
+UMBRAL_HOJA_DETALLE = 200
 
 # Clase para almacenar y gestionar patrones de facturas reconocidos
 class PatronesFacturas:
-    def __init__(self, ruta_archivo='patrones_facturas.pkl'):
+    """
+    Patrones aprendidos, guardados en SQLite (una fila por patrón) y con una copia en memoria
+    para las búsquedas. Agregar un patrón es un único INSERT, sin reescribir la base entera.
+    
+    Cada patrón guarda sus palabras clave y su firma MinHash; un índice LSH por bandas
+    devuelve los pocos candidatos parecidos y sólo a esos se les calcula el Jaccard exacto.
+    
+    Los patrones también se indexan por emisor (CUIT y punto de venta del encabezado):
+    para un proveedor conocido la búsqueda es un acceso al diccionario (sin umbral de
+    similitud) y sólo se recurre a la búsqueda por similitud con emisores nuevos.
+    
+    Cada patrón guarda una plantilla con la ubicación de sus campos (etiqueta, línea relativa
+    y expresión del valor), así una factura parecida se lee con esa plantilla y devuelve sus
+    propios montos, no los de la factura con la que se aprendió.
+    
+    Un patrón casi idéntico a uno ya guardado (mismo emisor y tipo, y la misma forma de
+    plantilla o palabras casi iguales) no se agrega: se fusiona sumándole un acierto.
+    Al superar la capacidad se expulsan de una vez los patrones necesarios para bajar a
+    FRACCION_EXPULSION por debajo de ella, según la política de expulsión; así la base no
+    se recorre en cada INSERT sino una vez cada tantos patrones nuevos. Capacidad,
+    política y umbral de deduplicación son atributos de la instancia (por defecto, los
+    globales): la instancia se comparte entre reruns y sesiones, así que la interfaz los
+    cambia sobre ella con configurar().
+    
+    Varias sesiones y procesos comparten la base: cada escritura es una transacción
+    BEGIN IMMEDIATE (las demás esperan hasta TIEMPO_ESPERA_BLOQUEO) y unos triggers anotan
+    los ids modificados en la tabla cambios. Antes de leer o escribir, cada instancia aplica
+    sólo los cambios de los demás que todavía no vio, sin recargar toda la base.
+    """
+    SOLO_LECTURA = False
+    VERSION_PALABRAS = 1  # Incrementar cuando cambie palabras_clave: las guardadas se vuelven a calcular
+    TIEMPO_ESPERA_BLOQUEO = 30  # Segundos que una escritura espera a que se libere la base
+    MAX_CAMBIOS = 10000  # Cambios que se conservan; una instancia más atrasada recarga todo
+    COLUMNAS_AGREGADAS = [('palabras', 'TEXT'), ('firma', 'BLOB'), ('tipo_factura', 'TEXT'),
+                          ('aciertos', 'INTEGER NOT NULL DEFAULT 0'), ('ultimo_uso', 'TEXT'),
+                          ('clave_emisor', 'TEXT'), ('plantilla', 'TEXT')]
+    COLUMNAS = ('id, texto_muestra, fecha_creacion, metodo_extraccion, estructura, palabras, firma, '
+                'tipo_factura, aciertos, ultimo_uso, clave_emisor, plantilla')
+    
+    # El CUIT del emisor es el primero del encabezado (el del cliente viene después)
+    LARGO_ENCABEZADO = 3000
+    PATRON_CUIT = re.compile(r'C\.?U\.?I\.?T\.?\s*(?:N[°ºo]\.?\s*)?:?\s*(\d{2})[-\s]?(\d{8})[-\s]?(\d)\b', re.I)
+    PATRON_PUNTO_VENTA = re.compile(r'Punto\s+de\s+Venta\s*(?:N[°ºo]\.?\s*)?:?\s*(\d{1,5})\b|\b(\d{4,5})-\d{8}\b', re.I)
+    
+    # MinHash/LSH: con 32 bandas de 4 filas, un par con Jaccard 0.7 es candidato con
+    # probabilidad ~1 - 2e-4; con umbrales menores a UMBRAL_MINIMO_LSH se compara contra todos
+    NUM_PERMUTACIONES = 128
+    FILAS_POR_BANDA = 4
+    UMBRAL_MINIMO_LSH = 0.7
+    PRIMO_MINHASH = (1 << 31) - 1
+    _generador = np.random.RandomState(20240601)
+    COEFICIENTES_A = _generador.randint(1, PRIMO_MINHASH, NUM_PERMUTACIONES).astype(np.uint64)
+    COEFICIENTES_B = _generador.randint(0, PRIMO_MINHASH, NUM_PERMUTACIONES).astype(np.uint64)
+    
+    def __init__(self, ruta_archivo='patrones_facturas.db', ruta_pickle='patrones_facturas.pkl'):
         self.ruta_archivo = ruta_archivo
-        self.patrones = self._cargar_patrones()
+        # La conexión y los índices en memoria se comparten entre los hilos de la sesión
+        self._bloqueo = threading.RLock()
+        self.capacidad = CAPACIDAD_PATRONES
+        self.politica_expulsion = POLITICA_EXPULSION
+        self.umbral_deduplicacion = UMBRAL_DEDUPLICACION
+        self.conexion = self._conectar()
+        self._migrar_pickle(ruta_pickle)
+        self._vaciar_indices()
+        self._cargar_patrones()
+    
+    def _vaciar_indices(self):
+        self.patrones = {}
+        self._palabras = {}  # id -> frozenset de palabras clave
+        self._firmas = {}  # id -> firma MinHash, para sacarlo de las bandas al expulsarlo
+        self._por_emisor = {}  # clave de emisor -> ids, en el orden en que se aprendieron
+        self._bandas = [{} for _ in range(self.NUM_PERMUTACIONES // self.FILAS_POR_BANDA)]
+        self._secuencia = {}  # id -> orden en que se indexó, para ordenar sólo los candidatos
+        self._siguiente_secuencia = 0
+        self._ultimo_cambio = 0  # Último cambio de la tabla cambios ya aplicado en memoria
+        self._version_datos = None
+    
+    @staticmethod
+    def palabras_clave(texto):
+        """
+        Palabras más distintivas (más largas) del texto, en minúsculas. Las que tienen dígitos
+        (números, fechas, importes) cambian en cada factura del mismo formato y no se usan.
+        """
+        return frozenset(palabra.lower() for palabra in texto.split()
+                         if len(palabra) > 5 and not any(caracter.isdigit() for caracter in palabra))
+    
+    @staticmethod
+    def forma_plantilla(plantilla):
+        """Campos y etiquetas de una plantilla, sin los valores: igual para facturas del mismo formato"""
+        return frozenset((campo, ubicacion['etiqueta'], ubicacion['desplazamiento'])
+                         for campo, ubicacion in (plantilla or {}).items())
+    
+    @classmethod
+    def clave_emisor(cls, texto):
+        """'CUIT/punto de venta' del emisor según el encabezado, o '' si no se encuentra el CUIT"""
+        encabezado = texto[:cls.LARGO_ENCABEZADO]
+        cuit = cls.PATRON_CUIT.search(encabezado)
+        if not cuit:
+            return ''
+        punto_venta = cls.PATRON_PUNTO_VENTA.search(encabezado)
+        punto_venta = int(punto_venta.group(1) or punto_venta.group(2)) if punto_venta else 0
+        return f"{''.join(cuit.groups())}/{punto_venta:05d}"
+    
+    @classmethod
+    def firma_minhash(cls, palabras):
+        """Firma MinHash de un conjunto de palabras (hashes estables entre procesos)"""
+        if not palabras:
+            return None
+        hashes = np.fromiter((zlib.crc32(palabra.encode('utf-8')) for palabra in palabras),
+                             dtype=np.uint64, count=len(palabras)) % cls.PRIMO_MINHASH
+        valores = (np.outer(hashes, cls.COEFICIENTES_A) + cls.COEFICIENTES_B) % cls.PRIMO_MINHASH
+        return valores.min(axis=0).astype(np.uint32)
+    
+    def _claves_bandas(self, firma):
+        filas = self.FILAS_POR_BANDA
+        return [firma[i * filas:(i + 1) * filas].tobytes() for i in range(len(self._bandas))]
+    
+    def _indexar(self, id_patron, patron, palabras, firma):
+        self.patrones[id_patron] = patron
+        self._palabras[id_patron] = palabras
+        self._firmas[id_patron] = firma
+        self._secuencia[id_patron] = self._siguiente_secuencia
+        self._siguiente_secuencia += 1
+        if patron['clave_emisor']:
+            self._por_emisor.setdefault(patron['clave_emisor'], []).append(id_patron)
+        if firma is not None:
+            for banda, clave in zip(self._bandas, self._claves_bandas(firma)):
+                banda.setdefault(clave, []).append(id_patron)
+    
+    def _desindexar(self, id_patron):
+        clave_emisor = self.patrones.pop(id_patron)['clave_emisor']
+        if clave_emisor:
+            ids = self._por_emisor[clave_emisor]
+            ids.remove(id_patron)
+            if not ids:
+                del self._por_emisor[clave_emisor]
+        del self._palabras[id_patron]
+        del self._secuencia[id_patron]
+        firma = self._firmas.pop(id_patron)
+        if firma is not None:
+            for banda, clave in zip(self._bandas, self._claves_bandas(firma)):
+                ids = banda[clave]
+                ids.remove(id_patron)
+                if not ids:
+                    del banda[clave]
+    
+    @contextmanager
+    def _transaccion(self, escritura=True):
+        """
+        Transacción explícita (la conexión está en modo autocommit). Las de escritura toman el
+        bloqueo de la base al empezar, así lo que se lee adentro no cambia hasta el COMMIT.
+        """
+        with self._bloqueo:
+            if self.conexion.in_transaction:
+                yield
+                return
+            self.conexion.execute("BEGIN IMMEDIATE" if escritura else "BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.conexion.execute("ROLLBACK")
+                raise
+            self.conexion.execute("COMMIT")
+    
+    @contextmanager
+    def _escritura(self):
+        """Transacción de escritura sobre los índices al día; los cambios propios no se vuelven a leer"""
+        with self._transaccion():
+            self._aplicar_cambios()
+            yield
+            self._ultimo_cambio = self.conexion.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+    
+    def _conectar(self):
+        conexion = sqlite3.connect(self.ruta_archivo, timeout=self.TIEMPO_ESPERA_BLOQUEO,
+                                   check_same_thread=False, isolation_level=None)
+        # WAL: los lectores (otras sesiones, procesos del lote) no se bloquean mientras se escribe
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        # Crear o actualizar el esquema con la base bloqueada, por si otro proceso lo hace a la vez
+        conexion.execute("BEGIN IMMEDIATE")
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS patrones (
+                id TEXT PRIMARY KEY,
+                texto_muestra TEXT NOT NULL,
+                fecha_creacion TEXT NOT NULL,
+                metodo_extraccion TEXT,
+                estructura TEXT NOT NULL,
+                palabras TEXT,
+                firma BLOB,
+                tipo_factura TEXT,
+                aciertos INTEGER NOT NULL DEFAULT 0,
+                ultimo_uso TEXT
+            )
+        """)
+        # Bases creadas con versiones anteriores de la tabla
+        columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(patrones)")}
+        if not self.SOLO_LECTURA:
+            for columna, definicion in self.COLUMNAS_AGREGADAS:
+                if columna not in columnas:
+                    conexion.execute(f"ALTER TABLE patrones ADD COLUMN {columna} {definicion}")
+            # Palabras calculadas con otra versión de palabras_clave: se completan de nuevo al cargar
+            if conexion.execute("PRAGMA user_version").fetchone()[0] < self.VERSION_PALABRAS:
+                conexion.execute("UPDATE patrones SET palabras = NULL")
+                conexion.execute(f"PRAGMA user_version = {self.VERSION_PALABRAS}")
+        
+        # Registro de cambios entre procesos: los triggers anotan cada id insertado, modificado o borrado
+        conexion.execute("CREATE TABLE IF NOT EXISTS cambios (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL)")
+        for operacion, fila in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            conexion.execute(f"CREATE TRIGGER IF NOT EXISTS patrones_{operacion.lower()} AFTER {operacion} ON patrones "
+                             f"BEGIN INSERT INTO cambios (id) VALUES ({fila}.id); END")
+        conexion.execute("COMMIT")
+        return conexion
+    
+    def _migrar_pickle(self, ruta_pickle):
+        """Importa una sola vez la base anterior en pickle y la renombra para no volver a leerla"""
+        if not ruta_pickle or not os.path.exists(ruta_pickle):
+            return
+        
+        # Con la base bloqueada: si otro proceso ya migró, la tabla no está vacía
+        with self._transaccion():
+            if self.conexion.execute("SELECT 1 FROM patrones LIMIT 1").fetchone():
+                return
+            
+            try:
+                with open(ruta_pickle, 'rb') as f:
+                    patrones = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                st.warning(f"No se pudo migrar {ruta_pickle}: {str(e)}")
+                return
+            
+            filas = []
+            for id_patron, patron in patrones.items():
+                palabras = self.palabras_clave(patron['texto_muestra'])
+                patron.setdefault('tipo_factura', identificar_tipo_factura(patron['texto_muestra']))
+                patron.setdefault('clave_emisor', self.clave_emisor(patron['texto_muestra']))
+                patron.setdefault('plantilla', construir_plantilla(patron['texto_muestra'], patron['estructura']))
+                filas.append(self._fila(id_patron, patron, palabras, self.firma_minhash(palabras)))
+            self.conexion.executemany(f"INSERT OR IGNORE INTO patrones ({self.COLUMNAS}) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", filas)
+            os.replace(ruta_pickle, ruta_pickle + '.migrado')
+    
+    @staticmethod
+    def _fila(id_patron, patron, palabras, firma):
+        return (id_patron, patron['texto_muestra'], patron['fecha_creacion'],
+                patron.get('metodo_extraccion'), json.dumps(patron['estructura'], default=str),
+                json.dumps(sorted(palabras)), firma.tobytes() if firma is not None else None,
+                patron.get('tipo_factura'), patron.get('aciertos', 0), patron.get('ultimo_uso'),
+                patron.get('clave_emisor'), json.dumps(patron['plantilla']) if 'plantilla' in patron else None)
+    
+    def _leer_fila(self, fila):
+        """(id, patrón, palabras, firma, completado) de una fila; completado indica si hubo que calcular columnas"""
+        (id_patron, texto_muestra, fecha_creacion, metodo, estructura, palabras, firma,
+         tipo_factura, aciertos, ultimo_uso, clave_emisor, plantilla) = fila
+        patron = {
+            'texto_muestra': texto_muestra,
+            'fecha_creacion': fecha_creacion,
+            'metodo_extraccion': metodo,
+            'estructura': json.loads(estructura),
+            'tipo_factura': tipo_factura,
+            'aciertos': aciertos,
+            'ultimo_uso': ultimo_uso,
+            'clave_emisor': clave_emisor,
+            'plantilla': json.loads(plantilla) if plantilla is not None else None
+        }
+        if palabras is None or tipo_factura is None or clave_emisor is None or plantilla is None:
+            # Patrón guardado con una versión anterior: completarlo
+            palabras = self.palabras_clave(texto_muestra)
+            firma = self.firma_minhash(palabras)
+            patron['tipo_factura'] = identificar_tipo_factura(texto_muestra)
+            patron['clave_emisor'] = self.clave_emisor(texto_muestra)
+            patron['plantilla'] = construir_plantilla(texto_muestra, patron['estructura'])
+            return id_patron, patron, palabras, firma, True
+        palabras = frozenset(json.loads(palabras))
+        firma = np.frombuffer(firma, dtype=np.uint32) if firma is not None else None
+        return id_patron, patron, palabras, firma, False
     
     def _cargar_patrones(self):
-        try:
-            with open(self.ruta_archivo, 'rb') as f:
-                return pickle.load(f)
-        except (FileNotFoundError, EOFError):
-            return {}
-    
-    def guardar_patrones(self):
-        with open(self.ruta_archivo, 'wb') as f:
-            pickle.dump(self.patrones, f)
-    
-    def encontrar_patron_similar(self, texto, umbral_similitud=0.85):  # Umbral más estricto
-        """Encuentra patrones similares basándose en palabras clave, con criterios más estrictos"""
+        with self._transaccion(escritura=False):
+            # Los cambios anteriores a esta lectura ya quedan incluidos en ella
+            self._ultimo_cambio = self.conexion.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+            self._version_datos = self.conexion.execute("PRAGMA data_version").fetchone()[0]
+            sin_firma = []
+            for fila in self.conexion.execute(f"SELECT {self.COLUMNAS} FROM patrones ORDER BY rowid"):
+                id_patron, patron, palabras, firma, completado = self._leer_fila(fila)
+                if completado:
+                    sin_firma.append((json.dumps(sorted(palabras)), firma.tobytes() if firma is not None else None,
+                                      patron['tipo_factura'], patron['clave_emisor'], json.dumps(patron['plantilla']),
+                                      id_patron))
+                self._indexar(id_patron, patron, palabras, firma)
+        
+        # Guardar una sola vez lo calculado para los patrones de versiones anteriores
+        if sin_firma and not self.SOLO_LECTURA:
+            with self._escritura():
+                self.conexion.executemany("UPDATE patrones SET palabras = ?, firma = ?, tipo_factura = ?, "
+                                          "clave_emisor = ?, plantilla = ? WHERE id = ?", sin_firma)
+    
+    def _aplicar_cambios(self):
+        """Aplica en memoria los patrones que otras sesiones o procesos agregaron, modificaron o borraron"""
+        with self._transaccion(escritura=False):
+            # data_version cambia sólo cuando otra conexión confirma una escritura
+            version = self.conexion.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._version_datos:
+                return
+            self._version_datos = version
+            
+            primero, ultimo = self.conexion.execute("SELECT MIN(seq), MAX(seq) FROM cambios").fetchone()
+            if ultimo is None or ultimo <= self._ultimo_cambio:
+                return
+            if primero > self._ultimo_cambio + 1:
+                # Los cambios intermedios ya se podaron: recargar todo
+                self._vaciar_indices()
+                self._cargar_patrones()
+                return
+            
+            ids = [fila[0] for fila in self.conexion.execute(
+                "SELECT id FROM cambios WHERE seq > ? GROUP BY id ORDER BY MIN(seq)", (self._ultimo_cambio,))]
+            for id_patron in ids:
+                fila = self.conexion.execute(f"SELECT {self.COLUMNAS} FROM patrones WHERE id = ?", (id_patron,)).fetchone()
+                if fila is None:
+                    if id_patron in self.patrones:
+                        self._desindexar(id_patron)
+                elif id_patron in self.patrones:
+                    # Sólo cambian aciertos, último uso o plantilla: actualizar sin mover de lugar
+                    self.patrones[id_patron].update(self._leer_fila(fila)[1])
+                else:
+                    self._indexar(*self._leer_fila(fila)[:4])
+            self._ultimo_cambio = ultimo
+    
+    def refrescar(self):
+        """Pone al día los índices en memoria con los cambios de otras sesiones y procesos"""
+        with self._bloqueo:
+            self._aplicar_cambios()
+    
+    def reiniciar(self):
+        """Borra todos los patrones aprendidos"""
+        with self._escritura():
+            self.conexion.execute("DELETE FROM patrones")
+            self._podar_cambios()
+        self._vaciar_indices()
+        self._ultimo_cambio = self.conexion.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+    
+    def _podar_cambios(self):
+        self.conexion.execute("DELETE FROM cambios WHERE seq <= (SELECT MAX(seq) FROM cambios) - ?", (self.MAX_CAMBIOS,))
+    
+    def registrar_uso(self, id_patron):
+        """Suma un acierto al patrón y actualiza su último uso (para la política de expulsión)"""
+        with self._escritura():
+            patron = self.patrones.get(id_patron)
+            if patron is None:
+                return  # Ya expulsado
+            patron['ultimo_uso'] = datetime.now().isoformat()
+            # El incremento se hace en la base: otro proceso puede haber sumado aciertos
+            self.conexion.execute("UPDATE patrones SET aciertos = aciertos + 1, ultimo_uso = ? WHERE id = ?",
+                                  (patron['ultimo_uso'], id_patron))
+            patron['aciertos'] = self.conexion.execute("SELECT aciertos FROM patrones WHERE id = ?",
+                                                       (id_patron,)).fetchone()[0]
+    
+    def _patron_duplicado(self, palabras, tipo_factura, clave_emisor, plantilla):
+        """
+        Id del patrón guardado del mismo emisor y tipo con la misma forma de plantilla (si el
+        emisor es conocido) o, si no, el más parecido que supere el umbral de deduplicación
+        """
+        forma = self.forma_plantilla(plantilla)
+        mejor_id = None
+        mejor_similitud = 0
+        for id_patron in self._candidatos(palabras, self.umbral_deduplicacion, clave_emisor):
+            patron = self.patrones[id_patron]
+            if patron['tipo_factura'] != tipo_factura or patron['clave_emisor'] != clave_emisor:
+                continue
+            if clave_emisor and forma and self.forma_plantilla(patron['plantilla']) == forma:
+                return id_patron
+            palabras_patron = self._palabras[id_patron]
+            similitud = len(palabras & palabras_patron) / len(palabras | palabras_patron)
+            if similitud > mejor_similitud and similitud >= self.umbral_deduplicacion:
+                mejor_id = id_patron
+                mejor_similitud = similitud
+        return mejor_id
+    
+    def _expulsar_excedentes(self):
+        """
+        Si se superó la capacidad, borra los patrones necesarios para bajar a
+        FRACCION_EXPULSION por debajo de ella, según la política de expulsión
+        """
+        if len(self.patrones) <= self.capacidad:
+            return
+        excedentes = len(self.patrones) - max(1, int(self.capacidad * (1 - FRACCION_EXPULSION)))
+        
+        def ultimo_uso(id_patron):
+            patron = self.patrones[id_patron]
+            return patron.get('ultimo_uso') or patron['fecha_creacion']
+        
+        if self.politica_expulsion == 'lfu':
+            clave = lambda id_patron: (self.patrones[id_patron].get('aciertos', 0), ultimo_uso(id_patron))
+        else:
+            clave = ultimo_uso
+        expulsados = heapq.nsmallest(excedentes, self.patrones, key=clave)
+        
+        self.conexion.executemany("DELETE FROM patrones WHERE id = ?", [(id_patron,) for id_patron in expulsados])
+        for id_patron in expulsados:
+            self._desindexar(id_patron)
+    
+    def configurar(self, capacidad=None, politica_expulsion=None, umbral_deduplicacion=None):
+        """Cambia la capacidad, la política o el umbral; si la capacidad baja, expulsa ya los excedentes"""
+        with self._bloqueo:
+            if capacidad is not None:
+                self.capacidad = capacidad
+            if politica_expulsion is not None:
+                self.politica_expulsion = politica_expulsion
+            if umbral_deduplicacion is not None:
+                self.umbral_deduplicacion = umbral_deduplicacion
+            if not self.SOLO_LECTURA and len(self.patrones) > self.capacidad:
+                with self._escritura():
+                    self._expulsar_excedentes()
+    
+    def _candidatos(self, palabras_clave, umbral_similitud, clave_emisor=''):
+        """Ids de los patrones que pueden superar el umbral, en el orden en que se aprendieron"""
+        # Emisor conocido: sus patrones son los únicos candidatos
+        if clave_emisor in self._por_emisor:
+            return list(self._por_emisor[clave_emisor])
+        
+        firma = self.firma_minhash(palabras_clave)
+        if firma is None:
+            return []
+        if umbral_similitud < self.UMBRAL_MINIMO_LSH:
+            return list(self.patrones)
+        
+        candidatos = set()
+        for banda, clave in zip(self._bandas, self._claves_bandas(firma)):
+            candidatos.update(banda.get(clave, ()))
+        return sorted(candidatos, key=self._secuencia.__getitem__)
+    
+    def encontrar_patron_similar(self, texto, umbral_similitud=None):
+        """
+        (id, patrón) del patrón más parecido según las palabras clave, o (None, None).
+        Los montos no se comparan: la plantilla del patrón lee los de esta factura y el
+        resultado se concilia después. El acierto lo registra quien acepta ese resultado.
+        """
+        if umbral_similitud is None:
+            umbral_similitud = UMBRAL_SIMILITUD_PATRON
+        with self._bloqueo:
+            self._aplicar_cambios()
+            mejor_id = self._buscar_similar(texto, umbral_similitud)
+            if mejor_id is None:
+                return None, None
+            return mejor_id, self.patrones[mejor_id]
+    
+    def _buscar_similar(self, texto, umbral_similitud):
         if not texto or not self.patrones:
             return None
         
         # Extraer palabras clave más distintivas (más largas)
-        palabras_clave = set([palabra.lower() for palabra in texto.split() 
-                             if len(palabra) > 5])  # Palabras más largas
-        
-        mejor_patron = None
+        palabras_clave = self.palabras_clave(texto)
+        
+        # Emisor conocido: se usa su patrón sin umbral (la plantilla concilia los montos después);
+        # si tiene varios, el de palabras más parecidas
+        ids_emisor = self._por_emisor.get(self.clave_emisor(texto))
+        if ids_emisor:
+            def similitud_emisor(id_patron):
+                palabras_patron = self._palabras[id_patron]
+                union = len(palabras_clave | palabras_patron)
+                return len(palabras_clave & palabras_patron) / union if union else 0
+            return max(ids_emisor, key=similitud_emisor)
+        
+        mejor_id = None
         mejor_similitud = 0
         
-        for id_patron, patron in self.patrones.items():
-            palabras_patron = set([palabra.lower() for palabra in patron['texto_muestra'].split() 
-                                  if len(palabra) > 5])
+        for id_patron in self._candidatos(palabras_clave, umbral_similitud):
+            palabras_patron = self._palabras[id_patron]
             
             if not palabras_patron:
                 continue
                 
             # Calcular similitud Jaccard
-            interseccion = len(palabras_clave.intersection(palabras_patron))
-            union = len(palabras_clave.union(palabras_patron))
+            interseccion = len(palabras_clave & palabras_patron)
+            union = len(palabras_clave | palabras_patron)
             
             if union > 0:
                 similitud = interseccion / union
                 
                 # Añadir criterios adicionales
                 if similitud > mejor_similitud and similitud >= umbral_similitud:
-                    # Verificación adicional: los montos totales deberían ser similares
-                    try:
-                        total_texto = re.search(r'TOTAL:?\s*\$?\s*([\d.,]+)', texto, re.IGNORECASE)
-                        if total_texto and 'estructura' in patron and 'Total' in patron['estructura']:
-                            total_patron = float(patron['estructura']['Total'])
-                            total_actual = parse_number(total_texto)
-                            # Si los totales difieren en más de 10%, no considerar similar
-                            if abs(total_actual - total_patron) / max(total_actual, total_patron) > 0.1:
-                                continue
-                    except:
-                        pass  # Si falla la comparación, continuar con la verificación normal
-                    
                     mejor_similitud = similitud
-                    mejor_patron = patron
+                    mejor_id = id_patron
         
-        return mejor_patron
+        return mejor_id
     
     def agregar_patron(self, datos, texto_muestra, metodo_extraccion):
+        plantilla = construir_plantilla(texto_muestra, datos)
+        texto_muestra = texto_muestra[:5000]  # Limitar tamaño
+        palabras = self.palabras_clave(texto_muestra)
+        tipo_factura = identificar_tipo_factura(texto_muestra)
+        clave_emisor = self.clave_emisor(texto_muestra)
+        
+        firma = self.firma_minhash(palabras)
+        
+        # La búsqueda de duplicados, el INSERT y la expulsión van en la misma transacción
+        with self._escritura():
+            # Casi idéntico a uno ya guardado: se conserva el existente y se le suma un acierto
+            if palabras:
+                id_duplicado = self._patron_duplicado(palabras, tipo_factura, clave_emisor, plantilla)
+                if id_duplicado is not None:
+                    # Quedarse con la plantilla que ubica más campos
+                    if len(plantilla) > len(self.patrones[id_duplicado]['plantilla']):
+                        self.patrones[id_duplicado]['plantilla'] = plantilla
+                        self.conexion.execute("UPDATE patrones SET plantilla = ? WHERE id = ?",
+                                              (json.dumps(plantilla), id_duplicado))
+                    self.registrar_uso(id_duplicado)
+                    return id_duplicado
+            
+            return self._insertar(datos, texto_muestra, metodo_extraccion, palabras, firma,
+                                  tipo_factura, clave_emisor, plantilla)
+    
+    def _insertar(self, datos, texto_muestra, metodo_extraccion, palabras, firma, tipo_factura, clave_emisor, plantilla):
         id_patron = str(uuid.uuid4())
-        self.patrones[id_patron] = {
-            'texto_muestra': texto_muestra[:5000],  # Limitar tamaño
+        patron = {
+            'texto_muestra': texto_muestra,
             'fecha_creacion': datetime.now().isoformat(),
             'metodo_extraccion': metodo_extraccion,
-            'estructura': datos
+            'estructura': datos,
+            'tipo_factura': tipo_factura,
+            'aciertos': 0,
+            'ultimo_uso': None,
+            'clave_emisor': clave_emisor,
+            'plantilla': plantilla
         }
-        self.guardar_patrones()
+        self.conexion.execute(f"INSERT INTO patrones ({self.COLUMNAS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              self._fila(id_patron, patron, palabras, firma))
+        self._indexar(id_patron, patron, palabras, firma)
+        self._expulsar_excedentes()
+        self._podar_cambios()
         return id_patron
 
 
+class PatronesFacturasDiferidos(PatronesFacturas):
+    """
+    Vista de sólo lectura del almacén de patrones para los procesos del lote.
+    Los patrones nuevos no se escriben a disco: quedan pendientes y el proceso
+    principal los agrega de a uno, así las escrituras quedan serializadas.
+    """
+    SOLO_LECTURA = True
+    
+    def __init__(self, ruta_archivo='patrones_facturas.db'):
+        # La migración del pickle la hace el proceso principal
+        super().__init__(ruta_archivo, ruta_pickle=None)
+        self.pendientes = []
+        self.usos = []
+    
+    def agregar_patron(self, datos, texto_muestra, metodo_extraccion):
+        self.pendientes.append((dict(datos), texto_muestra, metodo_extraccion))
+        return None
+    
+    def registrar_uso(self, id_patron):
+        self.usos.append(id_patron)
+
+
+# Clase con el PDF ya parseado, compartida por todas las etapas de la cascada
+class IndiceEtiquetas:
+    """
+    Índice de las etiquetas del texto ("Importe Exento:", "IVA 21%:", ...) armado en una sola pasada.
+    Las últimas palabras antes de cada ':' de una línea apuntan a la posición donde empieza
+    su valor, así las búsquedas de "etiqueta: valor" no vuelven a recorrer todo el texto.
+    Como las expresiones a las que reemplaza, por defecto la etiqueta tiene que ir pegada
+    al ':' ("TOTAL:" sí, "TOTAL :" no).
+    """
+    MAX_PALABRAS_ETIQUETA = 12
+    PATRON_IMPORTE = r'\s*([\d.,]+)'
+    
+    def __init__(self, texto):
+        self.texto = texto
+        self.lineas = texto.split('\n')
+        self._etiquetas = {}  # etiqueta -> [(posición del valor, etiqueta pegada al ':')]
+        self._etiquetas_lower = {}
+        self._etiquetas_completas = []  # (texto en minúsculas desde el ':' anterior de la línea, posición del valor)
+        self._importes = {}
+        
+        inicio_linea = 0
+        for linea in self.lineas:
+            posicion = linea.find(':')
+            anterior = -1
+            while posicion != -1:
+                palabras = linea[:posicion].split()
+                posicion_valor = inicio_linea + posicion + 1
+                pegada = posicion > 0 and not linea[posicion - 1].isspace()
+                # Con varias etiquetas en la línea, la completa empieza después del ':' anterior
+                # (si no, "No Gravado" quedaría dentro de la etiqueta del IVA que le sigue)
+                propias = linea[anterior + 1:posicion].split()
+                if propias:
+                    self._etiquetas_completas.append((" ".join(propias).lower(), posicion_valor))
+                for n in range(1, min(len(palabras), self.MAX_PALABRAS_ETIQUETA) + 1):
+                    etiqueta = " ".join(palabras[-n:])
+                    self._etiquetas.setdefault(etiqueta, []).append((posicion_valor, pegada))
+                    self._etiquetas_lower.setdefault(etiqueta.lower(), []).append((posicion_valor, pegada))
+                anterior = posicion
+                posicion = linea.find(':', posicion + 1)
+            inicio_linea += len(linea) + 1
+    
+    def posiciones(self, etiquetas, ignorar_mayusculas=False, espacio_antes=False):
+        """
+        Posiciones (en orden) donde empieza el valor de alguna de las etiquetas.
+        Con espacio_antes también valen las etiquetas separadas del ':' ("TOTAL USD :").
+        """
+        if isinstance(etiquetas, str):
+            etiquetas = (etiquetas,)
+        indice = self._etiquetas_lower if ignorar_mayusculas else self._etiquetas
+        posiciones = []
+        for etiqueta in etiquetas:
+            etiqueta = " ".join(etiqueta.split())
+            for posicion, pegada in indice.get(etiqueta.lower() if ignorar_mayusculas else etiqueta, ()):
+                if pegada or espacio_antes:
+                    posiciones.append(posicion)
+        return sorted(posiciones)
+    
+    def buscar(self, etiquetas, patron_valor=PATRON_IMPORTE, ignorar_mayusculas=False, espacio_antes=False):
+        """Primer valor (match de patron_valor) que sigue a alguna de las etiquetas"""
+        patron = re.compile(patron_valor)
+        for posicion in self.posiciones(etiquetas, ignorar_mayusculas, espacio_antes):
+            match = patron.match(self.texto, posicion)
+            if match:
+                return match
+        return None
+    
+    def importe(self, etiquetas, ignorar_mayusculas=False):
+        """Importe que sigue a la etiqueta, ya convertido (0.0 si no está)"""
+        clave = (etiquetas, ignorar_mayusculas)
+        if clave not in self._importes:
+            match = self.buscar(etiquetas, ignorar_mayusculas=ignorar_mayusculas)
+            self._importes[clave] = parse_number(match) if match else 0.0
+        return self._importes[clave]
+    
+    def importe_etiqueta_con(self, fragmento):
+        """Importe de la primera etiqueta que contiene el fragmento (sin distinguir mayúsculas)"""
+        fragmento = " ".join(fragmento.split()).lower()
+        clave = ('contiene', fragmento)
+        if clave not in self._importes:
+            self._importes[clave] = None
+            patron = re.compile(self.PATRON_IMPORTE)
+            for etiqueta, posicion in self._etiquetas_completas:
+                if fragmento in etiqueta:
+                    match = patron.match(self.texto, posicion)
+                    if match:
+                        self._importes[clave] = parse_number(match)
+                        break
+        return self._importes[clave]
+
+
+class DocumentoPDF:
+    """
+    Documento PDF leído una sola vez por archivo subido.
+    Guarda los bytes crudos, el texto de cada página, el texto completo
+    ya normalizado en mayúsculas y minúsculas y su índice de etiquetas.
+    Durante el OCR guarda además las páginas ya rasterizadas y binarizadas (y el texto de
+    las que se reconocieron completas), así la pasada de respaldo no vuelve a rasterizar.
+    """
+    def __init__(self, nombre, contenido):
+        self.nombre = nombre
+        self.contenido = contenido
+
+        reader = pypdf.PdfReader(BytesIO(contenido))
+        self.textos_paginas = [pagina.extract_text() or "" for pagina in reader.pages]
+        self.texto = "".join(self.textos_paginas)
+        self.texto_upper = self.texto.upper()
+        self.texto_lower = self.texto.lower()
+        self._indice = None
+        self.paginas_binarizadas = {}  # página (None = todas) -> imágenes binarizadas
+        self.textos_ocr_completos = {}  # página -> texto del OCR de la página completa
+
+    @property
+    def indice(self):
+        """Índice de etiquetas del texto (se arma la primera vez que se usa)"""
+        if self._indice is None:
+            self._indice = IndiceEtiquetas(self.texto)
+        return self._indice
+
+    @property
+    def name(self):
+        # Compatibilidad con el nombre de los archivos subidos de Streamlit
+        return self.nombre
+
+    @property
+    def num_paginas(self):
+        return len(self.textos_paginas)
+
+    @classmethod
+    def desde_archivo(cls, archivo_pdf):
+        """Crea el documento a partir de un archivo subido (o lo devuelve si ya está parseado)"""
+        if isinstance(archivo_pdf, cls):
+            return archivo_pdf
+        archivo_pdf.seek(0)
+        contenido = archivo_pdf.read()
+        archivo_pdf.seek(0)
+        return cls(archivo_pdf.name, contenido)
+
+
+# Clase para cachear en disco los resultados de extracción por contenido del PDF
+class CacheExtracciones:
+    """
+    Caché persistente de resultados, indexada por el SHA-256 de los bytes del PDF
+    más la configuración de extracción. Cada entrada es un JSON en el directorio
+    de la caché; al superar el tamaño máximo se borran las menos usadas (LRU).
+    """
+    def __init__(self, ruta_directorio=RUTA_CACHE_EXTRACCIONES, tamano_maximo=TAMANO_MAXIMO_CACHE):
+        self.ruta_directorio = ruta_directorio
+        self.tamano_maximo = tamano_maximo
+        os.makedirs(ruta_directorio, exist_ok=True)
+        self.tamano_actual = sum(tamano for _, _, tamano in self._entradas())
+    
+    def clave(self, contenido, configuracion, ignore_patterns):
+        """Clave de la entrada: hash del archivo más todo lo que afecta el resultado"""
+        ajustes = dict(configuracion, ignore_patterns=ignore_patterns, version=VERSION_CACHE_EXTRACCION)
+        h = hashlib.sha256(contenido)
+        h.update(json.dumps(ajustes, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+    
+    def _ruta(self, clave):
+        return os.path.join(self.ruta_directorio, f"{clave}.json")
+    
+    def _entradas(self):
+        """Devuelve (ruta, último uso, tamaño) de cada entrada guardada"""
+        entradas = []
+        for nombre in os.listdir(self.ruta_directorio):
+            if not nombre.endswith('.json'):
+                continue
+            ruta = os.path.join(self.ruta_directorio, nombre)
+            try:
+                estado = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            entradas.append((ruta, estado.st_mtime, estado.st_size))
+        return entradas
+    
+    def obtener(self, clave):
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Entrada corrupta: se descarta y se vuelve a extraer
+            os.remove(ruta)
+            return None
+        
+        # Marcar como usada recientemente para la expulsión LRU
+        os.utime(ruta)
+        return datos
+    
+    def guardar(self, clave, datos):
+        ruta = self._ruta(clave)
+        contenido = json.dumps(datos, ensure_ascii=False).encode('utf-8')
+        
+        # Escritura atómica para no dejar entradas a medias
+        ruta_temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        with open(ruta_temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(ruta_temporal, ruta)
+        
+        self.tamano_actual += len(contenido)
+        if self.tamano_actual > self.tamano_maximo:
+            self._expulsar()
+    
+    def _expulsar(self):
+        """Borra las entradas usadas hace más tiempo hasta quedar bajo el tamaño máximo"""
+        entradas = sorted(self._entradas(), key=lambda entrada: entrada[1])
+        self.tamano_actual = sum(tamano for _, _, tamano in entradas)
+        for ruta, _, tamano in entradas:
+            if self.tamano_actual <= self.tamano_maximo:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            self.tamano_actual -= tamano
+
+
 # Función para identificar el tipo de factura
-def identificar_tipo_factura(texto):
+class ConjuntoPatrones:
+    """
+    Patrones de todos los campos de un conjunto, resueltos con una sola pasada sobre el texto.
+    
+    Cada patrón declara sus anclas: las etiquetas literales con las que puede empezar
+    ("total", "fecha", ...). Una única expresión encuentra todas las anclas del texto y en
+    cada una se prueban sólo los patrones que empiezan con ella. Por campo gana el patrón de
+    menor índice que coincida en alguna parte, en su posición más a la izquierda: el mismo
+    resultado que probar los patrones de a uno con re.search y quedarse con el primero.
+    """
+    FLAGS = re.IGNORECASE | re.DOTALL
+    
+    def __init__(self, campos):
+        self.patrones = {}
+        self._sin_ancla = {}  # campo -> [(prioridad, patrón)] que hay que buscar en todo el texto
+        por_ancla = {}  # ancla -> [(campo, prioridad, patrón)]
+        
+        for campo, entradas in campos.items():
+            self.patrones[campo] = []
+            for prioridad, entrada in enumerate(entradas):
+                # Cada entrada es {"patron": ..., "anclas": [...]} o directamente el patrón
+                if isinstance(entrada, str):
+                    entrada = {'patron': entrada}
+                patron = re.compile(entrada['patron'], self.FLAGS)
+                self.patrones[campo].append(patron)
+                if entrada.get('anclas'):
+                    for ancla in entrada['anclas']:
+                        por_ancla.setdefault(ancla.lower(), []).append((campo, prioridad, patron))
+                else:
+                    self._sin_ancla.setdefault(campo, []).append((prioridad, patron))
+        
+        # En una posición la alternativa más larga tapa a las que son prefijo suyo
+        # ("importe total:" y "importe"), así que cada ancla hereda los patrones de sus prefijos
+        orden_campos = {campo: i for i, campo in enumerate(self.patrones)}
+        self._por_ancla = {}
+        for ancla in por_ancla:
+            candidatos = [c for prefijo, lista in por_ancla.items() if ancla.startswith(prefijo) for c in lista]
+            candidatos.sort(key=lambda c: (orden_campos[c[0]], c[1]))
+            self._por_ancla[ancla] = candidatos
+        
+        self._escaner = self._escaner_insensible = None
+        if por_ancla:
+            anclas = sorted(por_ancla, key=len, reverse=True)
+            alternativa = "|".join(re.escape(ancla) for ancla in anclas)
+            iniciales = "".join(sorted({re.escape(ancla[0]) for ancla in anclas}))
+            expresion = f"(?=[{iniciales}])(?=({alternativa}))"
+            self._escaner = re.compile(expresion)
+            self._escaner_insensible = re.compile(expresion, re.IGNORECASE)
+    
+    def prioridades(self, texto, presupuesto_ms=None):
+        """Devuelve {campo: (índice del patrón ganador, posición)} de los campos encontrados"""
+        if presupuesto_ms is None:
+            presupuesto_ms = PRESUPUESTO_PATRON_MS
+        presupuesto = presupuesto_ms / 1000
+        consumido = {}  # (campo, prioridad) -> segundos
+        agotados = set()
+        mejores = {}
+        
+        for campo, patrones in self._sin_ancla.items():
+            for prioridad, patron in patrones:
+                inicio = time.perf_counter()
+                match = patron.search(texto)
+                consumido[(campo, prioridad)] = time.perf_counter() - inicio
+                if match:
+                    mejores[campo] = (prioridad, match.start())
+                    break
+        
+        if self._escaner is None:
+            return mejores
+        
+        # Buscar las anclas sobre el texto en minúsculas es mucho más rápido que con IGNORECASE;
+        # sólo vale si cada carácter se convierte en uno solo y no aparecen las letras que
+        # IGNORECASE iguala a "i" y "s" pero lower() no
+        texto_lower = texto.lower()
+        if len(texto_lower) == len(texto) and 'ı' not in texto and 'ſ' not in texto:
+            escaneo = self._escaner.finditer(texto_lower)
+        else:
+            escaneo = self._escaner_insensible.finditer(texto)
+        
+        pendientes = len(self.patrones) - sum(1 for prioridad, _ in mejores.values() if prioridad == 0)
+        for m in escaneo:
+            posicion = m.start()
+            for campo, prioridad, patron in self._por_ancla[m.group(1).lower()]:
+                mejor = mejores.get(campo)
+                if mejor is not None and prioridad >= mejor[0]:
+                    continue
+                clave = (campo, prioridad)
+                if clave in agotados:
+                    continue
+                
+                inicio = time.perf_counter()
+                match = patron.match(texto, posicion)
+                consumido[clave] = consumido.get(clave, 0.0) + time.perf_counter() - inicio
+                if consumido[clave] > presupuesto:
+                    agotados.add(clave)
+                
+                if match:
+                    mejores[campo] = (prioridad, posicion)
+                    if prioridad == 0:
+                        pendientes -= 1
+            # Si todos los campos ya tienen su primer patrón, nada posterior puede mejorarlos
+            if pendientes == 0:
+                break
+        
+        if agotados:
+            # Depende de la carga de la máquina: se informa con el resultado para no guardarlo en la caché
+            omitidos = [f"{campo} #{prioridad + 1}" for campo, prioridad in sorted(agotados)]
+            logger.warning("Patrones omitidos por exceder %s ms en este documento: %s", presupuesto_ms, ", ".join(omitidos))
+            if getattr(_estado_documento, 'patrones_omitidos', None) is not None:
+                _estado_documento.patrones_omitidos.extend(omitidos)
+        
+        return mejores
+    
+    def buscar(self, texto):
+        """Devuelve {campo: match o None} recorriendo el texto una sola vez"""
+        mejores = self.prioridades(texto)
+        resultado = {}
+        for campo, patrones in self.patrones.items():
+            if campo in mejores:
+                prioridad, posicion = mejores[campo]
+                resultado[campo] = patrones[prioridad].match(texto, posicion)
+            else:
+                resultado[campo] = None
+        return resultado
+
+
+class RegistroPatronesCampos:
+    """
+    Patrones de expresión regular por campo, cargados desde un archivo JSON y compilados una sola vez.
+    Si el archivo cambia en disco se vuelve a cargar en la siguiente consulta, así se pueden
+    agregar proveedores sin tocar el código. Si no se puede leer o no es válido se sigue con
+    los patrones ya compilados y se avisa una sola vez, hasta que el archivo vuelva a cambiar.
+    """
+    ARCHIVO_NO_DISPONIBLE = object()  # mtime registrado mientras el archivo no existe o no se puede leer
+    
+    def __init__(self, ruta_archivo=RUTA_PATRONES_CAMPOS):
+        self.ruta_archivo = ruta_archivo
+        self.conjuntos = {}
+        self.firma = None
+        self._mtime = None
+        self._cargar()
+    
+    def _cargar(self):
+        mtime = os.path.getmtime(self.ruta_archivo)
+        with open(self.ruta_archivo, 'rb') as f:
+            contenido = f.read()
+        
+        definicion = json.loads(contenido.decode('utf-8'))
+        conjuntos = {nombre: ConjuntoPatrones(campos) for nombre, campos in definicion.items()}
+        
+        # Reemplazar todo junto para que ninguna consulta vea una carga a medias
+        self.conjuntos = conjuntos
+        self.firma = hashlib.sha256(contenido).hexdigest()
+        self._mtime = mtime
+    
+    def _recargar_si_cambio(self):
+        try:
+            mtime = os.path.getmtime(self.ruta_archivo)
+        except OSError as e:
+            mtime = self.ARCHIVO_NO_DISPONIBLE
+            error = e
+        if mtime == self._mtime:
+            return
+        
+        # El estado del archivo cambió: se registra antes de cargar, así una falla se avisa una sola vez
+        # (con logger: esto también corre en los procesos del lote, sin interfaz)
+        self._mtime = mtime
+        if mtime is self.ARCHIVO_NO_DISPONIBLE:
+            logger.warning("No se pudieron recargar los patrones de campos: %s", error)
+            return
+        try:
+            self._cargar()
+        except (OSError, ValueError, re.error) as e:
+            # Seguir con los patrones ya compilados si el archivo nuevo no es válido
+            logger.warning("No se pudieron recargar los patrones de campos: %s", e)
+    
+    def firma_actual(self):
+        """Hash del archivo de patrones vigente (forma parte de la clave de la caché de resultados)"""
+        self._recargar_si_cambio()
+        return self.firma
+    
+    def conjunto(self, nombre):
+        """Devuelve el ConjuntoPatrones pedido"""
+        self._recargar_si_cambio()
+        return self.conjuntos[nombre]
+
+
+@st.cache_resource(show_spinner=False)
+def cargar_registro_patrones(ruta_archivo=RUTA_PATRONES_CAMPOS):
+    """Registro compilado una sola vez por proceso del servidor, compartido entre sesiones y reejecuciones"""
+    return RegistroPatronesCampos(ruta_archivo)
+
+
+registro_patrones = cargar_registro_patrones()
+
+
+def identificar_tipo_factura(texto, texto_upper=None):
     """
     Identifica el tipo de factura para aplicar patrones específicos.
     Devuelve el tipo de factura como string.
     """
-    if ("VIAJES" in texto.upper() or "TURISMO" in texto.upper() or 
-        "AGENCIA" in texto.upper() or "PASAJES" in texto.upper() or
-        "Srvs de transporte exento" in texto or 
+    if texto_upper is None:
+        texto_upper = texto.upper()
+
+    if ("VIAJES" in texto_upper or "TURISMO" in texto_upper or
+        "AGENCIA" in texto_upper or "PASAJES" in texto_upper or
+        "Srvs de transporte exento" in texto or
         "FACTURA EMITIDA AL CAMBIO" in texto):
         return "VIAJES"
-    
+
     # Comprobación adicional para FCE_A (Factura Electrónica A)
-    if "FCE_A" in texto.upper() or "FCE_B" in texto.upper() or "FACTURA ELECTRONICA" in texto.upper():
+    if "FCE_A" in texto_upper or "FCE_B" in texto_upper or "FACTURA ELECTRONICA" in texto_upper:
         return "ELECTRONICA_AFIP"
-    
-    if "AFIP" in texto and ("FACTURA ELECTRÓNICA" in texto.upper() or "FACTURA ELECTRONICA" in texto.upper()):
+
+    if "AFIP" in texto and ("FACTURA ELECTRÓNICA" in texto_upper or "FACTURA ELECTRONICA" in texto_upper):
         return "ELECTRONICA_AFIP"
-    
+
     # Facturas B genéricas
-    if "FACTURA B" in texto.upper() or "CÓD. 006" in texto or "COD. 006" in texto:
+    if "FACTURA B" in texto_upper or "CÓD. 006" in texto or "COD. 006" in texto:
         return "TIPO_B"
-    
+
     # Facturas A genéricas
-    if "FACTURA A" in texto.upper() or "CÓD. 001" in texto or "COD. 001" in texto:
+    if "FACTURA A" in texto_upper or "CÓD. 001" in texto or "COD. 001" in texto:
         return "TIPO_A"
     
     # Por defecto
     return "GENERICA"
 
 # Función para detectar la moneda de una factura (MEJORADA)
+# Reglas de detección de moneda en orden de prioridad: (expresión, anclas, moneda).
+# Se evalúan con IGNORECASE; las que distinguen mayúsculas van dentro de (?-i:...).
+# Las reglas sin moneda sólo marcan que el "$" es de dólares y no de pesos.
+REGLAS_MONEDA = [
+    # Prioridad 1: frases explícitas sobre la moneda
+    (r'emitida\s+en\s+USD', ['emitida'], 'USD'),
+    (r'pagadera\s+en\s+USD', ['pagadera'], 'USD'),
+    (r'cancelada\s+en\s+(?:USD|dólares|dolares)', ['cancelada'], 'USD'),
+    (r'factura\s+(?:en|de)\s+USD', ['factura'], 'USD'),
+    (r'emitida\s+en\s+EUR', ['emitida'], 'EUR'),
+    (r'pagadera\s+en\s+EUR', ['pagadera'], 'EUR'),
+    (r'cancelada\s+en\s+(?:EUR|euros)', ['cancelada'], 'EUR'),
+    (r'factura\s+(?:en|de)\s+EUR', ['factura'], 'EUR'),
+    # Prioridad 2: símbolos de moneda
+    (r'(?-i:(?<!\S)U\$S(?!\S))', ['u$s'], 'USD'),
+    (r'(?-i:(?<!\S)US\$(?!\S))', ['us$'], 'USD'),
+    (r'\$\s*USD', ['$'], 'USD'),
+    (r'TOTAL\s+USD', ['total'], 'USD'),
+    (r'(?-i:USD\s*(?:\d|\.|\,))', ['usd'], 'USD'),
+    (r'€', ['€'], 'EUR'),
+    (r'(?-i:EUR\s*(?:\d|\.|\,))', ['eur'], 'EUR'),
+    (r'TOTAL\s+EUR', ['total'], 'EUR'),
+    # Prioridad 3: "TOTAL USD:" con un valor
+    (r'TOTAL\s+USD\s*[:=]?\s*[\d.,]+', ['total'], 'USD'),
+    (r'TOTAL\s+EUR\s*[:=]?\s*[\d.,]+', ['total'], 'EUR'),
+    # Prioridad 4: "$" a secas es ARS, salvo que aparezca como dólar
+    (r'US\$|U\$S|\$\s*US', ['us$', 'u$s', '$'], None),
+    (r'\$', ['$'], 'ARS'),
+]
+
+# Todas las reglas se resuelven juntas en una pasada: gana la de mayor prioridad que aparezca
+_CONJUNTO_MONEDA = ConjuntoPatrones({
+    'Moneda': [{'patron': patron, 'anclas': anclas} for patron, anclas, _ in REGLAS_MONEDA]
+})
+
+
 def detectar_moneda(texto):
     """
     Detecta la moneda utilizada en la factura.
     """
-    # Prioridad 1: Buscar frases explícitas sobre la moneda
-    if re.search(r'emitida\s+en\s+USD', texto, re.IGNORECASE) or \
-       re.search(r'pagadera\s+en\s+USD', texto, re.IGNORECASE) or \
-       re.search(r'cancelada\s+en\s+(?:USD|dólares|dolares)', texto, re.IGNORECASE) or \
-       re.search(r'factura\s+(?:en|de)\s+USD', texto, re.IGNORECASE) or \
-       ("cancelada en dicha moneda" in texto and "USD" in texto):
-        return "USD"
-    
-    if re.search(r'emitida\s+en\s+EUR', texto, re.IGNORECASE) or \
-       re.search(r'pagadera\s+en\s+EUR', texto, re.IGNORECASE) or \
-       re.search(r'cancelada\s+en\s+(?:EUR|euros)', texto, re.IGNORECASE) or \
-       re.search(r'factura\s+(?:en|de)\s+EUR', texto, re.IGNORECASE):
-        return "EUR"
-        
-    # Prioridad 2: Buscar símbolos de moneda
-    if re.search(r'(?:^|\s)U\$S(?:\s|$)', texto) or \
-       re.search(r'(?:^|\s)US\$(?:\s|$)', texto) or \
-       re.search(r'\$(?:\s*)USD', texto, re.IGNORECASE) or \
-       re.search(r'TOTAL\s+USD', texto, re.IGNORECASE) or \
-       re.search(r'USD\s*(?:\d|\.|\,)', texto):
+    # Prioridad 1: "cancelada en dicha moneda" junto con USD
+    if "cancelada en dicha moneda" in texto and "USD" in texto:
         return "USD"
-        
-    if re.search(r'€', texto) or \
-       re.search(r'EUR(?:\s*)(?:\d|\.|\,)', texto) or \
-       re.search(r'TOTAL\s+EUR', texto, re.IGNORECASE):
-        return "EUR"
-    
-    # Prioridad 3: Si hay "TOTAL USD:" con un valor
-    if re.search(r'TOTAL\s+USD\s*[:=]?\s*[\d.,]+', texto, re.IGNORECASE):
-        return "USD"
-        
-    if re.search(r'TOTAL\s+EUR\s*[:=]?\s*[\d.,]+', texto, re.IGNORECASE):
-        return "EUR"
     
-    # Prioridad 4: Detección básica de moneda por defecto
-    if "$" in texto and not re.search(r'US\$|U\$S|\$\s*US', texto, re.IGNORECASE):
-        # Si hay $ pero no parece ser USD, probablemente sea ARS
-        return "ARS"
-    
-    return "Desconocida"
+    mejor = _CONJUNTO_MONEDA.prioridades(texto).get('Moneda')
+    if mejor is None or REGLAS_MONEDA[mejor[0]][2] is None:
+        return "Desconocida"
+    return REGLAS_MONEDA[mejor[0]][2]
 
 # Función para convertir texto a número de forma segura
 def parse_number(match):
@@ -206,111 +1209,58 @@ def parse_number(match):
         print(f"Error al procesar número '{match.group(1) if match else 'None'}': {str(e)}")
         return 0.0
 
-def detectar_bienes_no_computables(texto, total, gravado, iva, exento):
-    """
-    Función general para detectar conceptos no gravados en cualquier factura.
-    """
-    # Lista de frases que indican conceptos no gravados
-    frases_no_gravado = [
-        "Bienes y srvs. no computables",
-        "no computables para la det. del Iva",
-        "Conceptos no gravados",
-        "No gravado",
-        "Operaciones no gravadas",
-        "No suj. a IVA",
-        "No alcanzado"
-    ]
-    
-    # Verificar si alguna de las frases está presente
-    frase_encontrada = None
-    for frase in frases_no_gravado:
-        if frase.lower() in texto.lower():
-            frase_encontrada = frase
-            break
-    
-    # Si encontramos alguna frase indicativa, buscar el valor
-    if frase_encontrada:
-        # Construir patrones de búsqueda para esta frase específica
+# Frases que indican conceptos no gravados, en orden de prioridad
+FRASES_NO_GRAVADO = [
+    "Bienes y srvs. no computables",
+    "no computables para la det. del Iva",
+    "Conceptos no gravados",
+    "No gravado",
+    "Operaciones no gravadas",
+    "No suj. a IVA",
+    "No alcanzado"
+]
+
+# Frase de mayor prioridad presente en el texto, en una sola pasada
+_CONJUNTO_FRASES_NO_GRAVADO = ConjuntoPatrones({
+    'Frase': [{'patron': re.escape(frase), 'anclas': [frase]} for frase in FRASES_NO_GRAVADO]
+})
+
+# Patrones de valor para cada frase, compilados una sola vez
+_PATRONES_VALOR_NO_GRAVADO = {
+    frase: [re.compile(patron, re.IGNORECASE | re.DOTALL) for patron in (
         # Patrón 1: La frase seguida de un valor numérico
-        patron1 = rf'{re.escape(frase_encontrada)}[^:]*:?\s*[$\s]*(\d[\d.,]+)'
+        rf'{re.escape(frase)}[^:]{{0,{VENTANA_BUSQUEDA}}}:?[$\s]*(\d[\d.,]+)',
         # Patrón 2: La frase en una tabla seguida de valor
-        patron2 = rf'{re.escape(frase_encontrada)}.*?(\d[\d.,]+)'
+        rf'{re.escape(frase)}.{{0,{VENTANA_BUSQUEDA}}}?(\d[\d.,]+)',
         # Patrón 3: Búsqueda cerca de la frase
-        patron3 = rf'{re.escape(frase_encontrada)}[^$\d]*[$\s]*(\d[\d.,]+)'
-        
-        # Intentar los patrones en orden
-        for patron in [patron1, patron2, patron3]:
-            match = re.search(patron, texto, re.IGNORECASE | re.DOTALL)
-            if match:
-                try:
-                    # Limpiar y convertir el valor
-                    valor_str = match.group(1).strip()
-                    # Manejar diferentes formatos numéricos
-                    if ',' in valor_str and '.' in valor_str:
-                        if valor_str.rindex('.') > valor_str.rindex(','):
-                            valor_str = valor_str.replace(',', '')
-                        else:
-                            valor_str = valor_str.replace('.', '').replace(',', '.')
-                    elif ',' in valor_str:
-                        valor_str = valor_str.replace(',', '.')
-                    
-                    valor = float(valor_str)
-                    return valor
-                except:
-                    pass
-        
-        # Si no se encontró un valor específico pero tenemos la frase y el total
-        if total > 0:
-            # Calcular suma de componentes conocidos
-            suma_componentes = gravado + iva + exento
-            
-            # Si hay una diferencia significativa entre el total y los componentes conocidos
-            if abs(total - suma_componentes) > 1.0 and (total - suma_componentes) > 0:
-                return total - suma_componentes
-    
-    # Si no se encontró ninguna frase específica pero hay diferencia significativa
-    if total > 0 and (gravado > 0 or iva > 0 or exento > 0):
-        suma_componentes = gravado + iva + exento
-        
-        # Si hay una diferencia mayor al 15% del total
-        if (total - suma_componentes) / total > 0.15:
-            return total - suma_componentes
-    
-    return 0.0
+        rf'{re.escape(frase)}[^$\d]{{0,{VENTANA_BUSQUEDA}}}[$\s]*(\d[\d.,]+)',
+    )]
+    for frase in FRASES_NO_GRAVADO
+}
+
+
+def detectar_bienes_no_computables(texto, total, gravado, iva, exento, indice=None):
     """
     Función general para detectar conceptos no gravados en cualquier factura.
     """
-    # Lista de frases que indican conceptos no gravados
-    frases_no_gravado = [
-        "Bienes y srvs. no computables",
-        "no computables para la det. del Iva",
-        "Conceptos no gravados",
-        "No gravado",
-        "Operaciones no gravadas",
-        "No suj. a IVA",
-        "No alcanzado"
-    ]
-    
-    # Verificar si alguna de las frases está presente
+    # Buscar la frase indicativa de mayor prioridad
     frase_encontrada = None
-    for frase in frases_no_gravado:
-        if frase.lower() in texto.lower():
-            frase_encontrada = frase
-            break
+    mejor = _CONJUNTO_FRASES_NO_GRAVADO.prioridades(texto).get('Frase')
+    if mejor is not None:
+        frase_encontrada = FRASES_NO_GRAVADO[mejor[0]]
     
     # Si encontramos alguna frase indicativa, buscar el valor
     if frase_encontrada:
-        # Construir patrones de búsqueda para esta frase específica
-        # Patrón 1: La frase seguida de un valor numérico
-        patron1 = rf'{re.escape(frase_encontrada)}[^:]*:?\s*[$\s]*(\d[\d.,]+)'
-        # Patrón 2: La frase en una tabla seguida de valor
-        patron2 = rf'{re.escape(frase_encontrada)}.*?(\d[\d.,]+)'
-        # Patrón 3: Búsqueda cerca de la frase
-        patron3 = rf'{re.escape(frase_encontrada)}[^$\d]*[$\s]*(\d[\d.,]+)'
+        # Primero en el índice: la frase como parte de una etiqueta "...: valor"
+        if indice is None:
+            indice = IndiceEtiquetas(texto)
+        valor = indice.importe_etiqueta_con(frase_encontrada)
+        if valor:
+            return valor
         
         # Intentar los patrones en orden
-        for patron in [patron1, patron2, patron3]:
-            match = re.search(patron, texto, re.IGNORECASE | re.DOTALL)
+        for patron in _PATRONES_VALOR_NO_GRAVADO[frase_encontrada]:
+            match = patron.search(texto)
             if match:
                 try:
                     # Limpiar y convertir el valor
@@ -347,66 +1297,26 @@ def detectar_bienes_no_computables(texto, total, gravado, iva, exento):
             return total - suma_componentes
     
     return 0.0
-    """
-    Busca específicamente "Bienes y srvs. no computables" y extrae su valor.
-    Si no lo encuentra directamente, intenta calcularlo por diferencia.
-    """
-    # Búsqueda con patrones más flexibles
-    patrones = [
-        r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*[\$\s]*([\d.,]+)',
-        r'Bienes\s+y\s+srvs\.\s+no\s+computables[^0-9]*(\d[\d.,]+)',
-        r'Srvs\s+(?:de\s+)?transporte\s+exento\s+s\/ley[^:]*:?\s*[\$\s]*([\d.,]+)',
-        r'no\s+computables\s+para\s+la\s+det\.\s+del\s+Iva:?\s*[\$\s]*([\d.,]+)'
-    ]
-    
-    for patron in patrones:
-        match = re.search(patron, texto, re.IGNORECASE | re.DOTALL)
-        if match:
-            try:
-                valor_str = match.group(1).replace('.', '').replace(',', '.')
-                return float(valor_str)
-            except:
-                pass
-    
-    # Si no encuentra directamente, intentar extraer de tabla
-    tabla_match = re.search(r'Bienes y srvs. no computables.*?(\d[\d.,]+)', texto, re.IGNORECASE | re.DOTALL)
-    if tabla_match:
-        try:
-            valor_str = tabla_match.group(1).replace('.', '').replace(',', '.')
-            return float(valor_str)
-        except:
-            pass
-    
-    # Si tiene la frase pero no encontró el valor, calcular por diferencia
-    if "Bienes y srvs. no computables" in texto and total > 0:
-        suma_componentes = gravado + iva + exento
-        if abs(total - suma_componentes) > 1.0:  # Si hay diferencia significativa
-            return total - suma_componentes
-    
-    # Última verificación: si hay mucha diferencia entre total y componentes
-    if total > 0 and (gravado > 0 or iva > 0 or exento > 0):
-        suma_componentes = gravado + iva + exento
-        # Si hay diferencia mayor al 15% del total
-        if (total - suma_componentes) / total > 0.15:
-            return total - suma_componentes
-    
-    return 0.0
+
 # Función específica para extraer datos de facturas de agencias de viajes
-def extraer_datos_factura_viajes(texto):
+def extraer_datos_factura_viajes(texto, indice=None):
     """
     Extrae datos específicos de facturas de agencias de viajes/turismo.
     """
+    if indice is None:
+        indice = IndiceEtiquetas(texto)
+    
     # Caso específico para Grupo On Line
     if "GRUPO ON LINE" in texto.upper():
         # Buscar específicamente el valor en la parte inferior de la factura
-        total_usd_match = re.search(r'TOTAL\s+USD:\s*([\d.,]+)', texto, re.IGNORECASE)
+        total_usd_match = indice.buscar('TOTAL USD', ignorar_mayusculas=True)
         
         # Buscar valor de servicios de transporte (aún más específico)
-        transporte_match = re.search(r'Srvs\s+de\s+transporte\s+exento\s+s/ley\s+23871:\s*([\d.,]+)', texto)
+        transporte_match = indice.buscar('Srvs de transporte exento s/ley 23871')
         
         # Extraer números de factura y fecha
-        nro_factura_match = re.search(r'Nro:\s*(\d{4}\s*-\s*\d{5,})', texto)
-        fecha_match = re.search(r'Fecha de Emisión:\s*(\d{2}/\d{2}/\d{4})', texto)
+        nro_factura_match = indice.buscar('Nro', r'\s*(\d{4}\s*-\s*\d{5,})')
+        fecha_match = indice.buscar('Fecha de Emisión', r'\s*(\d{2}/\d{2}/\d{4})')
         
         # Valor de total directamente de la parte inferior
         total_valor = parse_number(total_usd_match) if total_usd_match else 0.0
@@ -472,43 +1382,36 @@ def extraer_datos_factura_viajes(texto):
             fecha = match.group(1).strip()
             break
     
-    # Buscar el total USD directamente
-    total_patterns = [
-        r'TOTAL\s+USD:\s*([\d.,]+)',
-        r'TOTAL\s+FACTURA\s+USD\s*:\s*([\d.,]+)',
-        r'TOTAL(?:\s+GENERAL)?:\s*(?:USD)?\s*([\d.,]+)'
+    # Buscar el total USD directamente (etiquetas en orden de prioridad)
+    # (etiquetas, patrón del valor, admite espacio antes del ':')
+    total_etiquetas = [
+        ('TOTAL USD', IndiceEtiquetas.PATRON_IMPORTE, False),
+        ('TOTAL FACTURA USD', IndiceEtiquetas.PATRON_IMPORTE, True),
+        (('TOTAL', 'TOTAL GENERAL'), r'\s*(?:USD)?\s*([\d.,]+)', False)
     ]
     
     total = 0.0
-    for pattern in total_patterns:
-        match = re.search(pattern, texto, re.IGNORECASE)
+    for etiquetas, patron_valor, espacio_antes in total_etiquetas:
+        match = indice.buscar(etiquetas, patron_valor, ignorar_mayusculas=True, espacio_antes=espacio_antes)
         if match:
             total = parse_number(match)
             break
     
     # Buscar servicios de transporte exento y otros componentes
-    transporte_exento_match = re.search(r'Srvs de transporte exento s/ley 23871:\s*([\d.,]+)', texto)
-    transporte_exento = parse_number(transporte_exento_match) if transporte_exento_match else 0.0
+    transporte_exento = indice.importe('Srvs de transporte exento s/ley 23871')
     
     # Buscar gravado 21% y 10.5%
-    gravado_21_match = re.search(r'Gravado 21%:\s*([\d.,]+)', texto)
-    gravado_21 = parse_number(gravado_21_match) if gravado_21_match else 0.0
-    
-    gravado_10_5_match = re.search(r'Gravado 10\.5%:\s*([\d.,]+)', texto)
-    gravado_10_5 = parse_number(gravado_10_5_match) if gravado_10_5_match else 0.0
+    gravado_21 = indice.importe('Gravado 21%')
+    gravado_10_5 = indice.importe('Gravado 10.5%')
     
     # Buscar IVA 21% y 10.5%
-    iva_21_match = re.search(r'Iva 21%:\s*([\d.,]+)', texto)
-    iva_21 = parse_number(iva_21_match) if iva_21_match else 0.0
-    
-    iva_10_5_match = re.search(r'Iva 10\.5%:\s*([\d.,]+)', texto)
-    iva_10_5 = parse_number(iva_10_5_match) if iva_10_5_match else 0.0
+    iva_21 = indice.importe('Iva 21%')
+    iva_10_5 = indice.importe('Iva 10.5%')
     
     # Si no encontramos total pero tenemos otros valores
     if total == 0:
         # Intentar extraer el total de una línea que dice TOTAL USD
-        lines = texto.split('\n')
-        for line in lines:
+        for line in indice.lineas:
             if "TOTAL USD" in line.upper():
                 numbers = re.findall(r'[\d.,]+', line)
                 if numbers:
@@ -550,724 +1453,432 @@ def extraer_datos_factura_viajes(texto):
     }
 
 
-def extraer_con_tesseract_ocr(archivo_pdf):
+def texto_pagina_utilizable(texto):
     """
-    Extrae datos de facturas usando Tesseract OCR (ALTERNATIVA GRATUITA a OpenAI).
+    Indica si la capa de texto de una página sirve tal cual.
+    Las páginas vacías (escaneos) o con texto basura (fuentes sin mapa
+    de caracteres, sellos) deben pasar por OCR.
     """
-    try:
-        # Convertir PDF a imágenes
-        with tempfile.NamedTemporaryFile(suffix='.pdf') as temp_pdf:
-            temp_pdf.write(archivo_pdf.read())
-            temp_pdf.flush()
-            
-            # Reiniciar el puntero del archivo para usos futuros
-            archivo_pdf.seek(0)
-            
-            # Convertir PDF a imágenes
-            images = convert_from_bytes(archivo_pdf.read())
-        
-        # Procesar cada página con OCR
-        texto_completo = ""
-        for img in images:
-            # Preprocesar la imagen para mejorar el OCR
-            img_np = np.array(img)
-            img_gray = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
-            img_thresh = cv2.threshold(img_gray, 150, 255, cv2.THRESH_BINARY)[1]
-            
-            # Aplicar OCR
-            texto_pagina = pytesseract.image_to_string(img_thresh, lang='spa')
-            texto_completo += texto_pagina + "\n\n"
-        
-        # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto_completo)
-        
-        # Si es factura de viajes/turismo, usar extracción especializada
-        if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto_completo)
-            datos_viajes['Nombre_Archivo'] = archivo_pdf.name
-            datos_viajes['Metodo'] = 'Tesseract-OCR-Viajes'
-            return datos_viajes
+    caracteres = [c for c in (texto or "") if not c.isspace()]
+    if len(caracteres) < MIN_CARACTERES_CAPA_TEXTO:
+        return False
+    
+    alfanumericos = sum(1 for c in caracteres if c.isalnum())
+    return alfanumericos / len(caracteres) >= MIN_PROPORCION_ALFANUMERICA
+
+
+# Motores de OCR intercambiables detrás de extraer_con_tesseract_ocr
+class MotorOCR:
+    """Interfaz de los motores de OCR: reciben una imagen numpy y devuelven el texto reconocido"""
+    nombre = None
+    
+    def __init__(self, idioma=OCR_IDIOMA):
+        self.idioma = idioma
+    
+    def reconocer(self, imagen):
+        raise NotImplementedError
+
+
+class MotorOCRSubproceso(MotorOCR):
+    """Motor por defecto: pytesseract lanza un proceso de tesseract (y recarga el idioma) por imagen"""
+    nombre = 'subproceso'
+    
+    def reconocer(self, imagen):
+        return pytesseract.image_to_string(imagen, lang=self.idioma)
+
+
+class MotorOCRTesserocr(MotorOCR):
+    """
+    Motor en proceso sobre la API C de Tesseract (tesserocr).
+    Mantiene instancias ya cargadas con el idioma y las reutiliza entre páginas;
+    cada hilo toma una libre del pool, así los hilos de OCR no comparten instancia.
+    """
+    nombre = 'tesserocr'
+    
+    def __init__(self, idioma=OCR_IDIOMA):
+        super().__init__(idioma)
+        if tesserocr is None:
+            raise ImportError(ERROR_TESSEROCR)
+        self._libres = queue.LifoQueue()
+        # Crear la primera instancia ya: si falta el idioma, falla acá y no en medio de un lote
+        self._libres.put(tesserocr.PyTessBaseAPI(lang=idioma))
+    
+    def reconocer(self, imagen):
+        try:
+            api = self._libres.get_nowait()
+        except queue.Empty:
+            api = tesserocr.PyTessBaseAPI(lang=self.idioma)
         
-        # Para otros tipos de facturas, continuar con el proceso normal
-        # Detectar moneda
-        moneda = detectar_moneda(texto_completo)
+        try:
+            # El buffer de numpy se pasa directo, sin PNG temporal
+            imagen = np.ascontiguousarray(imagen)
+            alto, ancho = imagen.shape[:2]
+            bytes_por_pixel = 1 if imagen.ndim == 2 else imagen.shape[2]
+            api.SetImageBytes(imagen.tobytes(), ancho, alto, bytes_por_pixel, ancho * bytes_por_pixel)
+            return api.GetUTF8Text()
+        finally:
+            self._libres.put(api)
+
+
+def cargar_tesserocr():
+    """
+    Reintenta importar tesserocr si antes falló sólo por no estar en el hilo principal
+    (por ejemplo, en un proceso del lote creado desde la sesión de streamlit).
+    """
+    global tesserocr, ERROR_TESSEROCR, TESSEROCR_PENDIENTE
+    if TESSEROCR_PENDIENTE and threading.current_thread() is threading.main_thread():
+        TESSEROCR_PENDIENTE = False
+        try:
+            tesserocr = importlib.import_module('tesserocr')
+            ERROR_TESSEROCR = None
+        except (ImportError, ValueError) as e:
+            ERROR_TESSEROCR = f"No se pudo cargar tesserocr ({str(e)})"
+    return tesserocr is not None
+
+
+@st.cache_resource(show_spinner=False)
+def crear_motor_ocr(motor, idioma):
+    """
+    Motor de OCR pedido, con pytesseract como respaldo. Se crea una sola vez por
+    proceso del servidor y combinación de motor e idioma, y lo comparten todas las sesiones.
+    """
+    if motor in ('auto', 'tesserocr'):
+        try:
+            return MotorOCRTesserocr(idioma)
+        except Exception as e:
+            if motor == 'tesserocr':
+                st.warning(f"No se pudo iniciar tesserocr ({str(e)}). Se usa pytesseract.")
+    return MotorOCRSubproceso(idioma)
+
+
+def obtener_motor_ocr():
+    """Devuelve el motor de OCR configurado"""
+    return crear_motor_ocr(OCR_MOTOR, OCR_IDIOMA)
+
+
+def preprocesar_imagen_ocr(img):
+    """Convierte la página rasterizada a escala de grises binarizada para mejorar el OCR"""
+    img_np = np.array(img)
+    img_gray = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
+    return cv2.threshold(img_gray, 150, 255, cv2.THRESH_BINARY)[1]
+
+
+def detectar_regiones_interes(img_thresh):
+    """
+    Ubica los bloques de encabezado (número y fecha) y de totales (Neto Gravado,
+    IVA, Importe Total) de una página binarizada.
+    Une los caracteres en bloques con una dilatación horizontal, busca sus
+    contornos y devuelve una caja (x0, y0, x1, y1) por zona, de arriba hacia abajo.
+    Devuelve una lista vacía si no encuentra bloques (se usa la página completa).
+    """
+    alto, ancho = img_thresh.shape[:2]
+    
+    # Texto en blanco sobre fondo negro para la morfología
+    invertida = cv2.bitwise_not(img_thresh)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(1, ancho // 40), max(1, alto // 150)))
+    bloques = cv2.dilate(invertida, kernel, iterations=1)
+    contornos = cv2.findContours(bloques, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    
+    limite_encabezado = alto * FRACCION_ENCABEZADO
+    limite_totales = alto * (1 - FRACCION_TOTALES)
+    area_minima = ancho * alto * AREA_MINIMA_BLOQUE
+    
+    zonas = {'encabezado': None, 'totales': None}
+    for contorno in contornos:
+        x, y, w, h = cv2.boundingRect(contorno)
+        if w * h < area_minima:
+            continue
+        
+        centro_y = y + h / 2
+        if centro_y <= limite_encabezado:
+            zona = 'encabezado'
+        elif centro_y >= limite_totales:
+            zona = 'totales'
+        else:
+            continue
         
-        # MODIFICACIÓN: Forzar moneda ARS para facturas argentinas
-        if tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"] and moneda == 'Desconocida':
-            moneda = 'ARS'
-        
-        # Función para convertir texto a número de forma segura (ya definida anteriormente)
-        def parse_number(match):
-            if not match:
-                return 0.0
-            try:
-                # Eliminar puntos de miles y reemplazar coma decimal por punto
-                value_str = match.group(1).replace('.', '').replace(',', '.')
-                return float(value_str)
-            except (ValueError, AttributeError):
-                return 0.0
-        
-        # Detectar tipo de factura para usar patrones específicos
-        is_factura_b = "CÓD. 006" in texto_completo or "FACTURA B" in texto_completo
-        is_factura_a = "CÓD. 001" in texto_completo or "FACTURA A" in texto_completo
-        
-        # Patrones de expresión regular para diferentes campos (optimizados para OCR)
-        # Número de factura
-        nro_factura_patterns = [
-            r'Comp\.\s*Nro:?\s*(\d+)',
-            r'(?:Factura|FACTURA)\s+[Nn](?:[°o]|ro):?\s*([A-Z0-9\-]+)',
-            r'[Nn](?:[°o]|ro)\.?\s*(?:Factura|Comprobante):?\s*([A-Z0-9\-]+)',
-            r'(?:Factura|Comprobante)\s+(?:[Nn](?:[°o]|ro))?[:\s]+([A-Z0-9\-]+)'
-        ]
-        
-        # Fecha
-        fecha_patterns = [
-            r'Fecha de Emisi[óo]n:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
-            r'Fecha:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
-            r'Emitido\s+(?:el)?:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})'
-        ]
-        
-        # NUEVOS patrones para No Gravado
-        no_gravado_patterns = [
-            r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*\$?\s*([\d.,]+)',
-            r'Conceptos\s+no\s+gravados:?\s*\$?\s*([\d.,]+)',
-            r'No\s+gravado:?\s*\$?\s*([\d.,]+)',
-            r'Importe(?:s)?\s+no\s+gravado(?:s)?:?\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+No\s+Gravadas:?\s*\$?\s*([\d.,]+)',
-            r'No\s+suj\.\s+a\s+IVA:?\s*\$?\s*([\d.,]+)',
-            r'No\s+alcanzado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Total
-        total_patterns = [
-            r'Importe Total:.*?(\d[\d.,]+)',
-            r'TOTAL:?\s*\$?\s*([\d.,]+)',
-            r'Total:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:TOTAL|Total):?\s*\$?\s*([\d.,]+)',
-            r'(?<!\w)Total(?!\w).*?(\d[\d.,]+)'
-        ]
-        
-        # Exento
-        exento_patterns = [
-            r'Importe Exento:.*?(\d[\d.,]+)',
-            r'Exento:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:EXENTO|Exento):?\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+Exentas:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Gravado
-        gravado_patterns = [
-            r'Importe Neto Gravado:.*?(\d[\d.,]+)',
-            r'Gravado:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:NETO\s+)?(?:GRAVADO|Gravado):?\s*\$?\s*([\d.,]+)',
-            r'Neto\s+Gravado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # IVA
-        iva_patterns = [
-            r'IVA\s+21%:.*?(\d[\d.,]+)',
-            r'IVA\s+\(?21%\)?:?\s*\$?\s*([\d.,]+)',
-            r'IVA:?\s*\$?\s*([\d.,]+)',
-            r'I\.V\.A\.(?:\s+\d+%)?:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Aplicar todos los patrones y tomar el primer match para cada campo
-        def apply_patterns(patterns, text):
-            for pattern in patterns:
-                match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-                if match:
-                    return match
-            return None
-        
-        # Buscar primero en el texto completo
-        nro_factura_match = apply_patterns(nro_factura_patterns, texto_completo)
-        fecha_match = apply_patterns(fecha_patterns, texto_completo)
-        no_gravado_match = apply_patterns(no_gravado_patterns, texto_completo)  # NUEVO: Buscar No Gravado
-        exento_match = apply_patterns(exento_patterns, texto_completo)
-        gravado_match = apply_patterns(gravado_patterns, texto_completo)
-        iva_match = apply_patterns(iva_patterns, texto_completo)
-        total_match = apply_patterns(total_patterns, texto_completo)
-        
-        # Extraer valores numéricos
-        no_gravado = parse_number(no_gravado_match)  # NUEVO: Extraer valor de No Gravado
-        exento = parse_number(exento_match)
-        gravado = parse_number(gravado_match)
-        iva = parse_number(iva_match)
-        total_extraido = parse_number(total_match)
-        
-        # Si no se encontró el valor de No Gravado específicamente para "Bienes y srvs. no computables"
-        if no_gravado == 0 and "Bienes y srvs. no computables" in texto_completo:
-            # Buscar específicamente para "Bienes y srvs. no computables" con un patrón más flexible
-            bienes_no_comp_match = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*[\$\s]*([\d.,]+)', texto_completo, re.IGNORECASE)
-            if bienes_no_comp_match:
-                no_gravado = parse_number(bienes_no_comp_match)
-            # Si aún no encuentra, buscar cerca de la frase
-            else:
-                # Buscar números cerca de la frase "Bienes y srvs. no computables"
-                contexto = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^$]*(\d[\d.,]+)', texto_completo, re.IGNORECASE)
-                if contexto:
-                    try:
-                        valor_str = re.search(r'(\d[\d.,]+)', contexto.group(1))
-                        if valor_str:
-                            no_gravado = float(valor_str.group(1).replace('.', '').replace(',', '.'))
-                    except:
-                        pass
-        
-        # Si no se encontró el valor exento, intentar buscarlo en tablas
-        if exento == 0:
-            exento_tabla_match = re.search(r'(?:Exento|EXENTO)\s+(\d[\d.,]+)', texto_completo)
-            if exento_tabla_match:
-                exento = parse_number(exento_tabla_match)
-        
-        # Si no se encontró el valor gravado, intentar buscarlo en tablas
-        if gravado == 0:
-            gravado_tabla_match = re.search(r'(?:Gravado|GRAVADO)\s+(\d[\d.,]+)', texto_completo)
-            if gravado_tabla_match:
-                gravado = parse_number(gravado_tabla_match)
-        
-        # Calcular total si no se pudo extraer
-        total_calculado = exento + gravado + iva + no_gravado  # Incluir no_gravado en el cálculo
-        
-        # Comparar total extraído vs calculado y decidir cuál usar
-        if total_extraido > 0:
-            diferencia = abs(total_extraido - total_calculado)
-            if diferencia / (total_extraido + 0.001) > 0.05:  # Diferencia mayor al 5%
-                # Si hay gran diferencia, usar el extraído pero alertar
-                total = total_extraido
-                # Si tenemos total pero los componentes no suman, verificar si hay "Bienes y srvs"
-                if "Bienes y srvs. no computables" in texto_completo and no_gravado == 0:
-                    # Asignar la diferencia a No Gravado
-                    no_gravado = total_extraido - (exento + gravado + iva)
-                    no_gravado = max(0, no_gravado)  # Asegurar que no sea negativo
-                st.warning(f"Diferencia significativa entre total extraído ({total_extraido}) y calculado ({total_calculado})")
-            else:
-                total = total_extraido
+        # Unir todos los bloques de la zona en una sola caja
+        caja = zonas[zona]
+        if caja is None:
+            zonas[zona] = [x, y, x + w, y + h]
         else:
-            total = total_calculado
-        
-        # Si tenemos un total pero los componentes suman cero, buscar componentes específicos
-        if total > 0 and total_calculado == 0:
-            # Si hay "Bienes y srvs. no computables", asignar todo el total a No Gravado
-            if "Bienes y srvs. no computables" in texto_completo:
-                no_gravado = total
-            # Si hay "exento", asignar todo a exento
-            elif "exento" in texto_completo.lower():
-                exento = total
-            # Si hay mención de IVA específico, calcular valores
-            elif "21%" in texto_completo:
-                gravado = total / 1.21
-                iva = gravado * 0.21
-            elif "10.5%" in texto_completo:
-                gravado = total / 1.105
-                iva = gravado * 0.105
-            else:
-                # Si no hay indicación específica, asignar como No Gravado por defecto
-                no_gravado = total
-        
-        # Asegurar que todos los valores sean números positivos
-        no_gravado = max(0, no_gravado)
-        exento = max(0, exento)
-        gravado = max(0, gravado)
-        iva = max(0, iva)
-        total = max(0, total)
-        
-        # Verificación final para Bienes y srvs. no computables
-        if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
-            no_gravado = detectar_bienes_no_computables(texto_completo, total, gravado, iva, exento)
-        
-        return {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
-            'Fecha': fecha_match.group(1) if fecha_match else None,
-            'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
-            'Exento': exento,
-            'Gravado': gravado,
-            'IVA': iva,
-            'Total': total,
-            'Moneda': moneda,
-            'Metodo': 'Tesseract-OCR'
-        }
+            zonas[zona] = [min(caja[0], x), min(caja[1], y), max(caja[2], x + w), max(caja[3], y + h)]
+    
+    regiones = []
+    for caja in (zonas['encabezado'], zonas['totales']):
+        if caja is not None:
+            x0, y0, x1, y1 = caja
+            regiones.append((max(0, x0 - MARGEN_REGION), max(0, y0 - MARGEN_REGION),
+                             min(ancho, x1 + MARGEN_REGION), min(alto, y1 + MARGEN_REGION)))
+    return regiones
+
+
+def paginas_binarizadas(documento, num_pagina):
+    """Imágenes binarizadas de una página (o de todas si es None), rasterizadas una sola vez por documento"""
+    if num_pagina not in documento.paginas_binarizadas:
+        images = convert_from_bytes(documento.contenido, first_page=num_pagina, last_page=num_pagina)
+        # Preprocesar la imagen para mejorar el OCR
+        documento.paginas_binarizadas[num_pagina] = [preprocesar_imagen_ocr(img) for img in images]
+    return documento.paginas_binarizadas[num_pagina]
+
+
+def ocr_pagina(documento, num_pagina, regiones=False):
+    """
+    Rasteriza una página (numerada desde 1, o todas si es None) y le aplica OCR.
+    Con regiones=True sólo se reconocen los bloques de encabezado y totales.
+    """
+    if not regiones and num_pagina in documento.textos_ocr_completos:
+        # Ya se reconoció completa en la pasada por regiones (no se le encontraron bloques)
+        return documento.textos_ocr_completos[num_pagina]
+    motor = obtener_motor_ocr()
+    
+    texto_pagina = ""
+    pagina_completa = True
+    for img_thresh in paginas_binarizadas(documento, num_pagina):
+        recortes = detectar_regiones_interes(img_thresh) if regiones else []
+        if recortes:
+            # Menos píxeles para Tesseract: sólo las zonas con los datos buscados
+            pagina_completa = False
+            for x0, y0, x1, y1 in recortes:
+                texto_pagina += motor.reconocer(img_thresh[y0:y1, x0:x1]) + "\n"
+        else:
+            # Aplicar OCR a la página completa
+            texto_pagina += motor.reconocer(img_thresh)
+    if pagina_completa:
+        documento.textos_ocr_completos[num_pagina] = texto_pagina
+    return texto_pagina
+
+
+def obtener_texto_ocr(documento, regiones=False):
+    """
+    Devuelve el texto del documento y la cantidad de páginas que pasaron por OCR.
+    Sólo se rasterizan las páginas cuya capa de texto está vacía o es basura;
+    el resto usa el texto digital y todo se une respetando el orden de páginas.
+    Las páginas a rasterizar se procesan en paralelo con hasta OCR_HILOS_POR_DOCUMENTO hilos.
+    """
+    if documento.num_paginas == 0:
+        # Sin páginas legibles por pypdf: convertir el PDF completo
+        textos_paginas = [ocr_pagina(documento, None, regiones)]
+        paginas_ocr = [None]
+    else:
+        textos_paginas = list(documento.textos_paginas)
+        paginas_ocr = [num_pagina for num_pagina, texto_capa in enumerate(textos_paginas, 1)
+                       if not texto_pagina_utilizable(texto_capa)]
+        
+        hilos = min(OCR_HILOS_POR_DOCUMENTO, len(paginas_ocr))
+        if hilos > 1:
+            # executor.map conserva el orden de las páginas
+            with ThreadPoolExecutor(max_workers=hilos) as executor:
+                textos_ocr = list(executor.map(lambda num_pagina: ocr_pagina(documento, num_pagina, regiones),
+                                               paginas_ocr))
+        else:
+            textos_ocr = [ocr_pagina(documento, num_pagina, regiones) for num_pagina in paginas_ocr]
         
-    except Exception as e:
-        st.warning(f"Error OCR: {str(e)}")
-        return None
+        for num_pagina, texto_ocr in zip(paginas_ocr, textos_ocr):
+            textos_paginas[num_pagina - 1] = texto_ocr
+    
+    texto_completo = "".join(texto_pagina + "\n\n" for texto_pagina in textos_paginas)
+    return texto_completo, len(paginas_ocr)
+
+
+def extraer_con_tesseract_ocr(documento):
     """
     Extrae datos de facturas usando Tesseract OCR (ALTERNATIVA GRATUITA a OpenAI).
+    Recibe el DocumentoPDF ya leído, sin volver a tocar el archivo subido.
+    Con OCR_POR_REGIONES primero se reconocen sólo el encabezado y los totales;
+    si así faltan campos requeridos se repite el OCR con las páginas completas.
+    Si ninguna página necesitó OCR (PDF digital) el Metodo es 'Capa-Texto': el texto no
+    salió de Tesseract aunque se lea con los patrones de OCR.
     """
     try:
-        # Convertir PDF a imágenes
-        with tempfile.NamedTemporaryFile(suffix='.pdf') as temp_pdf:
-            temp_pdf.write(archivo_pdf.read())
-            temp_pdf.flush()
-            
-            # Reiniciar el puntero del archivo para usos futuros
-            archivo_pdf.seek(0)
-            
-            # Convertir PDF a imágenes
-            images = convert_from_bytes(archivo_pdf.read())
-        
-        # Procesar cada página con OCR
-        texto_completo = ""
-        for img in images:
-            # Preprocesar la imagen para mejorar el OCR
-            img_np = np.array(img)
-            img_gray = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
-            img_thresh = cv2.threshold(img_gray, 150, 255, cv2.THRESH_BINARY)[1]
-            
-            # Aplicar OCR
-            texto_pagina = pytesseract.image_to_string(img_thresh, lang='spa')
-            texto_completo += texto_pagina + "\n\n"
-        
-        # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto_completo)
-        
-        # Si es factura de viajes/turismo, usar extracción especializada
-        if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto_completo)
-            datos_viajes['Nombre_Archivo'] = archivo_pdf.name
-            datos_viajes['Metodo'] = 'Tesseract-OCR-Viajes'
-            return datos_viajes
+        texto_completo, paginas_ocr = obtener_texto_ocr(documento, regiones=OCR_POR_REGIONES)
+        metodo = 'Tesseract-OCR' if paginas_ocr else 'Capa-Texto'
+        datos = analizar_texto_ocr(texto_completo, documento.nombre, metodo)
         
-        # Para otros tipos de facturas, continuar con el proceso normal
-        # Detectar moneda
-        moneda = detectar_moneda(texto_completo)
+        if OCR_POR_REGIONES and paginas_ocr and not datos_completos(datos):
+            # Las páginas ya rasterizadas se reconocen ahora completas, sin volver a convertir el PDF
+            texto_completo, _ = obtener_texto_ocr(documento, regiones=False)
+            datos = analizar_texto_ocr(texto_completo, documento.nombre, metodo)
         
-        # MODIFICACIÓN: Forzar moneda ARS para facturas argentinas
-        if tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"] and moneda == 'Desconocida':
-            moneda = 'ARS'
-        
-        # Función para convertir texto a número de forma segura (ya definida anteriormente)
-        def parse_number(match):
-            if not match:
-                return 0.0
-            try:
-                # Eliminar puntos de miles y reemplazar coma decimal por punto
-                value_str = match.group(1).replace('.', '').replace(',', '.')
-                return float(value_str)
-            except (ValueError, AttributeError):
-                return 0.0
-        
-        # Detectar tipo de factura para usar patrones específicos
-        is_factura_b = "CÓD. 006" in texto_completo or "FACTURA B" in texto_completo
-        is_factura_a = "CÓD. 001" in texto_completo or "FACTURA A" in texto_completo
-        
-        # Patrones de expresión regular para diferentes campos (optimizados para OCR)
-        # Número de factura
-        nro_factura_patterns = [
-            r'Comp\.\s*Nro:?\s*(\d+)',
-            r'(?:Factura|FACTURA)\s+[Nn](?:[°o]|ro):?\s*([A-Z0-9\-]+)',
-            r'[Nn](?:[°o]|ro)\.?\s*(?:Factura|Comprobante):?\s*([A-Z0-9\-]+)',
-            r'(?:Factura|Comprobante)\s+(?:[Nn](?:[°o]|ro))?[:\s]+([A-Z0-9\-]+)'
-        ]
-        
-        # Fecha
-        fecha_patterns = [
-            r'Fecha de Emisi[óo]n:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
-            r'Fecha:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
-            r'Emitido\s+(?:el)?:?\s*(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})'
-        ]
-        
-        # NUEVOS patrones para No Gravado
-        no_gravado_patterns = [
-            r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*\$?\s*([\d.,]+)',
-            r'Conceptos\s+no\s+gravados:?\s*\$?\s*([\d.,]+)',
-            r'No\s+gravado:?\s*\$?\s*([\d.,]+)',
-            r'Importe(?:s)?\s+no\s+gravado(?:s)?:?\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+No\s+Gravadas:?\s*\$?\s*([\d.,]+)',
-            r'No\s+suj\.\s+a\s+IVA:?\s*\$?\s*([\d.,]+)',
-            r'No\s+alcanzado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Total
-        total_patterns = [
-            r'Importe Total:.*?(\d[\d.,]+)',
-            r'TOTAL:?\s*\$?\s*([\d.,]+)',
-            r'Total:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:TOTAL|Total):?\s*\$?\s*([\d.,]+)',
-            r'(?<!\w)Total(?!\w).*?(\d[\d.,]+)'
-        ]
-        
-        # Exento
-        exento_patterns = [
-            r'Importe Exento:.*?(\d[\d.,]+)',
-            r'Exento:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:EXENTO|Exento):?\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+Exentas:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Gravado
-        gravado_patterns = [
-            r'Importe Neto Gravado:.*?(\d[\d.,]+)',
-            r'Gravado:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:NETO\s+)?(?:GRAVADO|Gravado):?\s*\$?\s*([\d.,]+)',
-            r'Neto\s+Gravado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # IVA
-        iva_patterns = [
-            r'IVA\s+21%:.*?(\d[\d.,]+)',
-            r'IVA\s+\(?21%\)?:?\s*\$?\s*([\d.,]+)',
-            r'IVA:?\s*\$?\s*([\d.,]+)',
-            r'I\.V\.A\.(?:\s+\d+%)?:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Aplicar todos los patrones y tomar el primer match para cada campo
-        def apply_patterns(patterns, text):
-            for pattern in patterns:
-                match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-                if match:
-                    return match
-            return None
-        
-        # Buscar primero en el texto completo
-        nro_factura_match = apply_patterns(nro_factura_patterns, texto_completo)
-        fecha_match = apply_patterns(fecha_patterns, texto_completo)
-        no_gravado_match = apply_patterns(no_gravado_patterns, texto_completo)  # NUEVO: Buscar No Gravado
-        exento_match = apply_patterns(exento_patterns, texto_completo)
-        gravado_match = apply_patterns(gravado_patterns, texto_completo)
-        iva_match = apply_patterns(iva_patterns, texto_completo)
-        total_match = apply_patterns(total_patterns, texto_completo)
-        
-        # Extraer valores numéricos
-        no_gravado = parse_number(no_gravado_match)  # NUEVO: Extraer valor de No Gravado
-        exento = parse_number(exento_match)
-        gravado = parse_number(gravado_match)
-        iva = parse_number(iva_match)
-        total_extraido = parse_number(total_match)
-        
-        # Si no se encontró el valor de No Gravado específicamente para "Bienes y srvs. no computables"
-        if no_gravado == 0 and "Bienes y srvs. no computables" in texto_completo:
-            # Buscar específicamente para "Bienes y srvs. no computables" con un patrón más flexible
-            bienes_no_comp_match = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*[\$\s]*([\d.,]+)', texto_completo, re.IGNORECASE)
-            if bienes_no_comp_match:
-                no_gravado = parse_number(bienes_no_comp_match)
-            # Si aún no encuentra, buscar cerca de la frase
-            else:
-                # Buscar números cerca de la frase "Bienes y srvs. no computables"
-                contexto = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^$]*(\d[\d.,]+)', texto_completo, re.IGNORECASE)
-                if contexto:
-                    try:
-                        valor_str = re.search(r'(\d[\d.,]+)', contexto.group(1))
-                        if valor_str:
-                            no_gravado = float(valor_str.group(1).replace('.', '').replace(',', '.'))
-                    except:
-                        pass
-        
-        # Si no se encontró el valor exento, intentar buscarlo en tablas
-        if exento == 0:
-            exento_tabla_match = re.search(r'(?:Exento|EXENTO)\s+(\d[\d.,]+)', texto_completo)
-            if exento_tabla_match:
-                exento = parse_number(exento_tabla_match)
-        
-        # Si no se encontró el valor gravado, intentar buscarlo en tablas
-        if gravado == 0:
-            gravado_tabla_match = re.search(r'(?:Gravado|GRAVADO)\s+(\d[\d.,]+)', texto_completo)
-            if gravado_tabla_match:
-                gravado = parse_number(gravado_tabla_match)
-        
-        # Calcular total si no se pudo extraer
-        total_calculado = exento + gravado + iva + no_gravado  # Incluir no_gravado en el cálculo
-        
-        # Comparar total extraído vs calculado y decidir cuál usar
-        if total_extraido > 0:
-            diferencia = abs(total_extraido - total_calculado)
-            if diferencia / (total_extraido + 0.001) > 0.05:  # Diferencia mayor al 5%
-                # Si hay gran diferencia, usar el extraído pero alertar
-                total = total_extraido
-                # Si tenemos total pero los componentes no suman, verificar si hay "Bienes y srvs"
-                if "Bienes y srvs. no computables" in texto_completo and no_gravado == 0:
-                    # Asignar la diferencia a No Gravado
-                    no_gravado = total_extraido - (exento + gravado + iva)
-                    no_gravado = max(0, no_gravado)  # Asegurar que no sea negativo
-                st.warning(f"Diferencia significativa entre total extraído ({total_extraido}) y calculado ({total_calculado})")
-            else:
-                total = total_extraido
-        else:
-            total = total_calculado
-        
-        # Si tenemos un total pero los componentes suman cero, buscar componentes específicos
-        if total > 0 and total_calculado == 0:
-            # Si hay "Bienes y srvs. no computables", asignar todo el total a No Gravado
-            if "Bienes y srvs. no computables" in texto_completo:
-                no_gravado = total
-            # Si hay "exento", asignar todo a exento
-            elif "exento" in texto_completo.lower():
-                exento = total
-            # Si hay mención de IVA específico, calcular valores
-            elif "21%" in texto_completo:
-                gravado = total / 1.21
-                iva = gravado * 0.21
-            elif "10.5%" in texto_completo:
-                gravado = total / 1.105
-                iva = gravado * 0.105
-            else:
-                # Si no hay indicación específica, asignar como No Gravado por defecto
-                no_gravado = total
-        
-        # Asegurar que todos los valores sean números positivos
-        no_gravado = max(0, no_gravado)
-        exento = max(0, exento)
-        gravado = max(0, gravado)
-        iva = max(0, iva)
-        total = max(0, total)
-        
-        # Verificación final para Bienes y srvs. no computables
-        if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
-            no_gravado = detectar_bienes_no_computables(texto_completo, total, gravado, iva, exento)
-        
-        return {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
-            'Fecha': fecha_match.group(1) if fecha_match else None,
-            'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
-            'Exento': exento,
-            'Gravado': gravado,
-            'IVA': iva,
-            'Total': total,
-            'Moneda': moneda,
-            'Metodo': 'Tesseract-OCR'
-        }
+        return datos
         
     except Exception as e:
         st.warning(f"Error OCR: {str(e)}")
+        registrar_etapa_fallida('OCR', e)
         return None
+    finally:
+        # Las imágenes sólo hacen falta durante el OCR de este documento
+        documento.paginas_binarizadas.clear()
+        documento.textos_ocr_completos.clear()
 
-def extraer_con_regex(archivo_pdf):
+
+def analizar_texto_ocr(texto_completo, nombre_archivo, metodo='Tesseract-OCR'):
     """
-    Extrae datos de facturas usando expresiones regulares avanzadas.
+    Aplica los patrones optimizados para OCR al texto reconocido y arma el resultado.
+    metodo indica de dónde salió el texto ('Tesseract-OCR' o 'Capa-Texto').
     """
-    try:
-        # Leer el PDF
-        reader = pypdf.PdfReader(archivo_pdf)
-        texto = ""
-        for pagina in reader.pages:
-            texto += pagina.extract_text()
-        
-        # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto)
-        
-        # Si es factura de viajes/turismo, usar extracción especializada
-        if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto)
-            datos_viajes['Nombre_Archivo'] = archivo_pdf.name
-            datos_viajes['Metodo'] = 'RegEx-Viajes'
-            return datos_viajes
-            
-        # Detectar moneda
-        moneda = detectar_moneda(texto)
-        
-        # MODIFICACIÓN: Forzar moneda ARS para facturas argentinas
-        if tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"] and moneda == 'Desconocida':
-            moneda = 'ARS'
-        
-        # Función para convertir texto a número de forma segura
-        def parse_number(match):
-            if not match:
-                return 0.0
-            try:
-                # Eliminar puntos de miles y reemplazar coma decimal por punto
-                value_str = match.group(1).replace('.', '').replace(',', '.')
-                return float(value_str)
-            except (ValueError, AttributeError):
-                return 0.0
-        
-        # Detectar tipo de factura para usar patrones específicos
-        is_factura_b = "CÓD. 006" in texto or "FACTURA B" in texto
-        is_factura_a = "CÓD. 001" in texto or "FACTURA A" in texto
-        
-        # Patrones de expresión regular para diferentes campos
-        # Número de factura
-        nro_factura_patterns = [
-            r'Comp\. Nro:\s*(\d+)',
-            r'Factura\s+[Nn][°o]:\s*([A-Z0-9\-]+)',
-            r'N[°o]\s*(?:Factura|Comprobante):\s*([A-Z0-9\-]+)',
-            r'(?:Factura|Comprobante)\s+(?:[Nn][°o])?[:\s]+([A-Z0-9\-]+)'
-        ]
-        
-        # Fecha
-        fecha_patterns = [
-            r'Fecha de Emisión:\s*(\d{2}/\d{2}/\d{4})',
-            r'Fecha:\s*(\d{2}/\d{2}/\d{4})',
-            r'Fecha\s+(?:de\s+)?(?:Emisión|Emision):\s*(\d{2}[-/]\d{2}[-/]\d{4})',
-            r'Emitido\s+(?:el)?:\s*(\d{2}[-/]\d{2}[-/]\d{4})'
-        ]
-        
-        # NUEVOS patrones para No Gravado - AGREGADOS para capturar "Bienes y srvs. no computables"
-        no_gravado_patterns = [
-            r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:\s*\$?\s*([\d.,]+)',
-            r'Conceptos\s+no\s+gravados:\s*\$?\s*([\d.,]+)',
-            r'No\s+gravado:\s*\$?\s*([\d.,]+)',
-            r'Importe(?:s)?\s+no\s+gravado(?:s)?:\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+No\s+Gravadas:\s*\$?\s*([\d.,]+)',
-            r'No\s+suj\.\s+a\s+IVA:\s*\$?\s*([\d.,]+)',
-            r'No\s+alcanzado:\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Exento
-        exento_patterns = [
-            r'Importe Exento:.*?(\d[\d.,]+)',
-            r'Exento:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:EXENTO|Exento):?\s*\$?\s*([\d.,]+)',
-            r'Op.\s+Exentas:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Gravado
-        gravado_patterns = [
-            r'Importe Neto Gravado:.*?(\d[\d.,]+)',
-            r'Gravado:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:NETO\s+)?(?:GRAVADO|Gravado):?\s*\$?\s*([\d.,]+)',
-            r'Neto\s+Gravado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # IVA
-        iva_patterns = [
-            r'IVA 21%:.*?(\d[\d.,]+)',
-            r'IVA:?\s*\$?\s*([\d.,]+)',
-            r'I\.V\.A\.(?:\s+\d+%)?:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Total
-        total_patterns = [
-            r'Importe Total:.*?(\d[\d.,]+)',
-            r'TOTAL:?\s*\$?\s*([\d.,]+)',
-            r'Total:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:TOTAL|Total):?\s*\$?\s*([\d.,]+)',
-            r'(?<!\w)Total(?!\w).*?(\d[\d.,]+)'
-        ]
-        
-        # Aplicar todos los patrones y tomar el primer match para cada campo
-        def apply_patterns(patterns, text):
-            for pattern in patterns:
-                match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-                if match:
-                    return match
-            return None
-        
-        # Buscar los patrones en el texto
-        nro_factura_match = apply_patterns(nro_factura_patterns, texto)
-        fecha_match = apply_patterns(fecha_patterns, texto)
-        no_gravado_match = apply_patterns(no_gravado_patterns, texto)  # NUEVO: Buscar No Gravado
-        exento_match = apply_patterns(exento_patterns, texto)
-        gravado_match = apply_patterns(gravado_patterns, texto)
-        iva_match = apply_patterns(iva_patterns, texto)
-        total_match = apply_patterns(total_patterns, texto)
-        
-        # Extraer valores numéricos
-        no_gravado = parse_number(no_gravado_match)  # NUEVO: Extraer valor de No Gravado
-        exento = parse_number(exento_match)
-        gravado = parse_number(gravado_match)
-        iva = parse_number(iva_match)
-        total_extraido = parse_number(total_match)
-        
-        # Si no se encontró el valor de No Gravado específicamente para "Bienes y srvs. no computables"
-        if no_gravado == 0 and "Bienes y srvs. no computables" in texto:
-            # Buscar específicamente para "Bienes y srvs. no computables" con un patrón más flexible
-            bienes_no_comp_match = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*[\$\s]*([\d.,]+)', texto, re.IGNORECASE)
-            if bienes_no_comp_match:
-                no_gravado = parse_number(bienes_no_comp_match)
-            # Si aún no encuentra, buscar con un patrón más genérico
-            elif "Srvs de transporte exento" in texto:
-                srvs_transport_match = re.search(r'Srvs\s+de\s+transporte\s+exento\s+s/ley\s+\d+:\s*([\d.,]+)', texto)
-                if srvs_transport_match:
-                    no_gravado = parse_number(srvs_transport_match)
-        
-        # Si no se encontró el valor exento, intentar buscarlo en tablas
-        if exento == 0:
-            # Buscar en tablas con patrones específicos
-            exento_tabla_match = re.search(r'Exento\s+(\d[\d.,]+)', texto)
-            if exento_tabla_match:
-                exento = parse_number(exento_tabla_match)
-        
-        # Si no se encontró el valor gravado, intentar buscarlo en tablas
-        if gravado == 0:
-            # Buscar en tablas con patrones específicos
-            gravado_tabla_match = re.search(r'Gravado\s+(\d[\d.,]+)', texto)
-            if gravado_tabla_match:
-                gravado = parse_number(gravado_tabla_match)
-        
-        # Calcular total si no se pudo extraer
-        total_calculado = no_gravado + exento + gravado + iva  # Actualizado para incluir no_gravado
-        
-        # Comparar total extraído vs calculado y decidir cuál usar
-        if total_extraido > 0:
-            diferencia = abs(total_extraido - total_calculado)
-            if diferencia / (total_extraido + 0.001) > 0.05:  # Diferencia mayor al 5%
-                # Si hay gran diferencia, usar el extraído pero alertar
-                total = total_extraido
-                # Si tenemos total pero los componentes no suman, verificar si hay "Bienes y srvs"
-                if "Bienes y srvs. no computables" in texto and no_gravado == 0:
-                    # Asignar la diferencia a No Gravado
-                    no_gravado = total_extraido - (exento + gravado + iva)
-                    no_gravado = max(0, no_gravado)  # Asegurar que no sea negativo
-            else:
-                total = total_extraido
+    # Índice de etiquetas del texto reconocido, compartido por los extractores
+    indice = IndiceEtiquetas(texto_completo)
+    
+    # Identificar tipo de factura
+    tipo_factura = identificar_tipo_factura(texto_completo)
+    
+    # Si es factura de viajes/turismo, usar extracción especializada
+    if tipo_factura == "VIAJES":
+        datos_viajes = extraer_datos_factura_viajes(texto_completo, indice)
+        datos_viajes['Nombre_Archivo'] = nombre_archivo
+        datos_viajes['Metodo'] = f'{metodo}-Viajes'
+        return datos_viajes
+    
+    # Para otros tipos de facturas, continuar con el proceso normal
+    # Detectar moneda
+    moneda = detectar_moneda(texto_completo)
+    
+    # MODIFICACIÓN: Forzar moneda ARS para facturas argentinas
+    if tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"] and moneda == 'Desconocida':
+        moneda = 'ARS'
+    
+    # Función para convertir texto a número de forma segura (ya definida anteriormente)
+    def parse_number(match):
+        if not match:
+            return 0.0
+        try:
+            # Eliminar puntos de miles y reemplazar coma decimal por punto
+            value_str = match.group(1).replace('.', '').replace(',', '.')
+            return float(value_str)
+        except (ValueError, AttributeError):
+            return 0.0
+    
+    # Detectar tipo de factura para usar patrones específicos
+    is_factura_b = "CÓD. 006" in texto_completo or "FACTURA B" in texto_completo
+    is_factura_a = "CÓD. 001" in texto_completo or "FACTURA A" in texto_completo
+    
+    # Buscar todos los campos en una sola pasada sobre el texto completo
+    coincidencias = registro_patrones.conjunto('ocr').buscar(texto_completo)
+    nro_factura_match = coincidencias['Numero_Factura']
+    fecha_match = coincidencias['Fecha']
+    no_gravado_match = coincidencias['No_Gravado']  # NUEVO: Buscar No Gravado
+    exento_match = coincidencias['Exento']
+    gravado_match = coincidencias['Gravado']
+    iva_match = coincidencias['IVA']
+    total_match = coincidencias['Total']
+    
+    # Extraer valores numéricos
+    no_gravado = parse_number(no_gravado_match)  # NUEVO: Extraer valor de No Gravado
+    exento = parse_number(exento_match)
+    gravado = parse_number(gravado_match)
+    iva = parse_number(iva_match)
+    total_extraido = parse_number(total_match)
+    
+    # Si no se encontró el valor de No Gravado específicamente para "Bienes y srvs. no computables"
+    if no_gravado == 0 and "Bienes y srvs. no computables" in texto_completo:
+        # Buscar específicamente para "Bienes y srvs. no computables" con un patrón más flexible
+        bienes_no_comp_match = coincidencias['No_Gravado_Bienes']
+        if bienes_no_comp_match:
+            no_gravado = parse_number(bienes_no_comp_match)
+        # Si aún no encuentra, buscar cerca de la frase
         else:
-            total = total_calculado
-        
-        # Si tenemos un total pero los componentes suman cero, buscar componentes específicos
-        if total > 0 and total_calculado == 0:
-            # Si hay "Bienes y srvs. no computables", asignar todo el total a No Gravado
-            if "Bienes y srvs. no computables" in texto:
-                no_gravado = total
-            # Si hay "exento", asignar todo a exento
-            elif "exento" in texto.lower():
-                exento = total
-            # Si hay mención de IVA específico, calcular valores
-            elif "21%" in texto:
-                gravado = total / 1.21
-                iva = gravado * 0.21
-            elif "10.5%" in texto:
-                gravado = total / 1.105
-                iva = gravado * 0.105
-            else:
-                # Si no hay indicación específica, asignar como No Gravado por defecto
-                no_gravado = total
-                
-        # Asegurar que todos los valores sean números positivos
-        no_gravado = max(0, no_gravado)
-        exento = max(0, exento)
-        gravado = max(0, gravado)
-        iva = max(0, iva)
-        total = max(0, total)
-        
-        # Verificación final para Bienes y srvs. no computables
-        if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
-            no_gravado = detectar_bienes_no_computables(texto, total, gravado, iva, exento)
-        
-        return {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
-            'Fecha': fecha_match.group(1) if fecha_match else None,
-            'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
-            'Exento': exento,
-            'Gravado': gravado,
-            'IVA': iva,
-            'Total': total,
-            'Moneda': moneda,
-            'Metodo': 'RegEx'
-        }
-        
-    except Exception as e:
-        st.warning(f"RegEx: {str(e)}")
-        return None
+            # Buscar números cerca de la frase "Bienes y srvs. no computables"
+            contexto = coincidencias['No_Gravado_Contexto']
+            if contexto:
+                try:
+                    valor_str = re.search(r'(\d[\d.,]+)', contexto.group(1))
+                    if valor_str:
+                        no_gravado = float(valor_str.group(1).replace('.', '').replace(',', '.'))
+                except:
+                    pass
+    
+    # Si no se encontró el valor exento, intentar buscarlo en tablas
+    if exento == 0:
+        exento_tabla_match = coincidencias['Exento_Tabla']
+        if exento_tabla_match:
+            exento = parse_number(exento_tabla_match)
+    
+    # Si no se encontró el valor gravado, intentar buscarlo en tablas
+    if gravado == 0:
+        gravado_tabla_match = coincidencias['Gravado_Tabla']
+        if gravado_tabla_match:
+            gravado = parse_number(gravado_tabla_match)
+    
+    # Calcular total si no se pudo extraer
+    total_calculado = exento + gravado + iva + no_gravado  # Incluir no_gravado en el cálculo
+    
+    # Comparar total extraído vs calculado y decidir cuál usar
+    if total_extraido > 0:
+        diferencia = abs(total_extraido - total_calculado)
+        if diferencia / (total_extraido + 0.001) > 0.05:  # Diferencia mayor al 5%
+            # Si hay gran diferencia, usar el extraído pero alertar
+            total = total_extraido
+            # Si tenemos total pero los componentes no suman, verificar si hay "Bienes y srvs"
+            if "Bienes y srvs. no computables" in texto_completo and no_gravado == 0:
+                # Asignar la diferencia a No Gravado
+                no_gravado = total_extraido - (exento + gravado + iva)
+                no_gravado = max(0, no_gravado)  # Asegurar que no sea negativo
+            st.warning(f"Diferencia significativa entre total extraído ({total_extraido}) y calculado ({total_calculado})")
+        else:
+            total = total_extraido
+    else:
+        total = total_calculado
+    
+    # Si tenemos un total pero los componentes suman cero, buscar componentes específicos
+    if total > 0 and total_calculado == 0:
+        # Si hay "Bienes y srvs. no computables", asignar todo el total a No Gravado
+        if "Bienes y srvs. no computables" in texto_completo:
+            no_gravado = total
+        # Si hay "exento", asignar todo a exento
+        elif "exento" in texto_completo.lower():
+            exento = total
+        # Si hay mención de IVA específico, calcular valores
+        elif "21%" in texto_completo:
+            gravado = total / 1.21
+            iva = gravado * 0.21
+        elif "10.5%" in texto_completo:
+            gravado = total / 1.105
+            iva = gravado * 0.105
+        else:
+            # Si no hay indicación específica, asignar como No Gravado por defecto
+            no_gravado = total
     
+    # Asegurar que todos los valores sean números positivos
+    no_gravado = max(0, no_gravado)
+    exento = max(0, exento)
+    gravado = max(0, gravado)
+    iva = max(0, iva)
+    total = max(0, total)
+    
+    # Verificación final para Bienes y srvs. no computables
+    if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
+        no_gravado = detectar_bienes_no_computables(texto_completo, total, gravado, iva, exento, indice)
+    
+    return {
+        'Nombre_Archivo': nombre_archivo,
+        'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
+        'Fecha': fecha_match.group(1) if fecha_match else None,
+        'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
+        'Exento': exento,
+        'Gravado': gravado,
+        'IVA': iva,
+        'Total': total,
+        'Moneda': moneda,
+        'Metodo': metodo
+    }
+
+
+def extraer_con_regex(documento):
     """
     Extrae datos de facturas usando expresiones regulares avanzadas.
+    Trabaja sobre la capa de texto ya extraída del DocumentoPDF.
     """
     try:
-        # Leer el PDF
-        reader = pypdf.PdfReader(archivo_pdf)
-        texto = ""
-        for pagina in reader.pages:
-            texto += pagina.extract_text()
+        texto = documento.texto
         
         # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto)
+        tipo_factura = identificar_tipo_factura(texto, documento.texto_upper)
         
         # Si es factura de viajes/turismo, usar extracción especializada
         if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto)
-            datos_viajes['Nombre_Archivo'] = archivo_pdf.name
+            datos_viajes = extraer_datos_factura_viajes(texto, documento.indice)
+            datos_viajes['Nombre_Archivo'] = documento.nombre
             datos_viajes['Metodo'] = 'RegEx-Viajes'
             return datos_viajes
             
@@ -1293,82 +1904,15 @@ def extraer_con_regex(archivo_pdf):
         is_factura_b = "CÓD. 006" in texto or "FACTURA B" in texto
         is_factura_a = "CÓD. 001" in texto or "FACTURA A" in texto
         
-        # Patrones de expresión regular para diferentes campos
-        # Número de factura
-        nro_factura_patterns = [
-            r'Comp\. Nro:\s*(\d+)',
-            r'Factura\s+[Nn][°o]:\s*([A-Z0-9\-]+)',
-            r'N[°o]\s*(?:Factura|Comprobante):\s*([A-Z0-9\-]+)',
-            r'(?:Factura|Comprobante)\s+(?:[Nn][°o])?[:\s]+([A-Z0-9\-]+)'
-        ]
-        
-        # Fecha
-        fecha_patterns = [
-            r'Fecha de Emisión:\s*(\d{2}/\d{2}/\d{4})',
-            r'Fecha:\s*(\d{2}/\d{2}/\d{4})',
-            r'Fecha\s+(?:de\s+)?(?:Emisión|Emision):\s*(\d{2}[-/]\d{2}[-/]\d{4})',
-            r'Emitido\s+(?:el)?:\s*(\d{2}[-/]\d{2}[-/]\d{4})'
-        ]
-        
-        # NUEVOS patrones para No Gravado - AGREGADOS para capturar "Bienes y srvs. no computables"
-        no_gravado_patterns = [
-            r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:\s*\$?\s*([\d.,]+)',
-            r'Conceptos\s+no\s+gravados:\s*\$?\s*([\d.,]+)',
-            r'No\s+gravado:\s*\$?\s*([\d.,]+)',
-            r'Importe(?:s)?\s+no\s+gravado(?:s)?:\s*\$?\s*([\d.,]+)',
-            r'Op\.\s+No\s+Gravadas:\s*\$?\s*([\d.,]+)',
-            r'No\s+suj\.\s+a\s+IVA:\s*\$?\s*([\d.,]+)',
-            r'No\s+alcanzado:\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Exento
-        exento_patterns = [
-            r'Importe Exento:.*?(\d[\d.,]+)',
-            r'Exento:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:EXENTO|Exento):?\s*\$?\s*([\d.,]+)',
-            r'Op.\s+Exentas:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Gravado
-        gravado_patterns = [
-            r'Importe Neto Gravado:.*?(\d[\d.,]+)',
-            r'Gravado:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:NETO\s+)?(?:GRAVADO|Gravado):?\s*\$?\s*([\d.,]+)',
-            r'Neto\s+Gravado:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # IVA
-        iva_patterns = [
-            r'IVA 21%:.*?(\d[\d.,]+)',
-            r'IVA:?\s*\$?\s*([\d.,]+)',
-            r'I\.V\.A\.(?:\s+\d+%)?:?\s*\$?\s*([\d.,]+)'
-        ]
-        
-        # Total
-        total_patterns = [
-            r'Importe Total:.*?(\d[\d.,]+)',
-            r'TOTAL:?\s*\$?\s*([\d.,]+)',
-            r'Total:?\s*\$?\s*([\d.,]+)',
-            r'(?:IMPORTE|Importe)\s+(?:TOTAL|Total):?\s*\$?\s*([\d.,]+)',
-            r'(?<!\w)Total(?!\w).*?(\d[\d.,]+)'
-        ]
-        
-        # Aplicar todos los patrones y tomar el primer match para cada campo
-        def apply_patterns(patterns, text):
-            for pattern in patterns:
-                match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-                if match:
-                    return match
-            return None
-        
-        # Buscar los patrones en el texto
-        nro_factura_match = apply_patterns(nro_factura_patterns, texto)
-        fecha_match = apply_patterns(fecha_patterns, texto)
-        no_gravado_match = apply_patterns(no_gravado_patterns, texto)  # NUEVO: Buscar No Gravado
-        exento_match = apply_patterns(exento_patterns, texto)
-        gravado_match = apply_patterns(gravado_patterns, texto)
-        iva_match = apply_patterns(iva_patterns, texto)
-        total_match = apply_patterns(total_patterns, texto)
+        # Buscar todos los campos en una sola pasada sobre el texto
+        coincidencias = registro_patrones.conjunto('texto').buscar(texto)
+        nro_factura_match = coincidencias['Numero_Factura']
+        fecha_match = coincidencias['Fecha']
+        no_gravado_match = coincidencias['No_Gravado']  # NUEVO: Buscar No Gravado
+        exento_match = coincidencias['Exento']
+        gravado_match = coincidencias['Gravado']
+        iva_match = coincidencias['IVA']
+        total_match = coincidencias['Total']
         
         # Extraer valores numéricos
         no_gravado = parse_number(no_gravado_match)  # NUEVO: Extraer valor de No Gravado
@@ -1380,26 +1924,26 @@ def extraer_con_regex(archivo_pdf):
         # Si no se encontró el valor de No Gravado específicamente para "Bienes y srvs. no computables"
         if no_gravado == 0 and "Bienes y srvs. no computables" in texto:
             # Buscar específicamente para "Bienes y srvs. no computables" con un patrón más flexible
-            bienes_no_comp_match = re.search(r'Bienes\s+y\s+srvs\.\s+no\s+computables[^:]*:?\s*[\$\s]*([\d.,]+)', texto, re.IGNORECASE)
+            bienes_no_comp_match = coincidencias['No_Gravado_Bienes']
             if bienes_no_comp_match:
                 no_gravado = parse_number(bienes_no_comp_match)
             # Si aún no encuentra, buscar con un patrón más genérico
             elif "Srvs de transporte exento" in texto:
-                srvs_transport_match = re.search(r'Srvs\s+de\s+transporte\s+exento\s+s/ley\s+\d+:\s*([\d.,]+)', texto)
+                srvs_transport_match = coincidencias['No_Gravado_Transporte']
                 if srvs_transport_match:
                     no_gravado = parse_number(srvs_transport_match)
         
         # Si no se encontró el valor exento, intentar buscarlo en tablas
         if exento == 0:
             # Buscar en tablas con patrones específicos
-            exento_tabla_match = re.search(r'Exento\s+(\d[\d.,]+)', texto)
+            exento_tabla_match = coincidencias['Exento_Tabla']
             if exento_tabla_match:
                 exento = parse_number(exento_tabla_match)
         
         # Si no se encontró el valor gravado, intentar buscarlo en tablas
         if gravado == 0:
             # Buscar en tablas con patrones específicos
-            gravado_tabla_match = re.search(r'Gravado\s+(\d[\d.,]+)', texto)
+            gravado_tabla_match = coincidencias['Gravado_Tabla']
             if gravado_tabla_match:
                 gravado = parse_number(gravado_tabla_match)
         
@@ -1428,7 +1972,7 @@ def extraer_con_regex(archivo_pdf):
             if "Bienes y srvs. no computables" in texto:
                 no_gravado = total
             # Si hay "exento", asignar todo a exento
-            elif "exento" in texto.lower():
+            elif "exento" in documento.texto_lower:
                 exento = total
             # Si hay mención de IVA específico, calcular valores
             elif "21%" in texto:
@@ -1436,218 +1980,247 @@ def extraer_con_regex(archivo_pdf):
                 iva = gravado * 0.21
             elif "10.5%" in texto:
                 gravado = total / 1.105
-                iva = gravado * 0.105
-            else:
-                # Si no hay indicación específica, asignar como No Gravado por defecto
-                no_gravado = total
-                
-        # Asegurar que todos los valores sean números positivos
-        no_gravado = max(0, no_gravado)
-        exento = max(0, exento)
-        gravado = max(0, gravado)
-        iva = max(0, iva)
-        total = max(0, total)
-        
-        # Verificación final para Bienes y srvs. no computables
-        if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
-            no_gravado = detectar_bienes_no_computables(texto, total, gravado, iva, exento)
-        
-        return {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
-            'Fecha': fecha_match.group(1) if fecha_match else None,
-            'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
-            'Exento': exento,
-            'Gravado': gravado,
-            'IVA': iva,
-            'Total': total,
-            'Moneda': moneda,
-            'Metodo': 'RegEx'
-        }
-        
-    except Exception as e:
-        st.warning(f"RegEx: {str(e)}")
-        return None   
-
-def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
-    """
-    Sistema de cascada para extracción de datos de facturas.
-    Intenta varios métodos en orden de preferencia.
-    """
-    try:
-        # Verificar el nombre del archivo para facturas argentinas
-        nombre_archivo = archivo_pdf.name.upper()
-        es_factura_argentina = False
-        es_factura_usd = False
-        
-        # Verificación rápida del nombre para facturas argentinas
-        if "FCE_A" in nombre_archivo or "ROSSO" in nombre_archivo or "FACTURA_A" in nombre_archivo or "AFIP" in nombre_archivo:
-            es_factura_argentina = True
-            moneda_inicial = "ARS"  # Forzar ARS para este tipo de archivo
-        
-        # Verificación específica para facturas que sabemos son USD
-        if "THAU" in nombre_archivo or "FUENTES" in nombre_archivo:
-            es_factura_usd = True
-            moneda_inicial = "USD"  # Marcar inicialmente como USD
-        
-        # Leer el texto para buscar patrones similares
-        reader = pypdf.PdfReader(archivo_pdf)
-        texto = ""
-        for pagina in reader.pages:
-            texto += pagina.extract_text()
-        
-        # Verificación explícita para facturas en USD basada en el texto
-        if "emitida en USD" in texto or "TOTAL USD:" in texto or (
-            "cancelada en dicha moneda" in texto and "USD" in texto):
-            es_factura_usd = True
-            moneda_inicial = "USD"
-        
-        # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto)
-        
-        # Determinar moneda inicial si no se hizo por verificaciones anteriores
-        if not es_factura_argentina and not es_factura_usd:
-            if tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                moneda_inicial = "ARS"  # Forzar ARS para facturas A, B o electrónicas AFIP
-            else:
-                # Intentar detectar moneda normalmente
-                moneda_inicial = detectar_moneda(texto)
-        
-        # 0. Buscar si hay un patrón similar ya aprendido (solo si no se ignoran patrones)
-        if USE_PATTERN_MATCHING and not ignore_patterns:
-            patron_similar = patrones_manager.encontrar_patron_similar(texto)
-            if patron_similar:
-                st.info(f"Usando patrón aprendido previamente")
-                estructura = patron_similar['estructura']
-                estructura['Nombre_Archivo'] = archivo_pdf.name
-                
-                # Si el patrón no tiene moneda, intentar asignar una
-                if 'Moneda' not in estructura:
-                    estructura['Moneda'] = moneda_inicial
-                
-                # Forzar moneda según detecciones específicas
-                if es_factura_usd:
-                    estructura['Moneda'] = 'USD'
-                elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                    estructura['Moneda'] = 'ARS'
-                    
-                # Verificación final para conceptos no gravados
-                if estructura['Total'] > 0 and "Bienes y srvs. no computables" in texto:
-                    suma_actual = estructura['No_Gravado'] + estructura['Exento'] + estructura['Gravado'] + estructura['IVA']
-                    if abs(estructura['Total'] - suma_actual) > 1.0 and estructura['No_Gravado'] < 1.0:
-                        estructura['No_Gravado'] = detectar_bienes_no_computables(
-                            texto, estructura['Total'], estructura['Gravado'], 
-                            estructura['IVA'], estructura['Exento']
-                        )
-                    
-                estructura['Metodo'] = f"Patrón-{patron_similar['metodo_extraccion']}"
-                return estructura
-        
-        # 1. Intentar con Tesseract OCR (alternativa gratuita a OpenAI)
-        if USE_TESSERACT_OCR:
-            archivo_pdf.seek(0)  # Reiniciar el puntero del archivo
-            datos = extraer_con_tesseract_ocr(archivo_pdf)
-            if datos and datos['Total'] > 0:
-                # Forzar moneda según detecciones específicas
-                if es_factura_usd:
-                    datos['Moneda'] = 'USD'
-                elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                    datos['Moneda'] = 'ARS'
-                else:
-                    # Si no hay detección específica, usar la moneda inicial
-                    datos['Moneda'] = moneda_inicial
-                
-                # Guardar el patrón aprendido
-                patrones_manager.agregar_patron(datos, texto, 'TesseractOCR')
-                return datos
-        
-        # 2. Intentar con Expresiones Regulares mejoradas
-        archivo_pdf.seek(0)  # Reiniciar el puntero del archivo
-        datos = extraer_con_regex(archivo_pdf)
-        if datos and datos['Total'] > 0:
-            # Forzar moneda según detecciones específicas
-            if es_factura_usd:
-                datos['Moneda'] = 'USD'
-            elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                datos['Moneda'] = 'ARS'
-            else:
-                # Si no hay detección específica, usar la moneda inicial
-                datos['Moneda'] = moneda_inicial
-            
-            # Guardar el patrón aprendido
-            patrones_manager.agregar_patron(datos, texto, 'RegEx')
-            return datos
-        
-        # 3. Intentar específicamente con el extractor de facturas de viajes si es ese tipo
-        if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto)
-            if datos_viajes and datos_viajes['Total'] > 0:
-                datos_viajes['Nombre_Archivo'] = archivo_pdf.name
-                
-                # Forzar moneda según detecciones específicas
-                if es_factura_usd:
-                    datos_viajes['Moneda'] = 'USD'
-                elif es_factura_argentina:
-                    datos_viajes['Moneda'] = 'ARS'
-                else:
-                    datos_viajes['Moneda'] = moneda_inicial
-                
-                datos_viajes['Metodo'] = 'Especializado-Viajes'
-                patrones_manager.agregar_patron(datos_viajes, texto, 'Especializado-Viajes')
-                return datos_viajes
-        
-        # 4. Si todo falla, devolver datos vacíos
-        resultado_fallido = {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': None,
-            'Fecha': None,
-            'Total': 0.0,
-            'Gravado': 0.0,
-            'IVA': 0.0,
-            'No_Gravado': 0.0,
-            'Exento': 0.0,
-            'Moneda': moneda_inicial,  # Al menos tenemos una moneda detectada
-            'Metodo': 'Fallido'
-        }
-        
-        # Forzar moneda según detecciones específicas incluso si falló
-        if es_factura_usd:
-            resultado_fallido['Moneda'] = 'USD'
-        elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-            resultado_fallido['Moneda'] = 'ARS'
+                iva = gravado * 0.105
+            else:
+                # Si no hay indicación específica, asignar como No Gravado por defecto
+                no_gravado = total
+                
+        # Asegurar que todos los valores sean números positivos
+        no_gravado = max(0, no_gravado)
+        exento = max(0, exento)
+        gravado = max(0, gravado)
+        iva = max(0, iva)
+        total = max(0, total)
         
-        # Verificación final de consistencia para conceptos no gravados
-        if "Bienes y srvs. no computables" in texto:
-            valor_no_gravado = detectar_bienes_no_computables(
-                texto, resultado_fallido['Total'], resultado_fallido['Gravado'],
-                resultado_fallido['IVA'], resultado_fallido['Exento']
-            )
-            if valor_no_gravado > 0:
-                resultado_fallido['No_Gravado'] = valor_no_gravado
-            
-        return resultado_fallido
+        # Verificación final para Bienes y srvs. no computables
+        if no_gravado == 0 or (total > 0 and abs(total - (no_gravado + exento + gravado + iva)) > 1.0):
+            no_gravado = detectar_bienes_no_computables(texto, total, gravado, iva, exento, documento.indice)
         
-    except Exception as e:
-        st.error(f"Error al procesar {archivo_pdf.name}: {str(e)}")
         return {
-            'Nombre_Archivo': archivo_pdf.name,
-            'Numero_Factura': None,
-            'Fecha': None,
-            'Total': 0.0,
-            'Gravado': 0.0,
-            'IVA': 0.0,
-            'No_Gravado': 0.0,
-            'Exento': 0.0,
-            'Moneda': 'Desconocida',
-            'Metodo': 'Error'
+            'Nombre_Archivo': documento.nombre,
+            'Numero_Factura': nro_factura_match.group(1) if nro_factura_match else None,
+            'Fecha': fecha_match.group(1) if fecha_match else None,
+            'No_Gravado': no_gravado,  # Ahora incluye el valor capturado
+            'Exento': exento,
+            'Gravado': gravado,
+            'IVA': iva,
+            'Total': total,
+            'Moneda': moneda,
+            'Metodo': 'RegEx'
         }
+        
+    except Exception as e:
+        st.warning(f"RegEx: {str(e)}")
+        registrar_etapa_fallida('RegEx', e)
+        return None
+
+
+# Campos que se ubican en las plantillas de los patrones aprendidos
+CAMPOS_TEXTO_PLANTILLA = ('Numero_Factura', 'Fecha')
+CAMPOS_IMPORTE_PLANTILLA = ('No_Gravado', 'Exento', 'Gravado', 'IVA', 'Total')
+PATRON_IMPORTE_PLANTILLA = r'(\d(?:[\d.,]*\d)?)'
+MAX_LINEAS_ETIQUETA = 3  # Líneas hacia arriba en las que se busca la etiqueta de un valor suelto
+
+
+def _patron_forma(valor):
+    """Expresión con la forma del valor: los dígitos se generalizan y el resto queda literal"""
+    return '(' + ''.join(rf'\d{{{len(parte)}}}' if parte.isdigit() else re.escape(parte)
+                         for parte in re.split(r'(\d+)', valor) if parte) + ')'
+
+
+def _ubicar_valor(lineas, num_linea, inicio, fin, patron):
+    """
+    Ubicación del valor lineas[num_linea][inicio:fin]: la etiqueta que lo precede en la misma
+    línea (o la línea no vacía anterior) y en qué aparición del patrón cae a partir de ella.
+    """
+    linea = lineas[num_linea]
+    etiqueta = re.split(r'\s{2,}', linea[:inicio].rstrip(' $'))[-1].strip()
+    if etiqueta and not etiqueta[-1].isdigit():
+        desplazamiento = 0
+        num_etiqueta = num_linea
+        segmento_desde = linea.rfind(etiqueta, 0, inicio) + len(etiqueta)
+    else:
+        # Valor suelto (por ejemplo en una tabla): usar la línea anterior como etiqueta
+        for desplazamiento in range(1, MAX_LINEAS_ETIQUETA + 1):
+            num_etiqueta = num_linea - desplazamiento
+            if num_etiqueta < 0:
+                return None
+            etiqueta = lineas[num_etiqueta].strip()
+            if etiqueta:
+                break
+        else:
+            return None
+        segmento_desde = 0
+    
+    ocurrencias = [m.start(1) for m in re.finditer(patron, linea[segmento_desde:])]
+    if inicio - segmento_desde not in ocurrencias:
+        return None
+    
+    # Aparición de la etiqueta hasta la línea elegida (los encabezados suelen repetirse por página)
+    aparicion = sum(l.count(etiqueta) for l in lineas[:num_etiqueta])
+    aparicion += lineas[num_etiqueta].count(etiqueta, 0, segmento_desde if desplazamiento == 0 else None) - 1
+    return {
+        'etiqueta': etiqueta,
+        'aparicion': aparicion,
+        'desplazamiento': desplazamiento,
+        'patron': patron,
+        'ocurrencia': ocurrencias.index(inicio - segmento_desde)
+    }
+
+
+def construir_plantilla(texto, datos):
+    """
+    Plantilla de una factura ya extraída: dónde aparece cada campo de datos en el texto.
+    Los importes se reconocen por su valor numérico; se prefieren los de la forma "Etiqueta: valor".
+    """
+    lineas = texto.split('\n')
+    plantilla = {}
+    
+    for campo in CAMPOS_TEXTO_PLANTILLA:
+        valor = datos.get(campo)
+        if not valor or not isinstance(valor, str):
+            continue
+        patron = _patron_forma(valor)
+        for num_linea, linea in enumerate(lineas):
+            inicio = linea.find(valor)
+            ubicacion = _ubicar_valor(lineas, num_linea, inicio, inicio + len(valor), patron) if inicio != -1 else None
+            if ubicacion:
+                plantilla[campo] = ubicacion
+                break
+    
+    importes = [campo for campo in CAMPOS_IMPORTE_PLANTILLA if isinstance(datos.get(campo), (int, float)) and datos[campo] > 0]
+    if importes:
+        candidatos = {campo: [] for campo in importes}
+        for num_linea, linea in enumerate(lineas):
+            for match in re.finditer(PATRON_IMPORTE_PLANTILLA, linea):
+                numero = parse_number(match)
+                for campo in importes:
+                    if abs(numero - datos[campo]) < 0.005:
+                        con_dos_puntos = linea[:match.start()].rstrip(' $').endswith(':')
+                        candidatos[campo].append((not con_dos_puntos, num_linea, match.start(), match.end()))
+        for campo, ubicaciones in candidatos.items():
+            for _, num_linea, inicio, fin in sorted(ubicaciones):
+                ubicacion = _ubicar_valor(lineas, num_linea, inicio, fin, PATRON_IMPORTE_PLANTILLA)
+                if ubicacion:
+                    plantilla[campo] = ubicacion
+                    break
+    
+    return plantilla
+
+
+def _leer_ubicacion(lineas, ubicacion):
+    """Valor (match) que la ubicación de una plantilla señala en otra factura, o None"""
+    etiqueta = ubicacion['etiqueta']
+    restantes = ubicacion['aparicion']
+    for num_linea, linea in enumerate(lineas):
+        posicion = linea.find(etiqueta)
+        while posicion != -1 and restantes > 0:
+            restantes -= 1
+            posicion = linea.find(etiqueta, posicion + len(etiqueta))
+        if posicion == -1:
+            continue
+        
+        if ubicacion['desplazamiento'] == 0:
+            segmento = linea[posicion + len(etiqueta):]
+        elif num_linea + ubicacion['desplazamiento'] < len(lineas):
+            segmento = lineas[num_linea + ubicacion['desplazamiento']]
+        else:
+            return None
+        for ocurrencia, match in enumerate(re.finditer(ubicacion['patron'], segmento)):
+            if ocurrencia == ubicacion['ocurrencia']:
+                return match
+        return None
+    return None
+
+
+def extraer_con_plantilla(documento, plantilla):
+    """
+    Extracción dirigida con la plantilla de un patrón aprendido: lee cada campo en la
+    ubicación guardada, sin la cascada general ni OCR. Devuelve None si falta un campo requerido.
+    """
+    if not plantilla:
+        return None
+    lineas = documento.indice.lineas
+    
+    datos = {'Nombre_Archivo': documento.nombre}
+    for campo in CAMPOS_TEXTO_PLANTILLA:
+        match = _leer_ubicacion(lineas, plantilla[campo]) if campo in plantilla else None
+        datos[campo] = match.group(1) if match else None
+    for campo in CAMPOS_IMPORTE_PLANTILLA:
+        match = _leer_ubicacion(lineas, plantilla[campo]) if campo in plantilla else None
+        datos[campo] = parse_number(match) if match else 0.0
+    
+    if any(not datos.get(campo) for campo in CAMPOS_REQUERIDOS):
+        return None
+    return datos
+
+
+def datos_completos(datos):
+    """
+    Indica si una extracción tiene los campos requeridos y si sus componentes
+    concilian con el total. Se usa para decidir si hace falta escalar a OCR.
+    """
+    if not datos:
+        return False
+    
+    for campo in CAMPOS_REQUERIDOS:
+        if not datos.get(campo):
+            return False
+    
+    suma_componentes = datos['No_Gravado'] + datos['Exento'] + datos['Gravado'] + datos['IVA']
+    return abs(datos['Total'] - suma_componentes) <= TOLERANCIA_CONCILIACION
+
+
+def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
     """
     Sistema de cascada para extracción de datos de facturas.
     Intenta varios métodos en orden de preferencia.
+    El PDF se parsea una única vez y todas las etapas reciben el mismo DocumentoPDF.
+    Con PRIORIZAR_CAPA_TEXTO se prueba primero la capa de texto y sólo se
+    recurre al OCR cuando faltan campos requeridos o los montos no concilian.
+    
+    Si algún patrón de campos se omitió por exceder PRESUPUESTO_PATRON_MS, el resultado
+    lo indica en 'Patrones_Omitidos': depende del tiempo y no sólo del PDF. Las etapas que
+    fallaron con una excepción (OCR sin Tesseract o Poppler, por ejemplo) quedan en 'Etapas_Fallidas'.
+    """
+    _estado_documento.patrones_omitidos = []
+    _estado_documento.etapas_fallidas = []
+    try:
+        datos = _extraer_en_cascada(archivo_pdf, patrones_manager, ignore_patterns)
+    finally:
+        omitidos = _estado_documento.patrones_omitidos
+        fallidas = _estado_documento.etapas_fallidas
+        _estado_documento.patrones_omitidos = _estado_documento.etapas_fallidas = None
+    if datos is not None:
+        if omitidos:
+            datos['Patrones_Omitidos'] = sorted(set(omitidos))
+        if fallidas:
+            datos['Etapas_Fallidas'] = fallidas
+    return datos
+
+
+def registrar_etapa_fallida(etapa, error):
+    """Anota que una etapa de la cascada falló en el documento actual (su resultado no se guarda en la caché)"""
+    if getattr(_estado_documento, 'etapas_fallidas', None) is not None:
+        _estado_documento.etapas_fallidas.append(f"{etapa}: {error}")
+
+
+def resultado_reproducible(datos):
+    """
+    True si el resultado depende sólo del PDF y la configuración y se puede guardar en la caché.
+    Los fallidos, los que tuvieron una etapa con error y los que omitieron patrones por tiempo
+    pueden dar otra cosa al repetirse (por ejemplo, una vez instalado Tesseract).
     """
+    return (datos.get('Metodo') not in ('Error', 'Fallido')
+            and not datos.get('Etapas_Fallidas') and not datos.get('Patrones_Omitidos'))
+
+
+def _extraer_en_cascada(archivo_pdf, patrones_manager, ignore_patterns):
     try:
+        documento = DocumentoPDF.desde_archivo(archivo_pdf)
+        
         # Verificar el nombre del archivo para facturas argentinas
-        nombre_archivo = archivo_pdf.name.upper()
+        nombre_archivo = documento.nombre.upper()
         es_factura_argentina = False
         es_factura_usd = False
         
@@ -1661,11 +2234,8 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
             es_factura_usd = True
             moneda_inicial = "USD"  # Marcar inicialmente como USD
         
-        # Leer el texto para buscar patrones similares
-        reader = pypdf.PdfReader(archivo_pdf)
-        texto = ""
-        for pagina in reader.pages:
-            texto += pagina.extract_text()
+        # Texto de la capa digital, ya extraído al crear el documento
+        texto = documento.texto
         
         # Verificación explícita para facturas en USD basada en el texto
         if "emitida en USD" in texto or "TOTAL USD:" in texto or (
@@ -1674,7 +2244,7 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
             moneda_inicial = "USD"
         
         # Identificar tipo de factura
-        tipo_factura = identificar_tipo_factura(texto)
+        tipo_factura = identificar_tipo_factura(texto, documento.texto_upper)
         
         # Determinar moneda inicial si no se hizo por verificaciones anteriores
         if not es_factura_argentina and not es_factura_usd:
@@ -1686,47 +2256,26 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
         
         # 0. Buscar si hay un patrón similar ya aprendido (solo si no se ignoran patrones)
         if USE_PATTERN_MATCHING and not ignore_patterns:
-            patron_similar = patrones_manager.encontrar_patron_similar(texto)
-            if patron_similar:
+            id_patron, patron_similar = patrones_manager.encontrar_patron_similar(texto)
+            # La plantilla lee los valores de esta factura; si no concilian, se sigue con la cascada
+            datos_plantilla = extraer_con_plantilla(documento, patron_similar['plantilla']) if patron_similar else None
+            if datos_completos(datos_plantilla):
+                patrones_manager.registrar_uso(id_patron)
                 st.info(f"Usando patrón aprendido previamente")
-                estructura = patron_similar['estructura']
-                estructura['Nombre_Archivo'] = archivo_pdf.name
-                
-                # Si el patrón no tiene moneda, intentar asignar una
-                if 'Moneda' not in estructura:
-                    estructura['Moneda'] = moneda_inicial
                 
                 # Forzar moneda según detecciones específicas
                 if es_factura_usd:
-                    estructura['Moneda'] = 'USD'
-                elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                    estructura['Moneda'] = 'ARS'
-                    
-                estructura['Metodo'] = f"Patrón-{patron_similar['metodo_extraccion']}"
-                return estructura
-        
-        # 1. Intentar con Tesseract OCR (alternativa gratuita a OpenAI)
-        if USE_TESSERACT_OCR:
-            archivo_pdf.seek(0)  # Reiniciar el puntero del archivo
-            datos = extraer_con_tesseract_ocr(archivo_pdf)
-            if datos and datos['Total'] > 0:
-                # Forzar moneda según detecciones específicas
-                if es_factura_usd:
-                    datos['Moneda'] = 'USD'
+                    datos_plantilla['Moneda'] = 'USD'
                 elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
-                    datos['Moneda'] = 'ARS'
+                    datos_plantilla['Moneda'] = 'ARS'
                 else:
-                    # Si no hay detección específica, usar la moneda inicial
-                    datos['Moneda'] = moneda_inicial
+                    datos_plantilla['Moneda'] = patron_similar['estructura'].get('Moneda', moneda_inicial)
                 
-                # Guardar el patrón aprendido
-                patrones_manager.agregar_patron(datos, texto, 'TesseractOCR')
-                return datos
+                datos_plantilla['Metodo'] = f"Patrón-{patron_similar['metodo_extraccion']}"
+                return datos_plantilla
         
-        # 2. Intentar con Expresiones Regulares mejoradas
-        archivo_pdf.seek(0)  # Reiniciar el puntero del archivo
-        datos = extraer_con_regex(archivo_pdf)
-        if datos and datos['Total'] > 0:
+        # Asignar la moneda detectada y guardar el patrón aprendido
+        def confirmar_extraccion(datos, metodo_extraccion):
             # Forzar moneda según detecciones específicas
             if es_factura_usd:
                 datos['Moneda'] = 'USD'
@@ -1737,14 +2286,33 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
                 datos['Moneda'] = moneda_inicial
             
             # Guardar el patrón aprendido
-            patrones_manager.agregar_patron(datos, texto, 'RegEx')
+            patrones_manager.agregar_patron(datos, texto, metodo_extraccion)
             return datos
         
-        # 3. Intentar específicamente con el extractor de facturas de viajes si es ese tipo
+        # 1. Capa de texto primero: si ya trae todos los campos y concilia, no hace falta OCR
+        datos_regex = None
+        if PRIORIZAR_CAPA_TEXTO:
+            datos_regex = extraer_con_regex(documento)
+            if datos_completos(datos_regex):
+                return confirmar_extraccion(datos_regex, 'RegEx')
+        
+        # 2. Intentar con Tesseract OCR (alternativa gratuita a OpenAI)
+        if USE_TESSERACT_OCR:
+            datos = extraer_con_tesseract_ocr(documento)
+            if datos and datos['Total'] > 0:
+                metodo_extraccion = 'TesseractOCR' if datos['Metodo'].startswith('Tesseract') else 'Capa-Texto'
+                return confirmar_extraccion(datos, metodo_extraccion)
+        
+        # 3. Intentar con Expresiones Regulares mejoradas (reutilizando el resultado del paso 1)
+        datos = datos_regex if PRIORIZAR_CAPA_TEXTO else extraer_con_regex(documento)
+        if datos and datos['Total'] > 0:
+            return confirmar_extraccion(datos, 'RegEx')
+        
+        # 4. Intentar específicamente con el extractor de facturas de viajes si es ese tipo
         if tipo_factura == "VIAJES":
-            datos_viajes = extraer_datos_factura_viajes(texto)
+            datos_viajes = extraer_datos_factura_viajes(texto, documento.indice)
             if datos_viajes and datos_viajes['Total'] > 0:
-                datos_viajes['Nombre_Archivo'] = archivo_pdf.name
+                datos_viajes['Nombre_Archivo'] = documento.nombre
                 
                 # Forzar moneda según detecciones específicas
                 if es_factura_usd:
@@ -1758,9 +2326,9 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
                 patrones_manager.agregar_patron(datos_viajes, texto, 'Especializado-Viajes')
                 return datos_viajes
         
-        # 4. Si todo falla, devolver datos vacíos
+        # 5. Si todo falla, devolver datos vacíos
         resultado_fallido = {
-            'Nombre_Archivo': archivo_pdf.name,
+            'Nombre_Archivo': documento.nombre,
             'Numero_Factura': None,
             'Fecha': None,
             'Total': 0.0,
@@ -1777,17 +2345,16 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
             resultado_fallido['Moneda'] = 'USD'
         elif es_factura_argentina or tipo_factura in ["TIPO_A", "TIPO_B", "ELECTRONICA_AFIP"]:
             resultado_fallido['Moneda'] = 'ARS'
-            
-        # Verificación final para "Bienes y srvs. no computables"
-        if "Bienes y srvs. no computables" in texto and resultado_fallido['Total'] > 0:
-            no_comp_match = re.search(r'(?:Bienes y srvs\. no computables|no computables para la det\. del Iva)(?:[^\d]*)\$?\s*([\d.,]+)', texto)
-            if no_comp_match:
-                try:
-                    valor_str = no_comp_match.group(1).replace(".", "").replace(",", ".")
-                    resultado_fallido['No_Gravado'] = float(valor_str)
-                except:
-                    pass
         
+        # Verificación final de consistencia para conceptos no gravados
+        if "Bienes y srvs. no computables" in texto:
+            valor_no_gravado = detectar_bienes_no_computables(
+                texto, resultado_fallido['Total'], resultado_fallido['Gravado'],
+                resultado_fallido['IVA'], resultado_fallido['Exento'], documento.indice
+            )
+            if valor_no_gravado > 0:
+                resultado_fallido['No_Gravado'] = valor_no_gravado
+            
         return resultado_fallido
         
     except Exception as e:
@@ -1803,254 +2370,464 @@ def extraer_datos_pdf(archivo_pdf, patrones_manager, ignore_patterns=False):
             'Exento': 0.0,
             'Moneda': 'Desconocida',
             'Metodo': 'Error'
-        }      
-        
+        }
+
+def configuracion_extraccion():
+    """Configuración global que afecta el resultado de la extracción"""
+    return {
+        'USE_TESSERACT_OCR': USE_TESSERACT_OCR,
+        'USE_PATTERN_MATCHING': USE_PATTERN_MATCHING,
+        'PRIORIZAR_CAPA_TEXTO': PRIORIZAR_CAPA_TEXTO,
+        'OCR_POR_REGIONES': OCR_POR_REGIONES,
+        'OCR_MOTOR': OCR_MOTOR,
+        'PATRONES_CAMPOS': registro_patrones.firma_actual(),
+    }
+
+
+# Almacén de patrones de cada proceso del lote (se carga una vez por proceso)
+_patrones_worker = None
+
+
+def _inicializar_worker(ruta_patrones, configuracion, hilos_ocr):
+    """Prepara un proceso del lote con la misma configuración que la sesión"""
+    global _patrones_worker, OCR_HILOS_POR_DOCUMENTO
+    globals().update({clave: valor for clave, valor in configuracion.items() if clave in globals()})
+    OCR_HILOS_POR_DOCUMENTO = hilos_ocr
+    # El inicializador corre en el hilo principal del proceso: acá tesserocr sí se puede cargar
+    cargar_tesserocr()
+    _patrones_worker = PatronesFacturasDiferidos(ruta_patrones)
+
+
+def _procesar_en_worker(nombre, contenido, ignore_patterns):
+    """Procesa una factura dentro de un proceso del lote y devuelve también los patrones aprendidos"""
+    archivo = BytesIO(contenido)
+    archivo.name = nombre
+    _patrones_worker.pendientes = []
+    _patrones_worker.usos = []
+    datos = extraer_datos_pdf(archivo, _patrones_worker, ignore_patterns=ignore_patterns)
+    return datos, _patrones_worker.pendientes, _patrones_worker.usos
+
+
+def _error_motor_worker():
+    """Motivo por el que un proceso del lote no usa tesserocr (None si lo usa)"""
+    try:
+        MotorOCRTesserocr(OCR_IDIOMA)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def _modulo_importable():
+    """
+    Devuelve este módulo de forma que los procesos hijos puedan importarlo.
+    Streamlit ejecuta el script como __main__, que no es importable desde otro proceso.
+    """
+    if __name__ != "__main__":
+        return sys.modules[__name__]
+    return importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
 
-def aplicar_estilo_encabezado(ws, row, col_start, col_end):
-    """Aplica estilos a las celdas de encabezado"""
-    header_fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+
+def procesar_lote(archivos, patrones_manager, ignore_patterns=False, max_procesos=1, al_completar=None,
+                  cache=None, usar_cache=True):
+    """
+    Procesa un lote de facturas, en paralelo si max_procesos > 1.
+    Devuelve los resultados en el mismo orden en que se subieron los archivos.
+    al_completar(completados, total, nombre) se llama cada vez que termina una factura.
+    Si se pasa una CacheExtracciones, los PDFs ya procesados con la misma
+    configuración se devuelven sin volver a extraerlos (salvo que usar_cache sea False,
+    en cuyo caso sólo se actualiza la caché con los resultados nuevos).
+    """
+    total = len(archivos)
+    resultados = [None] * total
+    completados = 0
+    
+    # Leer los bytes una sola vez: sirven para la clave de caché y para los procesos del lote
+    contenidos = []
+    for archivo in archivos:
+        archivo.seek(0)
+        contenidos.append(archivo.read())
+        archivo.seek(0)
+    
+    claves = [None] * total
+    if cache is not None:
+        configuracion = configuracion_extraccion()
+        for idx, archivo in enumerate(archivos):
+            claves[idx] = cache.clave(contenidos[idx], configuracion, ignore_patterns)
+            datos = cache.obtener(claves[idx]) if usar_cache else None
+            if datos is not None:
+                # El mismo PDF puede haberse subido con otro nombre
+                datos['Nombre_Archivo'] = archivo.name
+                resultados[idx] = datos
+                completados += 1
+                if al_completar:
+                    al_completar(completados, total, archivo.name)
+    
+    def registrar_resultado(idx, datos):
+        nonlocal completados
+        resultados[idx] = datos
+        if datos.get('Patrones_Omitidos'):
+            st.warning(f"{archivos[idx].name}: patrones omitidos por exceder {PRESUPUESTO_PATRON_MS} ms "
+                       f"({', '.join(datos['Patrones_Omitidos'])}). El resultado no se guarda en la caché.")
+        if cache is not None and resultado_reproducible(datos):
+            cache.guardar(claves[idx], datos)
+        completados += 1
+        if al_completar:
+            al_completar(completados, total, archivos[idx].name)
+    
+    pendientes_idx = [idx for idx in range(total) if resultados[idx] is None]
+    procesos = min(max_procesos, len(pendientes_idx))
+    # Si tesserocr sólo se puede cargar en un hilo principal, el OCR en proceso necesita al menos un proceso del lote
+    usar_tesserocr = USE_TESSERACT_OCR and OCR_MOTOR in ('auto', 'tesserocr') and TESSEROCR_PENDIENTE
+    if procesos > 1 or (procesos == 1 and usar_tesserocr):
+        try:
+            modulo = _modulo_importable()
+            with ProcessPoolExecutor(max_workers=procesos,
+                                     initializer=modulo._inicializar_worker,
+                                     initargs=(patrones_manager.ruta_archivo, configuracion_extraccion(),
+                                               # Repartir los núcleos entre procesos para no sobresuscribir con hilos de OCR
+                                               max(1, min(OCR_HILOS_POR_DOCUMENTO, (os.cpu_count() or 1) // procesos)))) as executor:
+                if USE_TESSERACT_OCR and OCR_MOTOR == 'tesserocr':
+                    # Los avisos de los procesos del lote no llegan a la interfaz: preguntar qué motor quedó
+                    error_motor = executor.submit(modulo._error_motor_worker).result()
+                    if error_motor:
+                        st.warning(f"No se pudo iniciar tesserocr en los procesos del lote ({error_motor}). Se usa pytesseract.")
+                
+                futuros = {}
+                for idx in pendientes_idx:
+                    futuro = executor.submit(modulo._procesar_en_worker, archivos[idx].name, contenidos[idx], ignore_patterns)
+                    futuros[futuro] = idx
+                
+                for futuro in as_completed(futuros):
+                    idx = futuros[futuro]
+                    datos, pendientes, usos = futuro.result()
+                    
+                    # Los patrones aprendidos y sus aciertos se guardan sólo desde este proceso, de a uno
+                    for id_patron in usos:
+                        patrones_manager.registrar_uso(id_patron)
+                    for datos_patron, texto_muestra, metodo in pendientes:
+                        patrones_manager.agregar_patron(datos_patron, texto_muestra, metodo)
+                    
+                    registrar_resultado(idx, datos)
+        except Exception as e:
+            st.warning(f"No se pudo procesar en paralelo ({str(e)}). Se continúa de forma secuencial.")
+    
+    # Procesamiento secuencial (o lo que haya quedado pendiente si falló el paralelo)
+    for idx in pendientes_idx:
+        if resultados[idx] is not None:
+            continue
+        registrar_resultado(idx, extraer_datos_pdf(archivos[idx], patrones_manager, ignore_patterns=ignore_patterns))
     
-    for col in range(col_start, col_end + 1):
-        cell = ws.cell(row=row, column=col)
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = header_alignment
+    return resultados
+
+
+FORMATO_MONEDA = '"$"#,##0.00'
+
+
+def registrar_estilos(wb):
+    """
+    Registra en el libro los estilos con nombre del Excel. Cada celda recibe uno solo
+    (una asignación por celda) en lugar de relleno, fuente, alineación y formato por separado.
+    """
+    fill_datos = PatternFill(start_color="E9EDF4", end_color="E9EDF4", fill_type="solid")
+    fill_totales = PatternFill(start_color="D8E4BC", end_color="D8E4BC", fill_type="solid")
+    estilos = [
+        NamedStyle(name="encabezado", font=Font(bold=True, color="FFFFFF"),
+                   fill=PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid"),
+                   alignment=Alignment(horizontal="center", vertical="center")),
+        NamedStyle(name="datos_texto", font=copy(DEFAULT_FONT), fill=fill_datos,
+                   alignment=Alignment(horizontal="left", vertical="center")),
+        NamedStyle(name="datos_moneda", font=copy(DEFAULT_FONT), fill=fill_datos,
+                   alignment=Alignment(horizontal="right", vertical="center"), number_format=FORMATO_MONEDA),
+        NamedStyle(name="totales", font=Font(bold=True), fill=fill_totales),
+        NamedStyle(name="totales_moneda", font=Font(bold=True), fill=fill_totales, number_format=FORMATO_MONEDA),
+        NamedStyle(name="totales_vacio", font=copy(DEFAULT_FONT), fill=fill_totales),
+    ]
+    for estilo in estilos:
+        wb.add_named_style(estilo)
+
 
+def aplicar_estilo_encabezado(celdas):
+    """Aplica el estilo de encabezado a las celdas"""
+    for cell in celdas:
+        cell.style = "encabezado"
+    return celdas
 
-def aplicar_estilo_datos(ws, row, col_start, col_end, es_moneda=False):
-    """Aplica estilos a las celdas de datos"""
-    data_fill = PatternFill(start_color="E9EDF4", end_color="E9EDF4", fill_type="solid")
-    data_alignment = Alignment(horizontal="right" if es_moneda else "left", vertical="center")
+
+def aplicar_estilo_datos(celdas, es_moneda=False):
+    """Aplica el estilo de datos (texto o moneda) a las celdas"""
+    estilo = "datos_moneda" if es_moneda else "datos_texto"
+    for cell in celdas:
+        cell.style = estilo
+    return celdas
+
+
+class AnchosColumnas:
+    """
+    Ancho máximo del contenido de cada columna, acumulado a medida que se arman las filas.
+    En modo de sólo escritura los anchos van antes que las filas: se aplican una vez,
+    con la hoja ya armada y antes de escribirla, sin volver a recorrer sus celdas.
+    """
     
-    for col in range(col_start, col_end + 1):
-        cell = ws.cell(row=row, column=col)
-        cell.fill = data_fill
-        cell.alignment = data_alignment
-        
-        # Formato de moneda para columnas numéricas
-        if es_moneda and col > 1:  # Excepto la columna de fecha
-            cell.number_format = '"$"#,##0.00'
+    def __init__(self):
+        self.maximos = []
+    
+    def registrar(self, valores):
+        """Acumula los anchos de una fila y la devuelve"""
+        faltantes = len(valores) - len(self.maximos)
+        if faltantes > 0:
+            self.maximos.extend([0] * faltantes)
+        for col, valor in enumerate(valores):
+            if valor:
+                largo = len(str(valor))
+                if largo > self.maximos[col]:
+                    self.maximos[col] = largo
+        return valores
+    
+    def aplicar(self, ws):
+        """Ajusta el ancho de las columnas según el contenido registrado"""
+        for col, max_length in enumerate(self.maximos, 1):
+            ws.column_dimensions[get_column_letter(col)].width = (max_length + 2) * 1.2
+
+
+def _celdas(ws, valores):
+    return [WriteOnlyCell(ws, value=valor) for valor in valores]
 
 
-def ajustar_ancho_columnas(ws):
-    """Ajusta el ancho de las columnas según el contenido"""
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        adjusted_width = (max_length + 2) * 1.2
-        ws.column_dimensions[column].width = adjusted_width
+def _filas_factura(datos, moneda, importes):
+    """Valores de la hoja de una factura, en formato de tabla vertical"""
+    conceptos = [
+        'Número de Factura', 
+        'Fecha', 
+        'Moneda',
+        'No Gravado', 
+        'Exento', 
+        'Gravado', 
+        'IVA', 
+        'TOTAL',
+        'Total a facturar'  # Cambio de "Método de extracción" a "Total a facturar"
+    ]
+    valores = [
+        datos['Numero_Factura'] or "N/D",
+        datos['Fecha'] or "N/D",
+        moneda,
+        *importes,
+        ""  # Celda en blanco para Total a facturar
+    ]
+    return [['CONCEPTO', 'VALOR']] + [list(par) for par in zip(conceptos, valores)]
 
 
-def generar_excel(datos_list):
+def generar_excel(datos_list, hoja_detalle=None):
     """
     Genera un solo archivo Excel en memoria con una pestaña por factura y pestañas de resumen por moneda.
+    El libro es de sólo escritura: cada fila se vuelca a disco al agregarla, así la memoria
+    no crece con la cantidad de celdas.
+    
+    Con hoja_detalle (por defecto, desde UMBRAL_HOJA_DETALLE facturas) los conceptos de todas
+    las facturas van en una única hoja "Detalle" con filtros, en lugar de una hoja por factura.
     """
+    if hoja_detalle is None:
+        hoja_detalle = len(datos_list) >= UMBRAL_HOJA_DETALLE
     output = BytesIO()
-    wb = Workbook()
-    
-    # Eliminar la hoja por defecto al principio
-    default_sheet = wb.active
-    wb.remove(default_sheet)
-    
-    # Agrupar facturas por moneda
-    facturas_por_moneda = {}
+    wb = Workbook(write_only=True)
+    registrar_estilos(wb)
+    
+    # Armar en una sola pasada las filas de los resúmenes, midiendo los anchos de paso
+    encabezados_global = ['FACTURA', 'FECHA', 'MONEDA', 'NO GRAVADO', 'EXENTO', 'GRAVADO', 'IVA', 'TOTAL', 'TOTAL A FACTURAR']
+    encabezados_moneda = ['FACTURA', 'FECHA', 'NO GRAVADO', 'EXENTO', 'GRAVADO', 'IVA', 'TOTAL', 'TOTAL A FACTURAR']
+    anchos_global = AnchosColumnas()
+    anchos_global.registrar(encabezados_global)
+    facturas_por_moneda = {}  # moneda -> {'facturas', 'filas', 'anchos', 'totales'}
     for datos in datos_list:
         moneda = datos.get('Moneda', 'Desconocida')
         if moneda not in facturas_por_moneda:
-            facturas_por_moneda[moneda] = []
-        facturas_por_moneda[moneda].append(datos)
+            anchos = AnchosColumnas()
+            anchos.registrar(encabezados_moneda)
+            facturas_por_moneda[moneda] = {'facturas': [], 'filas': [], 'anchos': anchos, 'totales': [0.0] * 5}
+        grupo = facturas_por_moneda[moneda]
+        
+        # Asegurarse de que todos los valores numéricos sean float
+        importes = [float(datos['No_Gravado']), float(datos['Exento']), float(datos['Gravado']),
+                    float(datos['IVA']), float(datos['Total'])]
+        factura = datos['Numero_Factura'] or os.path.basename(datos['Nombre_Archivo'])
+        grupo['facturas'].append((datos, importes))
+        grupo['filas'].append(grupo['anchos'].registrar(
+            [factura, datos['Fecha'], *importes, ""]))  # Celda en blanco para Total a facturar
+        # Acumular sumatorias de la moneda
+        grupo['totales'] = [total + importe for total, importe in zip(grupo['totales'], importes)]
+    
+    # El resumen global lista las facturas agrupadas por moneda
+    filas_global = []
+    for moneda, grupo in facturas_por_moneda.items():
+        for fila in grupo['filas']:
+            filas_global.append(anchos_global.registrar([fila[0], fila[1], moneda, *fila[2:]]))
+        grupo['fila_totales'] = grupo['anchos'].registrar([f"TOTALES {moneda}", None, *grupo['totales'], None])
     
     # Crear una hoja de resumen global primero
     resumen_global = wb.create_sheet(title="Resumen Global")
-    
-    # Configurar encabezados del resumen global
-    encabezados_resumen = ['FACTURA', 'FECHA', 'MONEDA', 'NO GRAVADO', 'EXENTO', 'GRAVADO', 'IVA', 'TOTAL', 'TOTAL A FACTURAR']
-    for col_idx, header in enumerate(encabezados_resumen, 1):
-        resumen_global.cell(row=1, column=col_idx, value=header)
-    
-    aplicar_estilo_encabezado(resumen_global, 1, 1, len(encabezados_resumen))
+    anchos_global.aplicar(resumen_global)
+    resumen_global.append(aplicar_estilo_encabezado(_celdas(resumen_global, encabezados_global)))
     
     # Añadir todas las facturas al resumen global
-    fila_global = 2
-    for moneda, facturas in facturas_por_moneda.items():
-        for datos in facturas:
-            resumen_global.cell(row=fila_global, column=1, value=datos['Numero_Factura'] or os.path.basename(datos['Nombre_Archivo']))
-            resumen_global.cell(row=fila_global, column=2, value=datos['Fecha'])
-            resumen_global.cell(row=fila_global, column=3, value=moneda)
-            resumen_global.cell(row=fila_global, column=4, value=float(datos['No_Gravado']))
-            resumen_global.cell(row=fila_global, column=5, value=float(datos['Exento']))
-            resumen_global.cell(row=fila_global, column=6, value=float(datos['Gravado']))
-            resumen_global.cell(row=fila_global, column=7, value=float(datos['IVA']))
-            resumen_global.cell(row=fila_global, column=8, value=float(datos['Total']))
-            resumen_global.cell(row=fila_global, column=9, value="")  # Celda en blanco para Total a Facturar
-            
-            # Aplicar formato monetario a las celdas numéricas
-            for col in range(4, 9):
-                resumen_global.cell(row=fila_global, column=col).number_format = '"$"#,##0.00'
-            
-            # También aplicar formato monetario a la celda de Total a Facturar
-            resumen_global.cell(row=fila_global, column=9).number_format = '"$"#,##0.00'
-            
-            # Aplicar estilos
-            aplicar_estilo_datos(resumen_global, fila_global, 1, 3, False)
-            aplicar_estilo_datos(resumen_global, fila_global, 4, 9, True)  # Incluir la nueva columna
-            
-            fila_global += 1
+    for valores in filas_global:
+        celdas = _celdas(resumen_global, valores)
+        aplicar_estilo_datos(celdas[:3], False)
+        aplicar_estilo_datos(celdas[3:], True)  # Importes y Total a Facturar
+        resumen_global.append(celdas)
+    resumen_global.close()
+    
+    encabezados_detalle = ['FACTURA', 'MONEDA', 'CONCEPTO', 'VALOR']
+    anchos_detalle = AnchosColumnas()
+    anchos_detalle.registrar(encabezados_detalle)
+    filas_detalle = []
     
     # Procesar cada moneda por separado
-    for moneda, facturas in facturas_por_moneda.items():
-        # Crear hoja de resumen para esta moneda
+    for moneda, grupo in facturas_por_moneda.items():
+        # Crear hoja de resumen para esta moneda; sus filas se agregan a medida que se crean las hojas de factura
         nombre_resumen = f"Resumen {moneda}"
         resumen_sheet = wb.create_sheet(title=nombre_resumen)
-        
-        # Configurar encabezados del resumen
-        encabezados_resumen = ['FACTURA', 'FECHA', 'NO GRAVADO', 'EXENTO', 'GRAVADO', 'IVA', 'TOTAL', 'TOTAL A FACTURAR']
-        for col_idx, header in enumerate(encabezados_resumen, 1):
-            resumen_sheet.cell(row=1, column=col_idx, value=header)
-        
-        aplicar_estilo_encabezado(resumen_sheet, 1, 1, len(encabezados_resumen))
-        
-        # Inicializar sumatorias para esta moneda
-        total_no_gravado = 0.0
-        total_exento = 0.0
-        total_gravado = 0.0
-        total_iva = 0.0
-        total_total = 0.0
+        grupo['anchos'].aplicar(resumen_sheet)
+        resumen_sheet.append(aplicar_estilo_encabezado(_celdas(resumen_sheet, encabezados_moneda)))
         
         # Procesar cada factura de esta moneda
-        for i, datos in enumerate(facturas):
-            # Crear hoja para la factura actual
-            sheet_name = datos['Numero_Factura'] or os.path.basename(datos['Nombre_Archivo']).replace('.pdf', '')[:31]
-            # Añadir un sufijo a la hoja para evitar nombres duplicados
-            if moneda != 'Desconocida':
-                sheet_name = f"{sheet_name}_{moneda}"
-            
-            ws = wb.create_sheet(title=sheet_name)
-            
-            # Configurar encabezados de la factura
-            headers = ['CONCEPTO', 'VALOR']
-            for col_idx, header in enumerate(headers, 1):
-                ws.cell(row=1, column=col_idx, value=header)
-            
-            aplicar_estilo_encabezado(ws, 1, 1, 2)
-            
-            # Agregar datos de factura en formato de tabla vertical
-            conceptos = [
-                'Número de Factura', 
-                'Fecha', 
-                'Moneda',
-                'No Gravado', 
-                'Exento', 
-                'Gravado', 
-                'IVA', 
-                'TOTAL',
-                'Total a facturar'  # Cambio de "Método de extracción" a "Total a facturar"
-            ]
-            
-            # Asegurarse de que todos los valores numéricos sean float
-            no_gravado = float(datos['No_Gravado'])
-            exento = float(datos['Exento'])
-            gravado = float(datos['Gravado'])
-            iva = float(datos['IVA'])
-            total = float(datos['Total'])
-            
-            valores = [
-                datos['Numero_Factura'] or "N/D",
-                datos['Fecha'] or "N/D",
-                moneda,
-                no_gravado,
-                exento,
-                gravado,
-                iva,
-                total,
-                ""  # Celda en blanco para Total a facturar
-            ]
-            
-            for j, (concepto, valor) in enumerate(zip(conceptos, valores), 2):
-                ws.cell(row=j, column=1, value=concepto)
-                ws.cell(row=j, column=2, value=valor)
+        for (datos, importes), valores_resumen in zip(grupo['facturas'], grupo['filas']):
+            if hoja_detalle:
+                # Una fila por concepto, identificada por la factura (número y moneda ya son columnas)
+                for concepto, valor in _filas_factura(datos, moneda, importes)[1:]:
+                    if concepto not in ('Número de Factura', 'Moneda'):
+                        filas_detalle.append(anchos_detalle.registrar([valores_resumen[0], moneda, concepto, valor]))
+            else:
+                # Crear hoja para la factura actual
+                sheet_name = datos['Numero_Factura'] or os.path.basename(datos['Nombre_Archivo']).replace('.pdf', '')[:31]
+                # Añadir un sufijo a la hoja para evitar nombres duplicados
+                if moneda != 'Desconocida':
+                    sheet_name = f"{sheet_name}_{moneda}"
                 
-                # Aplicar formato condicional
-                if j >= 5 and j <= 8:  # Campos monetarios (No Gravado, Exento, Gravado, IVA, TOTAL)
-                    ws.cell(row=j, column=2).number_format = '"$"#,##0.00'
+                ws = wb.create_sheet(title=sheet_name)
+                anchos = AnchosColumnas()
+                filas_factura = [anchos.registrar(fila) for fila in _filas_factura(datos, moneda, importes)]
+                anchos.aplicar(ws)
                 
-                # También aplicar formato monetario a Total a facturar (celda 9)
-                if j == 9:  # Total a facturar
-                    ws.cell(row=j, column=2).number_format = '"$"#,##0.00'
-            
-            # Aplicar estilos a las celdas de datos
-            for j in range(2, len(conceptos) + 2):
-                aplicar_estilo_datos(ws, j, 1, 1, False)
-                aplicar_estilo_datos(ws, j, 2, 2, j >= 5)  # Aplicar estilo monetario a todos los valores numéricos
-            
-            # Ajustar ancho de columnas
-            ajustar_ancho_columnas(ws)
+                ws.append(aplicar_estilo_encabezado(_celdas(ws, filas_factura[0])))
+                for j, valores in enumerate(filas_factura[1:], 2):
+                    celdas = _celdas(ws, valores)
+                    aplicar_estilo_datos(celdas[:1], False)
+                    aplicar_estilo_datos(celdas[1:], j >= 5)  # Estilo monetario desde No Gravado hasta Total a facturar
+                    ws.append(celdas)
+                ws.close()
             
             # Agregar datos a la hoja de resumen de esta moneda
-            resumen_sheet.cell(row=i+2, column=1, value=datos['Numero_Factura'] or os.path.basename(datos['Nombre_Archivo']))
-            resumen_sheet.cell(row=i+2, column=2, value=datos['Fecha'])
-            resumen_sheet.cell(row=i+2, column=3, value=no_gravado)
-            resumen_sheet.cell(row=i+2, column=4, value=exento)
-            resumen_sheet.cell(row=i+2, column=5, value=gravado)
-            resumen_sheet.cell(row=i+2, column=6, value=iva)
-            resumen_sheet.cell(row=i+2, column=7, value=total)
-            resumen_sheet.cell(row=i+2, column=8, value="")  # Celda en blanco para Total a facturar
-            
-            # Aplicar formato monetario a las celdas de la hoja de resumen
-            for col in range(3, 8):
-                resumen_sheet.cell(row=i+2, column=col).number_format = '"$"#,##0.00'
-            
-            # También aplicar formato monetario a Total a facturar
-            resumen_sheet.cell(row=i+2, column=8).number_format = '"$"#,##0.00'
-            
-            # Aplicar estilos a la fila de resumen
-            aplicar_estilo_datos(resumen_sheet, i+2, 1, 2, False)
-            aplicar_estilo_datos(resumen_sheet, i+2, 3, 8, True)
-            
-            # Acumular sumatorias con conversión explícita a float
-            total_no_gravado += no_gravado
-            total_exento += exento
-            total_gravado += gravado
-            total_iva += iva
-            total_total += total
+            celdas = _celdas(resumen_sheet, valores_resumen)
+            aplicar_estilo_datos(celdas[:2], False)
+            aplicar_estilo_datos(celdas[2:], True)
+            resumen_sheet.append(celdas)
         
         # Agregar fila de totales en la hoja de resumen con valores calculados directamente
-        ultima_fila = len(facturas) + 2
-        resumen_sheet.cell(row=ultima_fila, column=1, value=f"TOTALES {moneda}")
-        resumen_sheet.cell(row=ultima_fila, column=1).font = Font(bold=True)
-        
-        # Insertar totales calculados
-        totales = [total_no_gravado, total_exento, total_gravado, total_iva, total_total]
-        for idx, total in enumerate(totales):
-            col = idx + 3  # Comenzando desde la columna 3 (NO GRAVADO)
-            # Usar un valor numérico explícito
-            resumen_sheet.cell(row=ultima_fila, column=col, value=float(total))
-            resumen_sheet.cell(row=ultima_fila, column=col).font = Font(bold=True)
-            resumen_sheet.cell(row=ultima_fila, column=col).number_format = '"$"#,##0.00'
-            
-            # Aplica un fondo diferente para los totales
-            resumen_sheet.cell(row=ultima_fila, column=col).fill = PatternFill(start_color="D8E4BC", end_color="D8E4BC", fill_type="solid")
-        
-        # También aplicar estilo a las celdas adicionales de la fila de totales
-        resumen_sheet.cell(row=ultima_fila, column=1).fill = PatternFill(start_color="D8E4BC", end_color="D8E4BC", fill_type="solid")
-        resumen_sheet.cell(row=ultima_fila, column=2).fill = PatternFill(start_color="D8E4BC", end_color="D8E4BC", fill_type="solid")
-        resumen_sheet.cell(row=ultima_fila, column=8).fill = PatternFill(start_color="D8E4BC", end_color="D8E4BC", fill_type="solid")
-        
-        # Ajustar ancho de columnas en la hoja de resumen
-        ajustar_ancho_columnas(resumen_sheet)
-    
-    # Ajustar ancho de columnas en la hoja de resumen global
-    ajustar_ancho_columnas(resumen_global)
+        celdas = _celdas(resumen_sheet, grupo['fila_totales'])
+        for cell, estilo in zip(celdas, ["totales", "totales_vacio"] + ["totales_moneda"] * 5 + ["totales_vacio"]):
+            cell.style = estilo
+        resumen_sheet.append(celdas)
+        resumen_sheet.close()
+    
+    if hoja_detalle:
+        # Tabla única con el desglose de todas las facturas, filtrable por factura, moneda o concepto
+        detalle = wb.create_sheet(title="Detalle")
+        anchos_detalle.aplicar(detalle)
+        detalle.freeze_panes = "A2"
+        detalle.auto_filter.ref = f"A1:D{len(filas_detalle) + 1}"
+        detalle.append(aplicar_estilo_encabezado(_celdas(detalle, encabezados_detalle)))
+        for valores in filas_detalle:
+            celdas = _celdas(detalle, valores)
+            aplicar_estilo_datos(celdas[:3], False)
+            aplicar_estilo_datos(celdas[3:], valores[2] != 'Fecha')
+            detalle.append(celdas)
+        detalle.close()
     
     wb.save(output)
     output.seek(0)
     return output
 
+# Exportación en formatos de columnas: una fila por factura, escrita a medida que se recorre el lote
+COLUMNAS_EXPORTACION = ('Nombre_Archivo', 'Numero_Factura', 'Fecha', 'Moneda',
+                        'No_Gravado', 'Exento', 'Gravado', 'IVA', 'Total', 'Metodo')
+COLUMNAS_IMPORTE_EXPORTACION = ('No_Gravado', 'Exento', 'Gravado', 'IVA', 'Total')
+FILAS_POR_GRUPO_PARQUET = 10000  # Filas que se juntan en memoria antes de escribir cada grupo del Parquet
+
+
+def _registros_exportacion(datos_list):
+    """Genera los registros a exportar, con las columnas fijas y los importes como float"""
+    for datos in datos_list:
+        registro = {}
+        for columna in COLUMNAS_EXPORTACION:
+            valor = datos.get(columna)
+            if columna in COLUMNAS_IMPORTE_EXPORTACION:
+                valor = float(valor or 0.0)
+            elif columna == 'Nombre_Archivo' and valor:
+                valor = os.path.basename(valor)
+            elif valor is not None:
+                valor = str(valor)
+            registro[columna] = valor
+        if registro['Moneda'] is None:
+            registro['Moneda'] = 'Desconocida'
+        yield registro
+
+
+def exportar_csv(datos_list, destino=None):
+    """Escribe las facturas en CSV (UTF-8) sobre destino, un archivo binario; por defecto, en memoria"""
+    output = destino if destino is not None else BytesIO()
+    texto = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    escritor = csv.DictWriter(texto, fieldnames=COLUMNAS_EXPORTACION)
+    escritor.writeheader()
+    for registro in _registros_exportacion(datos_list):
+        escritor.writerow(registro)
+    texto.flush()
+    texto.detach()  # Que cerrar el envoltorio no cierre el destino
+    if destino is None:
+        output.seek(0)
+    return output
+
+
+def exportar_jsonl(datos_list, destino=None):
+    """Escribe las facturas en JSON Lines (un objeto por línea) sobre destino; por defecto, en memoria"""
+    output = destino if destino is not None else BytesIO()
+    for registro in _registros_exportacion(datos_list):
+        output.write(json.dumps(registro, ensure_ascii=False).encode('utf-8') + b'\n')
+    if destino is None:
+        output.seek(0)
+    return output
+
+
+def exportar_parquet(datos_list, destino=None):
+    """
+    Escribe las facturas en Parquet sobre destino (por defecto, en memoria), de a
+    FILAS_POR_GRUPO_PARQUET filas por grupo. Requiere pyarrow.
+    """
+    if pa is None:
+        raise RuntimeError("Para exportar a Parquet hace falta instalar pyarrow")
+    esquema = pa.schema([(columna, pa.float64() if columna in COLUMNAS_IMPORTE_EXPORTACION else pa.string())
+                         for columna in COLUMNAS_EXPORTACION])
+    output = destino if destino is not None else BytesIO()
+    with pq.ParquetWriter(output, esquema) as escritor:
+        grupo = []
+        for registro in _registros_exportacion(datos_list):
+            grupo.append(registro)
+            if len(grupo) >= FILAS_POR_GRUPO_PARQUET:
+                escritor.write_batch(pa.RecordBatch.from_pylist(grupo, schema=esquema))
+                grupo = []
+        if grupo:
+            escritor.write_batch(pa.RecordBatch.from_pylist(grupo, schema=esquema))
+    if destino is None:
+        output.seek(0)
+    return output
+
+
+# Formato -> (exportador, extensión, tipo MIME) para los botones de descarga y la línea de comandos
+FORMATOS_EXPORTACION = {
+    'CSV': (exportar_csv, 'csv', 'text/csv'),
+    'JSON Lines': (exportar_jsonl, 'jsonl', 'application/x-ndjson'),
+    'Parquet': (exportar_parquet, 'parquet', 'application/vnd.apache.parquet'),
+}
+
+
 def eliminar_duplicados_simple(datos_list):
     """Elimina duplicados comparando números de factura"""
     # Paso 1: Crear un diccionario de facturas por número
@@ -2103,14 +2880,33 @@ def eliminar_duplicados_simple(datos_list):
 
 
 
+@st.cache_resource(show_spinner=False)
+def cargar_patrones_facturas(ruta_archivo='patrones_facturas.db'):
+    """
+    Almacén de patrones abierto una sola vez por proceso del servidor. Lo comparten todas
+    las sesiones (es seguro entre hilos) y se pone al día solo con lo que escriben otros procesos.
+    """
+    return PatronesFacturas(ruta_archivo)
+
+
+@st.cache_resource(show_spinner=False)
+def verificar_tesseract():
+    """Error al consultar la versión de Tesseract, o None si está disponible (se consulta una sola vez)"""
+    try:
+        pytesseract.get_tesseract_version()
+        return None
+    except Exception as e:
+        return str(e)
+
+
 def main():
     st.set_page_config(page_title="Extractor de Facturas", page_icon="📊", layout="wide")
     
     st.title("📊 Extractor Inteligente de Datos de Facturas")
     st.markdown("Sistema de extracción híbrido para procesar facturas y generar Excel con separación por monedas")
     
-    # Inicializar el administrador de patrones
-    patrones_manager = PatronesFacturas()
+    # Administrador de patrones compartido (no se vuelve a cargar en cada interacción)
+    patrones_manager = cargar_patrones_facturas()
     
     # Sidebar con configuraciones
     with st.sidebar:
@@ -2120,15 +2916,40 @@ def main():
         st.subheader("Métodos de extracción")
         use_tesseract = st.checkbox("Usar OCR avanzado (Tesseract)", value=True)
         use_patterns = st.checkbox("Usar reconocimiento de patrones", value=True)
+        priorizar_texto = st.checkbox("Priorizar capa de texto", value=True,
+                                      help="Usa OCR sólo si la capa de texto del PDF no trae número, fecha y total conciliados")
+        ocr_regiones = st.checkbox("OCR por regiones (encabezado y totales)", value=True,
+                                   help="Reconoce sólo los bloques con los datos buscados y usa la página completa si faltan campos")
+        motor_ocr = st.selectbox("Motor de OCR", ["auto", "tesserocr", "subproceso"],
+                                 help="tesserocr mantiene Tesseract cargado en memoria; 'subproceso' usa pytesseract")
+        if motor_ocr == "tesserocr" and tesserocr is None and not TESSEROCR_PENDIENTE:
+            st.warning(f"{ERROR_TESSEROCR}. Se usa pytesseract.")
         
         # NUEVA OPCIÓN: Ignorar patrones guardados
         ignore_patterns = st.checkbox("Ignorar patrones guardados", value=False, 
                                     help="Activa esta opción para procesar las facturas sin usar patrones guardados")
         
         # Para activar/desactivar características
-        global USE_TESSERACT_OCR, USE_PATTERN_MATCHING
+        global USE_TESSERACT_OCR, USE_PATTERN_MATCHING, PRIORIZAR_CAPA_TEXTO, OCR_POR_REGIONES, OCR_MOTOR
         USE_TESSERACT_OCR = use_tesseract
         USE_PATTERN_MATCHING = use_patterns
+        PRIORIZAR_CAPA_TEXTO = priorizar_texto
+        OCR_POR_REGIONES = ocr_regiones
+        OCR_MOTOR = motor_ocr
+        
+        # Procesamiento del lote
+        st.subheader("Rendimiento")
+        max_procesos = st.number_input("Procesos en paralelo", min_value=1, max_value=MAX_PROCESOS_LOTE,
+                                       value=MAX_PROCESOS_LOTE, step=1,
+                                       help="Cantidad de facturas que se procesan al mismo tiempo")
+        
+        global UMBRAL_HOJA_DETALLE
+        UMBRAL_HOJA_DETALLE = st.number_input("Hoja única de detalle desde (facturas)", min_value=1,
+                                              value=UMBRAL_HOJA_DETALLE, step=50,
+                                              help="Con más facturas, el Excel lleva una hoja 'Detalle' en lugar de una hoja por factura")
+        
+        omitir_cache = st.checkbox("Omitir caché de resultados", value=False,
+                                   help="Vuelve a extraer todas las facturas aunque ya se hayan procesado antes")
         
         # Modo depuración
         st.subheader("Depuración")
@@ -2136,12 +2957,22 @@ def main():
         
         # Información sobre patrones aprendidos
         st.subheader("Base de conocimiento")
+        patrones_manager.refrescar()  # Incluir lo aprendido por otras sesiones
+        # La base se comparte entre reruns y sesiones: los valores se aplican sobre la instancia, no en globales
+        capacidad = st.number_input("Capacidad de patrones", min_value=10, value=CAPACIDAD_PATRONES, step=100,
+                                    help=f"Al superarla se descartan los patrones necesarios para bajar un {FRACCION_EXPULSION:.0%} por debajo, según la política de expulsión")
+        politica_expulsion = st.selectbox("Política de expulsión", ["lru", "lfu"],
+                                          index=["lru", "lfu"].index(POLITICA_EXPULSION),
+                                          help="lru: el usado hace más tiempo; lfu: el de menos aciertos")
+        patrones_manager.configurar(capacidad=int(capacidad), politica_expulsion=politica_expulsion)
         patrones_count = len(patrones_manager.patrones)
-        st.write(f"Patrones aprendidos: {patrones_count}")
+        st.write(f"Patrones aprendidos: {patrones_count} / {patrones_manager.capacidad} "
+                 f"(expulsión {patrones_manager.politica_expulsion.upper()})")
         
         if st.button("Reiniciar base de conocimiento"):
-            patrones_manager.patrones = {}
-            patrones_manager.guardar_patrones()
+            patrones_manager.reiniciar()
+            # La próxima ejecución abre el almacén desde cero
+            cargar_patrones_facturas.clear()
             st.success("Base de conocimiento reiniciada")
     
     # Contenido principal
@@ -2163,12 +2994,10 @@ def main():
     
     # Verificar si Tesseract está instalado
     if USE_TESSERACT_OCR:
-        try:
-            import pytesseract
-            pytesseract.get_tesseract_version()
-        except Exception as e:
+        error_tesseract = verificar_tesseract()
+        if error_tesseract:
             st.warning(f"""
-            ⚠️ Tesseract OCR no está instalado o configurado correctamente: {str(e)}
+            ⚠️ Tesseract OCR no está instalado o configurado correctamente: {error_tesseract}
             
             Para usarlo necesitas:
             1. Instalar Tesseract OCR en tu sistema
@@ -2180,32 +3009,48 @@ def main():
     # Subir archivos
     archivos_pdf = st.file_uploader("Selecciona archivos PDF de facturas", type="pdf", accept_multiple_files=True)
     
+    # Si cambian los archivos subidos, los resultados guardados de la sesión dejan de valer
+    # (file_id es distinto en cada subida, aunque el archivo nuevo tenga el mismo nombre y tamaño)
+    firma_lote = [archivo.file_id for archivo in archivos_pdf] if archivos_pdf else None
+    if st.session_state.get('firma_lote') != firma_lote:
+        for clave in ('lote_procesado', 'excel_generado', 'exportaciones'):
+            st.session_state.pop(clave, None)
+        st.session_state['firma_lote'] = firma_lote
+    
     if archivos_pdf:
         st.info(f"Se han cargado {len(archivos_pdf)} archivo(s). Presiona 'Procesar Facturas' para continuar.")
         
         if st.button("Procesar Facturas", type="primary"):
-            datos_list = []
-            
             progress_bar = st.progress(0)
             progress_text = st.empty()
             
-            for idx, archivo in enumerate(archivos_pdf):
-                progress_text.text(f"Procesando {archivo.name}... ({idx+1}/{len(archivos_pdf)})")
-                progress_bar.progress((idx + 0.5) / len(archivos_pdf))
-                
-                # Aplicar el sistema de cascada de extracción
-                with st.spinner(f"Analizando {archivo.name}..."):
-                    # Usar el parámetro ignore_patterns
-                    datos = extraer_datos_pdf(archivo, patrones_manager, ignore_patterns=ignore_patterns)
-                    datos_list.append(datos)
-                
-                progress_bar.progress((idx + 1) / len(archivos_pdf))
+            def actualizar_progreso(completados, total, nombre):
+                progress_text.text(f"Procesado {nombre} ({completados}/{total})")
+                progress_bar.progress(completados / total)
+            
+            # Aplicar el sistema de cascada de extracción a todo el lote
+            with st.spinner(f"Analizando {len(archivos_pdf)} factura(s)..."):
+                datos_list = procesar_lote(archivos_pdf, patrones_manager, ignore_patterns=ignore_patterns,
+                                           max_procesos=int(max_procesos), al_completar=actualizar_progreso,
+                                           cache=CacheExtracciones(), usar_cache=not omitir_cache)
             
             progress_text.text("¡Procesamiento completado!")
             
             # NUEVA LÍNEA: Eliminar duplicados antes de mostrar resultados
             datos_list = eliminar_duplicados_simple(datos_list)
             
+            # Guardar el lote en la sesión: los reruns de Streamlit (edición, pestañas,
+            # descarga) sólo vuelven a dibujar, sin repetir la extracción
+            st.session_state['lote_procesado'] = datos_list
+            for clave in ('excel_generado', 'exportaciones'):
+                st.session_state.pop(clave, None)
+            # Un lote nuevo descarta las ediciones del editor anterior
+            st.session_state['version_lote'] = st.session_state.get('version_lote', 0) + 1
+        
+        if 'lote_procesado' in st.session_state:
+            # Copias de los resultados originales: las ediciones se aplican sobre ellas en cada rerun
+            datos_list = [dict(datos) for datos in st.session_state['lote_procesado']]
+            
             # Mostrar vista previa de datos extraídos
             if datos_list:
                 st.success(f"Se procesaron {len(datos_list)} facturas correctamente.")
@@ -2244,6 +3089,7 @@ def main():
                     # Crear una copia editable del DataFrame
                     edited_df = st.data_editor(
                         df_editable,
+                        key=f"editor_lote_{st.session_state.get('version_lote', 0)}",
                         use_container_width=True,
                         column_config={
                             "Moneda": st.column_config.SelectboxColumn(
@@ -2336,18 +3182,158 @@ def main():
                             col4.metric("IVA", f"${totales_moneda['IVA']:.2f}")
                             col5.metric("TOTAL", f"${totales_moneda['Total']:.2f}")
                 
-                # Generar y descargar Excel
-                excel_file = generar_excel(datos_list)
+                # Generar el Excel sólo cuando cambian los datos editados; si no, reutilizar el de la sesión
+                firma_edicion = hashlib.sha256((edited_df.to_json() + str(UMBRAL_HOJA_DETALLE)).encode('utf-8')).hexdigest()
+                excel_generado = st.session_state.get('excel_generado')
+                if not excel_generado or excel_generado[0] != firma_edicion:
+                    excel_generado = (firma_edicion, generar_excel(datos_list).getvalue())
+                    st.session_state['excel_generado'] = excel_generado
                 
                 # Botón para descargar el Excel
                 st.download_button(
                     label="Descargar Excel",
-                    data=excel_file,
+                    data=excel_generado[1],
                     file_name=f"Facturas_por_Moneda_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 )
+                
+                # Formatos de columnas para procesos posteriores (también se regeneran sólo si cambian los datos)
+                exportaciones = st.session_state.get('exportaciones')
+                if not exportaciones or exportaciones[0] != firma_edicion:
+                    exportaciones = (firma_edicion, {
+                        formato: exportador(datos_list).getvalue()
+                        for formato, (exportador, _, _) in FORMATOS_EXPORTACION.items()
+                        if formato != 'Parquet' or pa is not None
+                    })
+                    st.session_state['exportaciones'] = exportaciones
+                
+                marca_tiempo = datetime.now().strftime('%Y%m%d_%H%M%S')
+                for columna, (formato, (_, extension, mime)) in zip(st.columns(len(FORMATOS_EXPORTACION)),
+                                                                    FORMATOS_EXPORTACION.items()):
+                    if formato in exportaciones[1]:
+                        columna.download_button(
+                            label=f"Descargar {formato}",
+                            data=exportaciones[1][formato],
+                            file_name=f"Facturas_{marca_tiempo}.{extension}",
+                            mime=mime,
+                        )
+                    else:
+                        columna.caption(f"{formato}: instalar pyarrow para habilitarlo")
             else:
                 st.error("No se pudo extraer datos de ninguna factura.")
 
+def verificar_etiquetas_en_linea():
+    """
+    Casos de regresión del índice de etiquetas con varias etiquetas en una misma línea:
+    el valor de una etiqueta no puede salir de otra posterior. Devuelve las fallas.
+    """
+    casos = [
+        # (texto, fragmento buscado, importe esperado)
+        ("Neto Gravado: 1.000,00  No Gravado: -  IVA 21%: 210,00\nTotal: 1.210,00", "No gravado", None),
+        ("Neto Gravado: 1.000,00  No Gravado: 55,00  IVA 21%: 210,00\nTotal: 1.265,00", "No gravado", 55.0),
+        ("Neto Gravado: 1.000,00  No Gravado: 55,00  IVA 21%: 210,00\nTotal: 1.265,00", "IVA 21%", 210.0),
+        ("Subtotal: 100,00  Conceptos no gravados: 20,00  Total: 120,00", "Conceptos no gravados", 20.0),
+    ]
+    fallas = []
+    for texto, fragmento, esperado in casos:
+        obtenido = IndiceEtiquetas(texto).importe_etiqueta_con(fragmento)
+        if obtenido != esperado:
+            fallas.append(f"{fragmento!r} en {texto!r}: se esperaba {esperado}, se obtuvo {obtenido}")
+    
+    # Sin valor propio, el no gravado no puede tomar el importe del IVA de la misma línea
+    texto = casos[0][0]
+    no_gravado = detectar_bienes_no_computables(texto, 1210.0, 1000.0, 210.0, 0.0)
+    if no_gravado == 210.0:
+        fallas.append(f"No gravado tomó el importe del IVA en {texto!r}")
+    
+    # Como en la expresión original, "TOTAL :" no es la etiqueta "TOTAL:"
+    if IndiceEtiquetas("TOTAL : 99,00").buscar('TOTAL', ignorar_mayusculas=True) is not None:
+        fallas.append("'TOTAL' aceptó un espacio antes del ':'")
+    
+    for falla in fallas:
+        print(f"FALLA {falla}")
+    print(f"{len(casos) + 2 - len(fallas)}/{len(casos) + 2} casos correctos")
+    return fallas
+
+
+def medir_peor_caso_patrones(tamanos=(10000, 20000, 40000, 80000), repeticiones=3):
+    """
+    Mide el tiempo de los conjuntos de patrones sobre textos patológicos (muchas etiquetas
+    sin valores, espacios largos) de tamaño creciente, cada uno el doble del anterior. Con
+    ventanas acotadas, duplicar el tamaño del texto debe duplicar el tiempo, no cuadruplicarlo.
+    Devuelve las fallas: los casos que crecen más de MAX_CRECIMIENTO_PATRONES por duplicación.
+    """
+    casos = {
+        'Total sin dígitos': "Total " ,
+        'Importe Total sin valor': "Importe Total: ---- ",
+        'Bienes sin dos puntos': "Bienes y srvs. no computables " + "x" * 20,
+        'Factura con espacios': "Factura" + " " * 60,
+        'Etiquetas y espacios': "IVA" + " " * 30 + "$" + " " * 30,
+    }
+    conjuntos = dict(registro_patrones.conjuntos)
+    conjuntos['moneda'] = _CONJUNTO_MONEDA
+    
+    fallas = []
+    for nombre_caso, bloque in casos.items():
+        for nombre_conjunto, conjunto in conjuntos.items():
+            tiempos = []
+            for tamano in tamanos:
+                texto = (bloque * (tamano // len(bloque) + 1))[:tamano]
+                # El mínimo de varias repeticiones descarta las pausas ajenas a los patrones
+                mejor = float('inf')
+                for _ in range(repeticiones):
+                    inicio = time.perf_counter()
+                    conjunto.prioridades(texto, presupuesto_ms=float('inf'))
+                    mejor = min(mejor, time.perf_counter() - inicio)
+                tiempos.append(mejor)
+            # Crecimiento medio por cada duplicación del tamaño (≈2 si es lineal, ≈4 si es cuadrático)
+            crecimiento = (tiempos[-1] / tiempos[0]) ** (1 / (len(tamanos) - 1)) if tiempos[0] > 0 else 0.0
+            print(f"{nombre_caso:<26} {nombre_conjunto:<7} "
+                  + " ".join(f"{t * 1000:8.2f}ms" for t in tiempos)
+                  + f"   x{crecimiento:.1f} por duplicación")
+            if crecimiento > MAX_CRECIMIENTO_PATRONES:
+                fallas.append(f"{nombre_caso} ({nombre_conjunto}): x{crecimiento:.1f} por duplicación")
+    
+    for falla in fallas:
+        print(f"FALLA {falla}")
+    return fallas
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Extractor de datos de facturas")
+    parser.add_argument('--benchmark-patrones', action='store_true',
+                        help="Medir el peor caso de los patrones de campos y salir (código 1 si crece más que lineal)")
+    parser.add_argument('--verificar-etiquetas', action='store_true',
+                        help="Verificar el índice de etiquetas con varias etiquetas por línea y salir (código 1 si falla)")
+    parser.add_argument('pdfs', nargs='*', help="Facturas a procesar sin interfaz (junto con --csv, --jsonl o --parquet)")
+    parser.add_argument('--csv', metavar='RUTA', help="Exportar las facturas procesadas a CSV")
+    parser.add_argument('--jsonl', metavar='RUTA', help="Exportar las facturas procesadas a JSON Lines")
+    parser.add_argument('--parquet', metavar='RUTA', help="Exportar las facturas procesadas a Parquet (requiere pyarrow)")
+    # Streamlit puede pasar sus propios argumentos al script
+    argumentos, _ = parser.parse_known_args()
+    salidas = {'CSV': argumentos.csv, 'JSON Lines': argumentos.jsonl, 'Parquet': argumentos.parquet}
+    
+    if argumentos.benchmark_patrones:
+        sys.exit(1 if medir_peor_caso_patrones() else 0)
+    elif argumentos.verificar_etiquetas:
+        sys.exit(1 if verificar_etiquetas_en_linea() else 0)
+    elif any(salidas.values()):
+        if argumentos.parquet and pa is None:
+            parser.error("--parquet requiere pyarrow")
+        if not argumentos.pdfs:
+            parser.error("indicar los PDFs a procesar")
+        archivos = [open(ruta, 'rb') for ruta in argumentos.pdfs]
+        try:
+            datos_list = procesar_lote(archivos, cargar_patrones_facturas(), max_procesos=MAX_PROCESOS_LOTE,
+                                       cache=CacheExtracciones())
+        finally:
+            for archivo in archivos:
+                archivo.close()
+        datos_list = eliminar_duplicados_simple(datos_list)
+        for formato, ruta in salidas.items():
+            if ruta:
+                with open(ruta, 'wb') as destino:
+                    FORMATOS_EXPORTACION[formato][0](datos_list, destino)
+                print(f"{formato}: {len(datos_list)} facturas en {ruta}")
+    else:
+        main()